@@ -5,3 +5,4 @@ __email__ = 'dave@st.germa.in'
 __version__ = '0.4.0'
 
 from .bot import NostrBot, CommunicatorBot, RPCBot
+from .rpc import rpc_method
@@ -0,0 +1,115 @@
+"""
+Shedding unwanted events before they are verified
+"""
+import logging
+import time
+
+from .cache import LRUCache
+from .filters import FilterIndex
+from .metrics import SHED_COUNT
+
+
+class TokenBucket:
+    """
+    Allows `rate` events per second on average, and bursts of up to `burst` events
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic() if now is None else now
+
+    def take(self, now=None):
+        """
+        Returns True if there was a token left for this event
+        """
+        now = time.monotonic() if now is None else now
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class AdmissionControl:
+    """
+    Cheap checks that decide whether an event is worth verifying and handling.
+
+    In order, an event is shed if:
+    - its content is longer than `max_content_size`, or it has more than `max_tags` tags
+    - it doesn't match any of `filters` (the bot's query)
+    - its pubkey is over `rate` events per second (with bursts of `burst`)
+    - all pubkeys together are over `global_rate` events per second (with bursts of `global_burst`)
+
+    Any limit set to 0 (or filters set to None) is not checked. The buckets of the
+    `max_pubkeys` most recently active pubkeys are kept; the global limit bounds
+    floods from many new pubkeys.
+    """
+    def __init__(self, rate=0, burst=10, global_rate=0, global_burst=100, max_content_size=0, max_tags=0,
+                 filters=None, max_pubkeys=10000, name='', log=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_content_size = max_content_size
+        self.max_tags = max_tags
+        self.buckets = LRUCache(max_pubkeys)
+        self.global_bucket = TokenBucket(global_rate, global_burst) if global_rate else None
+        self.set_filters(filters)
+        self.log = log or logging.getLogger(__name__)
+        self.counts = dict.fromkeys(('size', 'query', 'rate', 'global_rate'), 0)
+        self.shed = {reason: SHED_COUNT.labels(bot=name, reason=reason) for reason in self.counts}
+
+    def set_filters(self, filters):
+        """
+        Change the query that events must match. None accepts any event
+        """
+        index = None
+        if filters is not None:
+            index = FilterIndex()
+            for filter_obj in filters:
+                index.add(filter_obj, True)
+        self.index = index
+
+    @property
+    def enabled(self):
+        return bool(
+            self.rate or self.global_bucket or self.max_content_size or self.max_tags or self.index is not None
+        )
+
+    def check(self, event):
+        """
+        Returns the reason to shed the event, or None to admit it
+        """
+        if (self.max_content_size and len(event.content) > self.max_content_size) or \
+                (self.max_tags and len(event.tags) > self.max_tags):
+            return 'size'
+        if self.index is not None and not self.index.matches(event):
+            return 'query'
+        now = time.monotonic()
+        if self.rate:
+            bucket = self.buckets.get(event.pubkey)
+            if bucket is None:
+                bucket = self.buckets[event.pubkey] = TokenBucket(self.rate, self.burst, now)
+            if not bucket.take(now):
+                return 'rate'
+        if self.global_bucket is not None and not self.global_bucket.take(now):
+            return 'global_rate'
+        return None
+
+    def admit(self, event):
+        """
+        Returns True if the event should be verified and handled, counting it if not
+        """
+        reason = self.check(event)
+        if reason is None:
+            return True
+        self.counts[reason] += 1
+        self.shed[reason].inc()
+        self.log.debug("Shed %s from %s: %s", event.id, event.pubkey, reason)
+        return False
+
+    @property
+    def stats(self):
+        return dict(self.counts)
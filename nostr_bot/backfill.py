@@ -0,0 +1,190 @@
+"""
+Loading stored history quickly
+"""
+import asyncio
+import logging
+import secrets
+from collections import deque
+
+from .cache import SeenCache
+from .query import split_filter
+
+
+class Lane:
+    """
+    The windows to load for one filter on one relay, from `until` back to `since`.
+    After an empty window the next one is twice as long, so years without events
+    take a few requests rather than one per window
+    """
+    def __init__(self, relay, filter_obj, since, until, window):
+        self.relay = relay
+        self.filter = filter_obj
+        self.since = since
+        self.end = until
+        self.window = self.size = window
+
+    def next_window(self):
+        """
+        The next (since, until) to load, or None when the lane is done
+        """
+        if self.end < self.since:
+            return None
+        start = max(self.end - self.size + 1, self.since)
+        window = (start, self.end)
+        self.end = start - 1
+        return window
+
+    def loaded(self, found):
+        self.size = self.window if found else self.size * 2
+
+
+class Backfill:
+    """
+    Loads the stored events matching a filter between `since` and `until`.
+
+    The range is split into windows of `window` seconds, and each window is paged
+    backwards with `until` on each relay until the relay has nothing more.
+    Up to `fan_out` windows are loaded at the same time, taking turns between the relays
+    and author chunks. Windows are only made when they are loaded, and grow over empty stretches.
+    Events are yielded as they arrive, so they are not in chronological order.
+
+    A page that times out is retried `page_retries` times, waiting `retry_delay` seconds
+    and twice as long each time after that. The ranges that still couldn't be loaded are
+    added to `gaps`, as (relay url, filter, since, until).
+    """
+    def __init__(self, manager, window=86400, page_size=500, fan_out=4, max_authors=500,
+                 page_timeout=30.0, page_retries=3, retry_delay=1.0, dedup_size=100000, log=None):
+        self.manager = manager
+        self.window = window
+        self.page_size = page_size
+        self.fan_out = fan_out
+        self.max_authors = max_authors
+        self.page_timeout = page_timeout
+        self.page_retries = page_retries
+        self.retry_delay = retry_delay
+        self.gaps = []
+        self.dedup_size = dedup_size
+        self.log = log or logging.getLogger(__name__)
+
+    async def fetch_page(self, relay, filter_obj):
+        sub_id = secrets.token_hex(4)
+        queue = await relay.subscribe(sub_id, filter_obj)
+        events = []
+        try:
+            while True:
+                event = await asyncio.wait_for(queue.get(), self.page_timeout)
+                if event is None:
+                    break
+                events.append(event)
+        finally:
+            await relay.unsubscribe(sub_id)
+        return events
+
+    async def fetch_page_retrying(self, relay, filter_obj):
+        delay = self.retry_delay
+        for attempt in range(self.page_retries):
+            try:
+                return await self.fetch_page(relay, filter_obj)
+            except asyncio.TimeoutError:
+                self.log.warning("Timed out loading %s from %s. Retrying in %ss", filter_obj, relay.url, delay)
+                await asyncio.sleep(delay)
+                delay *= 2
+        return await self.fetch_page(relay, filter_obj)
+
+    async def load_second(self, relay, filter_obj, timestamp, output, known):
+        """
+        Load a second with more than a page of events, by splitting one of the filter's lists,
+        such as its authors, in half until each half fits in a page.
+        Returns False if some of them couldn't be loaded
+        """
+        key = next((key for key, value in filter_obj.items() if isinstance(value, list) and len(value) > 1), None)
+        if key is None:
+            return False
+        values = filter_obj[key]
+        half = len(values) // 2
+        loaded = True
+        for part in (values[:half], values[half:]):
+            part_filter = dict(filter_obj, **{key: part})
+            page_filter = dict(part_filter, since=timestamp, until=timestamp, limit=self.page_size)
+            events = await self.fetch_page_retrying(relay, page_filter)
+            for event in events:
+                if event.id not in known:
+                    known.add(event.id)
+                    await output.put(event)
+            if len(events) >= self.page_size:
+                loaded = await self.load_second(relay, part_filter, timestamp, output, known) and loaded
+        return loaded
+
+    async def load_window(self, relay, filter_obj, since, until, output):
+        """
+        Page through one window on one relay. Returns False if it was empty
+        """
+        boundary_ids = set()
+        found = False
+        try:
+            while True:
+                page_filter = dict(filter_obj, since=since, until=until, limit=self.page_size)
+                events = await self.fetch_page_retrying(relay, page_filter)
+                found = found or bool(events)
+                new = [event for event in events if event.id not in boundary_ids]
+                for event in new:
+                    await output.put(event)
+                if len(events) < self.page_size or not new:
+                    return found
+                oldest = min(event.created_at for event in events)
+                if oldest == until:
+                    # a whole page within one second. `until` can't page through it
+                    known = {event.id for event in events} | boundary_ids
+                    if not await self.load_second(relay, filter_obj, until, output, known):
+                        self.log.warning("Could not load all the events at %d from %s", until, relay.url)
+                        self.gaps.append((relay.url, filter_obj, until, until))
+                    until -= 1
+                    boundary_ids = set()
+                else:
+                    # `until` is inclusive, so the next page repeats the events at `oldest`
+                    until = oldest
+                    boundary_ids = {event.id for event in events if event.created_at == oldest}
+                if until < since:
+                    return found
+        except asyncio.TimeoutError:
+            self.log.warning("Gave up loading %s from %s between %d and %d", filter_obj, relay.url, since, until)
+            self.gaps.append((relay.url, filter_obj, since, until))
+            return True
+
+    async def get_events(self, filter_obj, since, until):
+        filter_obj = {key: value for key, value in filter_obj.items() if key not in ('since', 'until', 'limit')}
+        lanes = deque(
+            Lane(relay, chunk, since, until, self.window)
+            for chunk in split_filter(filter_obj, self.max_authors)
+            for relay in self.manager.relays
+        )
+        self.log.info("Backfilling %s from %d to %d in %d lanes", filter_obj, since, until, len(lanes))
+        output = asyncio.Queue(maxsize=1000)
+        seen = SeenCache(self.dedup_size)
+
+        async def work():
+            while lanes:
+                lane = lanes[0]
+                lanes.rotate(-1)
+                window = lane.next_window()
+                if window is None:
+                    if lane in lanes:
+                        lanes.remove(lane)
+                    continue
+                lane.loaded(await self.load_window(lane.relay, lane.filter, *window, output))
+
+        tasks = [asyncio.create_task(work()) for i in range(self.fan_out)]
+        done = asyncio.ensure_future(asyncio.gather(*tasks))
+        done.add_done_callback(lambda f: asyncio.ensure_future(output.put(None)))
+        try:
+            while True:
+                event = await output.get()
+                if event is None:
+                    break
+                if not seen.seen(event.id):
+                    yield event
+            await done
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,65 @@
+"""
+Batching work
+"""
+import asyncio
+
+
+class Batcher:
+    """
+    Collects items and processes them together with `await func(items)`,
+    which must return one result per item.
+
+    A batch is processed once it has `size` items, or `delay` seconds after its first item arrived.
+    `submit(item)` returns a future for the item's result.
+    """
+    def __init__(self, func, size=100, delay=0.05):
+        self.func = func
+        self.size = size
+        self.delay = delay
+        self.items = []
+        self.futures = []
+        self.timer = None
+        self.tasks = set()
+
+    def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.items.append(item)
+        self.futures.append(future)
+        if len(self.items) >= self.size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.delay, self.flush)
+        return future
+
+    def flush(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if not self.items:
+            return
+        items, futures = self.items, self.futures
+        self.items, self.futures = [], []
+        task = asyncio.create_task(self._run(items, futures))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, items, futures):
+        try:
+            results = await self.func(items)
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for future, result in zip(futures, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def close(self):
+        """
+        Process any waiting items and wait for all batches to finish
+        """
+        self.flush()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
@@ -0,0 +1,6 @@
+"""
+Benchmarking bots against local relays
+"""
+from .generate import EventGenerator
+from .relay import FakeRelay
+from .runner import Benchmark, run_benchmark
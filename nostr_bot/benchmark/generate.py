@@ -0,0 +1,54 @@
+"""
+Synthetic signed events
+"""
+import json
+import random
+import time
+
+from aionostr.event import Event
+from aionostr.key import PrivateKey
+
+
+class EventGenerator:
+    """
+    Makes signed events from `authors` random keys, with kinds chosen from `kinds`
+    and every tag in `tags`.
+
+    With `rpc_method`, the content is an RPC command calling that method.
+    If `encrypt_with` is the recipient's SharedSecrets, the commands are encrypted
+    to the recipient, the way each author would have encrypted them
+    """
+    def __init__(self, authors=100, kinds=(1,), tags=(), rpc_method=None, encrypt_with=None,
+                 content_size=64, seed=None):
+        self.random = random.Random(seed)
+        self.keys = [PrivateKey(self.random.randbytes(32)) for i in range(authors)]
+        self.pubkeys = [key.public_key.hex() for key in self.keys]
+        self.kinds = list(kinds)
+        self.tags = [list(tag) for tag in tags]
+        self.rpc_method = rpc_method
+        self.encrypt_with = encrypt_with
+        self.content_size = content_size
+
+    def make_content(self, index, pubkey):
+        if not self.rpc_method:
+            return f'{index} ' + 'x' * self.content_size
+        content = json.dumps({'method': self.rpc_method, 'args': [index]})
+        if self.encrypt_with is not None:
+            content = self.encrypt_with.encrypt(content, pubkey)
+        return content
+
+    def make_event(self, index, created_at=None):
+        author = self.random.randrange(len(self.keys))
+        pubkey = self.pubkeys[author]
+        event = Event(
+            pubkey=pubkey,
+            kind=self.random.choice(self.kinds),
+            content=self.make_content(index, pubkey),
+            tags=[list(tag) for tag in self.tags],
+            created_at=created_at or int(time.time()),
+        )
+        self.keys[author].sign_event(event)
+        return event
+
+    def generate(self, count):
+        return [self.make_event(i) for i in range(count)]
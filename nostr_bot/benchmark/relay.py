@@ -0,0 +1,99 @@
+"""
+A local relay stand-in for benchmarks
+"""
+import asyncio
+import json
+import logging
+
+from websockets import serve
+
+from ..filters import event_matches
+
+
+class FakeRelay:
+    """
+    A minimal in-memory relay on localhost.
+
+    It answers REQ with the stored events matching the filters and EOSE,
+    keeps subscriptions open for events sent with `push()`, and answers
+    published events with OK. It is only fast and correct enough to exercise a bot
+    """
+    def __init__(self, host='127.0.0.1', port=0, log=None):
+        self.host = host
+        self.port = port
+        self.log = log or logging.getLogger(__name__)
+        self.server = None
+        # Event objects returned for REQs
+        self.stored = []
+        # event dicts published by clients
+        self.published = []
+        # (websocket, sub_id) -> filters
+        self.subscriptions = {}
+
+    @property
+    def url(self):
+        return f'ws://{self.host}:{self.port}'
+
+    async def start(self):
+        self.server = await serve(self.handler, self.host, self.port)
+        self.port = list(self.server.sockets)[0].getsockname()[1]
+        return self
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, ex_type, ex, tb):
+        await self.close()
+
+    def store(self, events):
+        self.stored.extend(events)
+
+    async def push(self, event):
+        """
+        Send the Event to the matching subscriptions
+        """
+        row = None
+        for (ws, sub_id), filters in list(self.subscriptions.items()):
+            if any(event_matches(f, event) for f in filters):
+                if row is None:
+                    row = json.dumps(event.to_json_object())
+                try:
+                    await ws.send(f'["EVENT",{json.dumps(sub_id)},{row}]')
+                except Exception:
+                    self.subscriptions.pop((ws, sub_id), None)
+
+    async def handler(self, ws, path=None):
+        try:
+            async for message in ws:
+                await self.handle_message(ws, json.loads(message))
+        except Exception as e:
+            self.log.debug("Connection closed: %s", e)
+        finally:
+            for key in [key for key in self.subscriptions if key[0] is ws]:
+                del self.subscriptions[key]
+
+    async def handle_message(self, ws, message):
+        if message[0] == 'EVENT':
+            row = message[1]
+            self.published.append(row)
+            await ws.send(json.dumps(['OK', row['id'], True, '']))
+        elif message[0] == 'REQ':
+            sub_id, filters = message[1], message[2:]
+            self.subscriptions[(ws, sub_id)] = filters
+            for f in filters:
+                matched = [event for event in self.stored if event_matches(f, event)]
+                if f.get('limit') is not None:
+                    matched = sorted(matched, key=lambda e: e.created_at, reverse=True)[:f['limit']]
+                for event in matched:
+                    await ws.send(json.dumps(['EVENT', sub_id, event.to_json_object()]))
+            await ws.send(json.dumps(['EOSE', sub_id]))
+        elif message[0] == 'CLOSE':
+            self.subscriptions.pop((ws, message[1]), None)
+        # give the other connections a turn
+        await asyncio.sleep(0)
@@ -0,0 +1,225 @@
+"""
+Running a bot against local relays and measuring it
+"""
+import asyncio
+import logging
+import random
+import time
+
+from ..bot import RPCBot, load_bots
+from ..metrics import registry
+from .generate import EventGenerator
+from .relay import FakeRelay
+
+log = logging.getLogger(__name__)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(int(round(fraction * (len(values) - 1))), len(values) - 1)]
+
+
+def max_rss_mb():
+    """
+    The peak resident memory of this process, or None where it isn't available
+    """
+    try:
+        import resource
+        import sys
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss / (1 << 20) if sys.platform == 'darwin' else rss / 1024
+
+
+class Benchmark:
+    """
+    Runs a bot against `relays` FakeRelays and sends it `count` generated events.
+
+    The events are sent live at `rate` per second (0 sends them as fast as possible),
+    or stored on the relays before the bot starts with `stored`.
+    `duplicate_ratio` of the events are also sent by a second relay.
+
+    Bots with an author filter (like RPCBot, which listens to its own key) have
+    LISTEN_PUBKEY cleared, so the generated authors match. The other attributes
+    in `options` are set on the bot.
+    """
+    def __init__(self, classname, count=10000, rate=0, authors=100, kinds=None, rpc_method=None,
+                 relays=1, duplicate_ratio=0.0, stored=False, timeout=60.0, seed=None, **options):
+        self.classname = classname
+        self.count = count
+        self.rate = rate
+        self.authors = authors
+        self.kinds = kinds
+        self.rpc_method = rpc_method
+        self.num_relays = max(relays, 1)
+        self.duplicate_ratio = duplicate_ratio
+        self.stored = stored
+        self.timeout = timeout
+        self.seed = seed
+        self.options = options
+        self.relays = []
+        # event id -> time it was sent
+        self.sent = {}
+        self.handled = {}
+        self.handler_latency = []
+        self.all_handled = asyncio.Event()
+
+    def make_bot(self):
+        options = dict(self.options, RELAYS=[relay.url for relay in self.relays])
+        if self.stored:
+            options.setdefault('LIMIT', self.count)
+        bot = load_bots([self.classname], **options)[0]
+        if getattr(bot, 'LISTEN_PUBKEY', None):
+            bot.LISTEN_PUBKEY = None
+        handle_event = bot.handle_event
+
+        async def timed_handle_event(event):
+            start = time.perf_counter()
+            try:
+                await handle_event(event)
+            finally:
+                end = time.perf_counter()
+                if event.id in self.sent and event.id not in self.handled:
+                    self.handler_latency.append(end - start)
+                    self.handled[event.id] = end
+                    if len(self.handled) == self.count:
+                        self.all_handled.set()
+
+        bot.handle_event = timed_handle_event
+        return bot
+
+    def make_generator(self, bot):
+        query = bot.get_query()
+        filter_obj = (query if isinstance(query, dict) else query[0]) or {}
+        if filter_obj.get('authors') or filter_obj.get('ids'):
+            raise ValueError(f"Can't generate events for the query {filter_obj}")
+        tags = [[key[1:], values[0]] for key, values in filter_obj.items() if key.startswith('#') and values]
+        kinds = self.kinds or filter_obj.get('kinds') or [1]
+        rpc_method = self.rpc_method
+        encrypt_with = None
+        if isinstance(bot, RPCBot):
+            rpc_method = rpc_method or 'ping'
+            if bot.ENCRYPTED:
+                encrypt_with = bot.shared_secrets
+        return EventGenerator(
+            authors=self.authors,
+            kinds=kinds,
+            tags=tags,
+            rpc_method=rpc_method,
+            encrypt_with=encrypt_with,
+            seed=self.seed,
+        )
+
+    def assign(self, events):
+        """
+        Returns (event, relays) for each event
+        """
+        choose = random.Random(self.seed)
+        assigned = []
+        for i, event in enumerate(events):
+            relays = [self.relays[i % self.num_relays]]
+            if self.duplicate_ratio and choose.random() < self.duplicate_ratio:
+                relays.append(self.relays[(i + 1) % self.num_relays])
+            assigned.append((event, relays))
+        return assigned
+
+    async def wait_for_subscriptions(self):
+        deadline = time.perf_counter() + self.timeout
+        while not all(relay.subscriptions for relay in self.relays):
+            if time.perf_counter() > deadline:
+                raise TimeoutError("The bot didn't subscribe")
+            await asyncio.sleep(0.01)
+
+    async def send(self, assigned):
+        start = time.perf_counter()
+        for i, (event, relays) in enumerate(assigned):
+            if self.rate:
+                delay = start + i / self.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self.sent[event.id] = time.perf_counter()
+            for relay in relays:
+                await relay.push(event)
+
+    async def run(self):
+        self.relays = [await FakeRelay().start() for i in range(self.num_relays)]
+        task = None
+        try:
+            bot = self.make_bot()
+            origin = bot.get_origin()
+            start = time.perf_counter()
+            events = self.make_generator(bot).generate(self.count)
+            generate_seconds = time.perf_counter() - start
+            assigned = self.assign(events)
+            stages_before = self.stages(origin)
+
+            if self.stored:
+                for event, relays in assigned:
+                    for relay in relays:
+                        relay.store([event])
+            start = time.perf_counter()
+            task = asyncio.create_task(bot.start())
+            if self.stored:
+                self.sent = dict.fromkeys((event.id for event, relays in assigned), start)
+            else:
+                await self.wait_for_subscriptions()
+                start = time.perf_counter()
+                await self.send(assigned)
+            try:
+                await asyncio.wait_for(self.all_handled.wait(), self.timeout)
+            except asyncio.TimeoutError:
+                log.warning("Timed out with %d of %d events handled", len(self.handled), self.count)
+            elapsed = (max(self.handled.values()) if self.handled else time.perf_counter()) - start
+        finally:
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+            for relay in self.relays:
+                await relay.close()
+
+        end_to_end = [self.handled[event_id] - self.sent[event_id] for event_id in self.handled]
+        stages = self.stages(origin)
+        return {
+            'bot': self.classname,
+            'events': self.count,
+            'sent': sum(len(relays) for event, relays in assigned),
+            'handled': len(self.handled),
+            'seconds': elapsed,
+            'events_per_second': len(self.handled) / elapsed if elapsed > 0 else 0.0,
+            'handler_p50_ms': percentile(self.handler_latency, 0.5) * 1000,
+            'handler_p99_ms': percentile(self.handler_latency, 0.99) * 1000,
+            'end_to_end_p50_ms': percentile(end_to_end, 0.5) * 1000,
+            'end_to_end_p99_ms': percentile(end_to_end, 0.99) * 1000,
+            'replies': sum(len(relay.published) for relay in self.relays),
+            'stages': {stage: stages.get(stage, 0) - stages_before.get(stage, 0) for stage in stages},
+            'generate_seconds': generate_seconds,
+            'max_rss_mb': max_rss_mb(),
+        }
+
+    def stages(self, origin):
+        return {
+            sample['labels']['stage']: sample['value']
+            for sample in registry.snapshot(bot=origin)['nostr_bot_events_total']
+        }
+
+
+async def run_benchmark(classname, trace_memory=False, **kwargs):
+    """
+    Run a Benchmark and return its results.
+    With `trace_memory`, the peak Python memory allocated during the run is included
+    """
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+    try:
+        results = await Benchmark(classname, **kwargs).run()
+        if trace_memory:
+            results['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / (1 << 20)
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return results
@@ -1,8 +1,24 @@
+import asyncio
 import logging
 import os
-
-from aionostr.relay import Manager
-from aionostr.event import Event, loads, dumps
+import time
+
+from aionostr.event import Event
+from .admission import AdmissionControl
+from .backfill import Backfill
+from .cache import LRUCache, SeenCache
+from .codec import CommandError, get_codec
+from .dispatch import EventDispatcher
+from .health import relay_health
+from .metrics import EVENT_COUNT, STAGE_LATENCY
+from .nip04 import SharedSecrets
+from .outbox import Outbox
+from .pool import relay_pool
+from .profiles import ProfileResolver
+from .query import LOADED, LiveQuery, QueryPlanner
+from .rpc import find_rpc_methods
+from .store import StateStore
+from .verify import EventVerifier, has_valid_id
 
 __all__ = ('NostrBot', 'RPCBot', 'CommunicatorBot')
 
@@ -16,25 +32,192 @@ class NostrBot:
     LISTEN_KIND = 1
     LISTEN_PUBKEY = ''
     LIMIT = 1
+    # number of events handled at the same time. 1 handles them inline
+    CONCURRENCY = 1
+    QUEUE_SIZE = 100
+    # keep events from the same pubkey in order when CONCURRENCY > 1
+    ORDER_BY_PUBKEY = False
+    # seconds to wait for queued events when stopping
+    DRAIN_TIMEOUT = 10
+    # priority class of the bot's events when bots share a PriorityScheduler: 'interactive', 'default' or 'bulk'
+    PRIORITY = 'default'
+    # priority classes of some kinds, over PRIORITY
+    KIND_PRIORITIES = {0: 'bulk', 4: 'interactive', 22222: 'interactive'}
+    # verify signatures in batches, in this many processes. 0 verifies them inline
+    VERIFY_WORKERS = 0
+    # use threads instead of processes for verification
+    VERIFY_THREADS = False
+    VERIFY_BATCH_SIZE = 64
+    VERIFY_BATCH_DELAY = 0.01
+    # number of verified event ids to remember
+    VERIFIED_CACHE_SIZE = 10000
+    # number of event ids to remember for skipping duplicates. 0 disables deduplication
+    DEDUP_SIZE = 10000
+    # forget event ids after this many seconds
+    DEDUP_TTL = None
+    # events per second allowed from each pubkey before verification, in bursts of up to RATE_LIMIT_BURST.
+    # 0 disables the limit
+    RATE_LIMIT = 0
+    RATE_LIMIT_BURST = 10
+    # events per second allowed from all pubkeys together
+    GLOBAL_RATE_LIMIT = 0
+    GLOBAL_RATE_LIMIT_BURST = 100
+    # shed events with longer content or more tags than this. 0 disables the check
+    MAX_CONTENT_SIZE = 0
+    MAX_TAGS = 0
+    # shed events that don't match get_query()
+    CHECK_QUERY = True
+    # remember this many ids in Bloom filters instead, for very large windows
+    DEDUP_BLOOM_CAPACITY = 0
+    # filters with more authors than this are split into several subscriptions
+    MAX_AUTHORS = 500
+    # number of split subscriptions loading stored events at the same time
+    QUERY_FAN_OUT = 4
+    # seconds a split subscription can load stored events before the next one starts anyway
+    QUERY_EOSE_TIMEOUT = 10
+    # load stored events for queries with `since` in parallel time windows, before going live
+    BACKFILL = False
+    # seconds per window
+    BACKFILL_WINDOW = 86400
+    BACKFILL_PAGE_SIZE = 500
+    # number of windows loading at the same time
+    BACKFILL_FAN_OUT = 4
+    # sqlite file for persistent state. Defaults to <origin>.sqlite
+    STATE_FILE = None
+    # seconds between writes of the state to disk
+    STATE_FLUSH_INTERVAL = 1.0
+    # append the events received from the relays to this JSONL file, for `nostr-bot replay`
+    RECORD_FILE = None
+    # profile lookups are fetched together, in queries for up to PROFILE_BATCH_SIZE authors
+    # made PROFILE_BATCH_DELAY seconds after the first lookup
+    PROFILE_BATCH_SIZE = 100
+    PROFILE_BATCH_DELAY = 0.05
+    # number of profiles to remember, and for how many seconds
+    PROFILE_CACHE_SIZE = 10000
+    PROFILE_TTL = 3600
+    # seconds to remember that a pubkey has no profile
+    PROFILE_MISSING_TTL = 300
     RELAYS = ['ws://localhost:6969']
     PRIVATE_KEY = os.getenv('NOSTR_KEY', 'd3b7207018ac76dfab82100a6c07a42c68b8efc4898b96d2882b8a7636dd0498')
 
     def __init__(self):
         self.log = logging.getLogger(self.get_origin())
         self._manager = None
+        # (PRIVATE_KEY, parsed key)
+        self._private_key = None
+        self._store = None
+        self._profiles = None
+        self.verified_ids = LRUCache(self.VERIFIED_CACHE_SIZE)
+        self.seen_ids = self.get_seen_cache()
+        # the running subscription, for update_query()
+        self.live_query = None
+        self.admission = None
+        # the BotRouter running this bot, if any
+        self.router = None
+        # the PriorityScheduler shared with other bots, if any
+        self.scheduler = None
+        # created_at of the newest event processed, but not in the future
+        self.last_event_at = 0
+        # True until the stored events of the subscription have all been dispatched
+        self.loading = False
+        # in a worker process, the shard of the events it handles. In the parent, the number of shards
+        self.shard = None
+        self.shards = 0
 
     def get_origin(self):
         return self.__class__.__name__
 
-    def get_manager(self):
+    def get_manager(self, relays=None):
+        """
+        A Manager for `relays` (by default, get_relays()).
+        Connections come from the process-wide relay pool, so they are shared with other bots
+        """
         pk = self.private_key
         if pk:
             pk = pk.hex()
-        return Manager(self.get_relays(), origin=self.get_origin(), private_key=pk)
+        return relay_pool.get_manager(relays or self.get_relays(), origin=self.get_origin(), private_key=pk)
+
+    def get_priority(self, event: Event):
+        """
+        The priority class of the event, when the bot's events are handled by a PriorityScheduler
+        """
+        return self.KIND_PRIORITIES.get(event.kind, self.PRIORITY)
+
+    def get_dispatcher(self):
+        # events from the same pubkey can't be kept in order by the scheduler
+        if self.scheduler is not None and not self.ORDER_BY_PUBKEY:
+            dispatcher = self.scheduler.get_dispatcher(
+                self.handle_event,
+                priority=self.get_priority,
+                concurrency=self.CONCURRENCY,
+                queue_size=self.QUEUE_SIZE,
+                name=self.get_origin(),
+                log=self.log,
+            )
+        else:
+            dispatcher = EventDispatcher(
+                self.handle_event,
+                concurrency=self.CONCURRENCY,
+                queue_size=self.QUEUE_SIZE,
+                ordered=self.ORDER_BY_PUBKEY,
+                name=self.get_origin(),
+                log=self.log,
+            )
+        dispatcher.on_done = self.end_event
+        return dispatcher
+
+    def get_seen_cache(self):
+        if not (self.DEDUP_SIZE or self.DEDUP_BLOOM_CAPACITY):
+            return None
+        return SeenCache(self.DEDUP_SIZE, ttl=self.DEDUP_TTL, bloom_capacity=self.DEDUP_BLOOM_CAPACITY)
+
+    def get_admission(self):
+        filters = None
+        if self.CHECK_QUERY:
+            query = self.get_query()
+            filters = query if isinstance(query, (list, tuple)) else [query]
+        return AdmissionControl(
+            rate=self.RATE_LIMIT,
+            burst=self.RATE_LIMIT_BURST,
+            global_rate=self.GLOBAL_RATE_LIMIT,
+            global_burst=self.GLOBAL_RATE_LIMIT_BURST,
+            max_content_size=self.MAX_CONTENT_SIZE,
+            max_tags=self.MAX_TAGS,
+            filters=filters,
+            name=self.get_origin(),
+            log=self.log,
+        )
+
+    def get_profile_resolver(self):
+        return ProfileResolver(
+            self.get_events,
+            verify=self.is_verified,
+            batch_size=self.PROFILE_BATCH_SIZE,
+            delay=self.PROFILE_BATCH_DELAY,
+            maxsize=self.PROFILE_CACHE_SIZE,
+            ttl=self.PROFILE_TTL,
+            missing_ttl=self.PROFILE_MISSING_TTL,
+            name=self.get_origin(),
+            log=self.log,
+        )
+
+    def get_verifier(self):
+        return EventVerifier(
+            workers=self.VERIFY_WORKERS,
+            batch_size=self.VERIFY_BATCH_SIZE,
+            batch_delay=self.VERIFY_BATCH_DELAY,
+            threads=self.VERIFY_THREADS,
+        )
 
     def get_relays(self):
         return self.RELAYS
 
+    def get_relay_scores(self):
+        """
+        The health of the bot's relays, from best to worst
+        """
+        return relay_health.scores(self.get_relays())
+
     def get_query(self):
         filter_obj = {
             'limit': self.LIMIT
@@ -45,17 +228,32 @@ class NostrBot:
             filter_obj['kinds'] = [self.LISTEN_KIND]
         return filter_obj
 
+    @staticmethod
+    def parse_private_key(private_key: str):
+        from aionostr.key import PrivateKey
+        from aionostr.util import from_nip19
+        if private_key.startswith('nsec'):
+            return from_nip19(private_key)['object']
+        return PrivateKey(bytes.fromhex(private_key))
+
     @property
     def private_key(self):
+        """
+        The parsed PRIVATE_KEY. It is parsed once, and again only if PRIVATE_KEY changes
+        """
         if not self.PRIVATE_KEY:
             return None
-        from aionostr.key import PrivateKey
-        from aionostr.util import from_nip19
-        if self.PRIVATE_KEY.startswith('nsec'):
-            pk = from_nip19(self.PRIVATE_KEY)['object']
-        else:
-            pk = PrivateKey(bytes.fromhex(self.PRIVATE_KEY))
-        return pk
+        cached = self._private_key
+        if cached is None or cached[0] != self.PRIVATE_KEY:
+            cached = self._private_key = (self.PRIVATE_KEY, self.parse_private_key(self.PRIVATE_KEY))
+        return cached[1]
+
+    def sign_event(self, event: Event):
+        """
+        Sign the event with the bot's private key
+        """
+        self.private_key.sign_event(event)
+        return event
 
     @property
     def manager(self):
@@ -67,27 +265,372 @@ class NostrBot:
     def manager(self, manager):
         self._manager = manager
 
-    async def start(self):
-        if self.private_key:
-            self.manager.private_key = self.private_key.hex()
+    def get_state_file(self):
+        return self.STATE_FILE or f'{self.get_origin()}.sqlite'
+
+    @property
+    def store(self):
+        """
+        A StateStore for state that should survive restarts
+        """
+        if self._store is None:
+            self._store = StateStore(
+                self.get_state_file(),
+                flush_interval=self.STATE_FLUSH_INTERVAL,
+                shard=self.shard,
+                shards=self.shards,
+                log=self.log,
+            )
+            if self.loading:
+                self._store.checkpoint.hold()
+        return self._store
+
+    @property
+    def checkpoint(self):
+        """
+        The Checkpoint of the store's cursor, or None if the bot has no store
+        """
+        return self._store.checkpoint if self._store is not None else None
+
+    @property
+    def profiles(self):
+        """
+        A ProfileResolver for looking up profiles, e.g. `await self.profiles.get_name(pubkey)`.
+        Kind 0 events received by the bot are added to it
+        """
+        if self._profiles is None:
+            self._profiles = self.get_profile_resolver()
+        return self._profiles
+
+    @profiles.setter
+    def profiles(self, profiles):
+        self._profiles = profiles
+
+    async def start(self, events=None):
+        """
+        Connect, subscribe to the query and handle events until cancelled.
+        If the async iterator `events` is given, it is handled instead of the subscription
+        """
+        private_key = self.private_key
+        if private_key:
+            self.manager.private_key = private_key.hex()
+        if events is None:
+            # relays send stored events newest first, so the cursor waits until they are all processed
+            self.loading = True
         await self.manager.connect()
+        await self.setup()
+
+        if events is None:
+            query = self.get_query()
+            self.log.info("Running query %s on %s", query, self.get_relays())
+
+            filters = query if isinstance(query, (list, tuple)) else [query]
+            if self.BACKFILL and any(f.get('since') for f in filters):
+                events = self.backfill_events(*filters)
+            else:
+                self.live_query = LiveQuery(self.get_events, filters, mark_loaded=True, log=self.log)
+                events = self.live_query.events()
+            if self.RECORD_FILE:
+                from .replay import EventRecorder
+                events = EventRecorder(self.RECORD_FILE).record(events)
+        try:
+            await self.process_events(events)
+        finally:
+            await self.close()
 
-        query = self.get_query()
-        self.log.info("Running query %s on %s", query, self.get_relays())
+    async def close(self):
+        """
+        Called when the bot stops
+        """
+        if self._profiles is not None:
+            await self._profiles.close()
+            self._profiles = None
+        if self._store is not None:
+            await self._store.close()
+            self._store = None
+        if self._manager is not None:
+            await self._manager.close()
+            self._manager = None
+
+    def get_events(self, *filters, only_stored=True, mark_loaded=False):
+        """
+        Query the relays, splitting filters with too many authors into several subscriptions.
+        With `mark_loaded`, a live query yields LOADED after the stored events
+        """
+        planner = QueryPlanner(
+            self.manager,
+            max_authors=self.MAX_AUTHORS,
+            fan_out=self.QUERY_FAN_OUT,
+            eose_timeout=self.QUERY_EOSE_TIMEOUT,
+            log=self.log,
+        )
+        return planner.get_events(*filters, only_stored=only_stored, mark_loaded=mark_loaded)
+
+    async def backfill_events(self, *filters):
+        """
+        Load the history of filters with `since` using Backfill, then continue with live events.
 
+        The live subscription starts from now before the backfill begins, and buffers
+        events until the backfill is done, so nothing is missed in between.
+        If the backfill leaves gaps, the cursor isn't moved, so they are loaded again next time.
+        """
+        now = int(time.time())
+        live_filters = [dict(f, since=now) if f.get('since') else f for f in filters]
+        live = asyncio.Queue()
+        self.live_query = LiveQuery(self.get_events, live_filters, log=self.log)
 
-        async for event in self.manager.get_events(query, only_stored=False):
+        async def listen():
             try:
-                if not event.verify():
-                    self.log.warning('Invalid event: %s', event.id)
+                async for event in self.live_query.events():
+                    await live.put(event)
+            finally:
+                live.put_nowait(None)
+
+        listener = asyncio.create_task(listen())
+        backfill = Backfill(
+            self.manager,
+            window=self.BACKFILL_WINDOW,
+            page_size=self.BACKFILL_PAGE_SIZE,
+            fan_out=self.BACKFILL_FAN_OUT,
+            max_authors=self.MAX_AUTHORS,
+            log=self.log,
+        )
+        try:
+            for filter_obj in filters:
+                if filter_obj.get('since'):
+                    async for event in backfill.get_events(filter_obj, filter_obj['since'], now):
+                        yield event
+            self.log.info("Backfill done. %d live events waiting", live.qsize())
+            if backfill.gaps:
+                # so they are loaded again after a restart
+                self.log.warning("Could not load %s. The cursor stays where it was", backfill.gaps)
+            else:
+                yield LOADED
+            while True:
+                event = await live.get()
+                if event is None:
+                    # raise any error from the live subscription
+                    await listener
+                    return
+                yield event
+        finally:
+            listener.cancel()
+
+    async def update_query(self, query=None, since=None):
+        """
+        Change the filters of the running subscription to `query` (by default, get_query()),
+        without reconnecting. Filters that only gained authors get a subscription for the
+        new authors; otherwise the subscription is closed and opened again.
+        The new subscriptions start at `since`, which defaults to the last processed event
+        """
+        if self.router is not None:
+            return await self.router.update_query(query, since=since, bot=self)
+        if query is None:
+            query = self.get_query()
+        filters = query if isinstance(query, (list, tuple)) else [query]
+        if self.admission is not None:
+            self.admission.set_filters(filters if self.CHECK_QUERY else None)
+        if self.live_query is None:
+            self.log.warning("No running subscription to update")
+            return
+        if since is None:
+            since = self.last_event_at or int(time.time())
+        opened = await self.live_query.update(filters, since=since)
+        self.log.info("Updated query. Opened %d filters since %d", len(opened), since)
+
+    async def setup(self):
+        """
+        Called once the manager is connected, before the query is made.
+        Override this to prepare anything the query or the handler needs
+        """
+
+    async def process_events(self, events):
+        """
+        Deduplicate, admit and verify the events from the async iterator `events`
+        and dispatch them to `handle_event`
+        """
+        dispatcher = self.get_dispatcher()
+        duplicate = EVENT_COUNT.labels(bot=self.get_origin(), stage='duplicate')
+        try:
+            async for event in self.verified_events(self.admitted_events(self.unique_events(events))):
+                if event is LOADED:
+                    # every event received before it has been dispatched or dropped
+                    await self.stored_loaded()
                     continue
-            except Exception as e:
-                self.log.error(str(e))
+                # ids are only remembered once verified, so a forged copy can't hide the real event.
+                # copies that were verified at the same time are dropped here
+                if self.seen_ids is not None and self.seen_ids.seen(self.seen_key(event)):
+                    duplicate.inc()
+                    self.drop_event(event)
+                    continue
+                if event.created_at > self.last_event_at:
+                    self.last_event_at = min(event.created_at, int(time.time()))
+                if event.kind == 0:
+                    self.profiles.feed(event)
+                await dispatcher.put(event)
+        finally:
+            await dispatcher.close(self.DRAIN_TIMEOUT)
+
+    async def stored_loaded(self):
+        """
+        Called once the stored events have all been dispatched. Until then, the cursor doesn't move
+        """
+        self.loading = False
+        if self.checkpoint is not None:
+            self.checkpoint.loaded()
+
+    def begin_event(self, event: Event):
+        """
+        Called when the event is received. The cursor doesn't move past it until it is handled or dropped
+        """
+        if self.checkpoint is not None:
+            self.checkpoint.begin(event.created_at)
+
+    def end_event(self, event: Event):
+        """
+        Called when the handler is done with the event
+        """
+        if self.checkpoint is not None:
+            self.checkpoint.end(event.created_at)
+
+    def drop_event(self, event: Event):
+        """
+        Called when the event is dropped before it is handled
+        """
+        self.end_event(event)
+
+    def seen_key(self, event: Event):
+        """
+        The key of the event in the seen ids
+        """
+        return event.id
+
+    async def unique_events(self, events):
+        """
+        Yield the events from `events` that haven't been seen recently.
+        They are only remembered once they have been verified, in process_events
+        """
+        received = EVENT_COUNT.labels(bot=self.get_origin(), stage='received')
+        duplicate = EVENT_COUNT.labels(bot=self.get_origin(), stage='duplicate')
+        seen_ids = self.seen_ids
+        async for event in events:
+            if event is LOADED:
+                yield event
                 continue
+            received.inc()
+            self.begin_event(event)
+            if seen_ids is not None and seen_ids.has(self.seen_key(event)):
+                duplicate.inc()
+                self.drop_event(event)
+            else:
+                yield event
+
+    async def admitted_events(self, events):
+        """
+        Yield the events from `events` that pass the admission control,
+        shedding floods and unwanted events before they are verified
+        """
+        admission = self.admission = self.get_admission()
+        if not admission.enabled:
+            async for event in events:
+                yield event
+            return
+        async for event in events:
+            if event is LOADED or admission.admit(event):
+                yield event
+            else:
+                self.drop_event(event)
+
+    def invalid_event(self, event: Event):
+        self.log.warning('Invalid event: %s', event.id)
+        EVENT_COUNT.labels(bot=self.get_origin(), stage='invalid').inc()
+        self.drop_event(event)
+
+    def is_verified(self, event: Event):
+        """
+        Returns True if the event's id and signature are valid.
+        Valid events are remembered, so their signatures are only checked once
+        """
+        try:
+            # the id is the cache key, so it must match the event
+            if not has_valid_id(event):
+                return False
+            if self.verified_ids.get(event.id) == event.sig:
+                return True
+            valid = event.verify()
+        except Exception as e:
+            self.log.error(str(e))
+            return False
+        if valid:
+            self.verified_ids[event.id] = event.sig
+        return valid
+
+    async def verified_events(self, events):
+        """
+        Yield the events from `events` that have valid signatures
+        """
+        latency = STAGE_LATENCY.labels(bot=self.get_origin(), stage='verify')
+        if not self.VERIFY_WORKERS:
+            async for event in events:
+                if event is LOADED:
+                    yield event
+                    continue
+                start = time.perf_counter()
+                valid = self.is_verified(event)
+                latency.observe(time.perf_counter() - start)
+                if valid:
+                    yield event
+                else:
+                    self.invalid_event(event)
+            return
+
+        verifier = self.get_verifier()
+        # bounds the number of events waiting for verification
+        pending = asyncio.Queue(maxsize=self.VERIFY_BATCH_SIZE * (self.VERIFY_WORKERS + 1))
+
+        async def submit():
             try:
-                await self.handle_event(event)
-            except Exception:
-                self.log.exception('handle_event')
+                async for event in events:
+                    if event is LOADED:
+                        future = None
+                    elif self.verified_ids.get(event.id) == event.sig and has_valid_id(event):
+                        future = asyncio.get_running_loop().create_future()
+                        future.set_result(True)
+                    else:
+                        future = verifier.verify(event)
+                    await pending.put((event, future, time.perf_counter()))
+            except Exception as e:
+                await pending.put(e)
+            else:
+                await pending.put(None)
+
+        reader = asyncio.create_task(submit())
+        try:
+            while True:
+                item = await pending.get()
+                if item is None:
+                    break
+                elif isinstance(item, Exception):
+                    raise item
+                event, future, start = item
+                if event is LOADED:
+                    yield event
+                    continue
+                try:
+                    valid = await future
+                except Exception as e:
+                    self.log.error(str(e))
+                    self.invalid_event(event)
+                    continue
+                latency.observe(time.perf_counter() - start)
+                if valid:
+                    self.verified_ids[event.id] = event.sig
+                    yield event
+                else:
+                    self.invalid_event(event)
+        finally:
+            reader.cancel()
+            await verifier.close()
 
     async def handle_event(self, event: Event):
         """
@@ -101,24 +644,69 @@ class CommunicatorBot(NostrBot):
     A bot that can make DM's and reply
     """
     PUBLIC_KEY = ''
-    
+    # number of counterparties to keep NIP-04 shared secrets for
+    SHARED_SECRET_CACHE_SIZE = 1024
+    # run encryption and decryption in this many threads. 0 runs them inline
+    CRYPTO_THREADS = 0
+    # queue replies in an outbox instead of waiting for each relay to respond
+    OUTBOX = True
+    PUBLISH_RETRIES = 2
+    # seconds to wait for a relay to respond to a published event
+    PUBLISH_TIMEOUT = 10
+    # publish to this many of the healthiest relays first. 0 publishes to all of them at once
+    PUBLISH_FANOUT = 0
+    # seconds to wait for the first relays to accept an event before publishing it to the rest
+    PUBLISH_HEDGE_DELAY = 0.5
+
     def __init__(self):
         super().__init__()
+        self._shared_secrets = None
+        self._crypto_executor = None
+        self._outbox = None
         if not self.PUBLIC_KEY:
             self.PUBLIC_KEY = self.private_key.public_key.hex()
         elif self.PUBLIC_KEY.startswith('npub'):
             from aionostr.util import from_nip19
             self.PUBLIC_KEY = from_nip19(self.PUBLIC_KEY)['object'].hex()
 
+    @property
+    def shared_secrets(self):
+        private_key = self.private_key
+        if self._shared_secrets is None or self._shared_secrets.private_key is not private_key:
+            self._shared_secrets = SharedSecrets(private_key, maxsize=self.SHARED_SECRET_CACHE_SIZE)
+        return self._shared_secrets
+
+    def encrypt_message(self, message: str, public_key_hex: str):
+        return self.shared_secrets.encrypt(message, public_key_hex)
+
+    def decrypt_message(self, content: str, public_key_hex: str):
+        return self.shared_secrets.decrypt(content, public_key_hex)
+
+    async def run_crypto(self, func, *args):
+        """
+        Call `func(*args)` in the crypto thread pool, or inline if CRYPTO_THREADS is 0
+        """
+        if not self.CRYPTO_THREADS:
+            return func(*args)
+        if self._crypto_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._crypto_executor = ThreadPoolExecutor(self.CRYPTO_THREADS, thread_name_prefix='crypto')
+        return await asyncio.get_running_loop().run_in_executor(self._crypto_executor, func, *args)
+
+    async def encrypt(self, message: str, public_key_hex: str):
+        return await self.run_crypto(self.encrypt_message, message, public_key_hex)
+
+    async def decrypt(self, content: str, public_key_hex: str):
+        with STAGE_LATENCY.labels(bot=self.get_origin(), stage='decrypt').time():
+            return await self.run_crypto(self.decrypt_message, content, public_key_hex)
+
     def make_event(self, encrypt_to=None, **event_args):
         if encrypt_to:
-            event_args['content'] = self.private_key.encrypt_message(event_args['content'], encrypt_to)
+            event_args['content'] = self.encrypt_message(event_args['content'], encrypt_to)
         if not event_args.get('pubkey'):
             event_args['pubkey'] = self.PUBLIC_KEY
         event = Event(**event_args)
-
-        event.sign(self.private_key.hex())
-        return event
+        return self.sign_event(event)
 
     def make_dm(self, encrypt_to, **event_args):
         tags = event_args.get('tags', [])
@@ -128,9 +716,46 @@ class CommunicatorBot(NostrBot):
         event = self.make_event(encrypt_to=encrypt_to, **event_args)
         return event
 
-    async def reply(self, event):
+    @property
+    def outbox(self):
+        if self._outbox is None:
+            self._outbox = Outbox(
+                self.manager,
+                retries=self.PUBLISH_RETRIES,
+                timeout=self.PUBLISH_TIMEOUT,
+                fanout=self.PUBLISH_FANOUT,
+                hedge_delay=self.PUBLISH_HEDGE_DELAY,
+                log=self.log,
+            )
+        return self._outbox
+
+    async def reply(self, event, wait=False):
+        """
+        Publish the event. With OUTBOX, this returns once the event is queued,
+        with a PublishResult that can be awaited for the relays' responses.
+        Set `wait` to wait for them here
+        """
         self.log.debug("Replying with %s", event)
-        await self.manager.add_event(event, check_response=True)
+        latency = STAGE_LATENCY.labels(bot=self.get_origin(), stage='reply')
+        start = time.perf_counter()
+        if not self.OUTBOX:
+            response = await self.manager.add_event(event, check_response=True)
+            latency.observe(time.perf_counter() - start)
+            return response
+        result = await self.outbox.publish(event)
+        result.future.add_done_callback(lambda f: latency.observe(time.perf_counter() - start))
+        if wait:
+            await result
+        return result
+
+    async def close(self):
+        if self._outbox is not None:
+            await self._outbox.close(self.DRAIN_TIMEOUT)
+            self._outbox = None
+        if self._crypto_executor is not None:
+            self._crypto_executor.shutdown(wait=False)
+            self._crypto_executor = None
+        await super().close()
 
 
 class RPCBot(CommunicatorBot):
@@ -142,36 +767,57 @@ class RPCBot(CommunicatorBot):
     }
 
     By default, these are kind 22222 -- ephemeral events
+
+    Methods named `on_<method>`, or decorated with `rpc_method`, are called as
+    `method(event, *args)`. They're collected once per class, and the arguments
+    are checked against their signatures before they're called
     """
     LISTEN_KIND = 22222
     ENCRYPTED = True
+    # JSON library for commands: 'msgspec', 'orjson' or 'json'. By default, the fastest installed
+    CODEC = None
+    # name -> RPCMethod. Subclasses collect theirs in __init_subclass__
+    rpc_methods = {}
 
     def __init__(self):
         super().__init__()
         self.LISTEN_PUBKEY = self.PUBLIC_KEY
+        self.codec = get_codec(self.CODEC)
+        self.rpc_handlers = {name: method.bind(self) for name, method in self.rpc_methods.items()}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.rpc_methods = find_rpc_methods(cls)
+
+    @property
+    def rpc_stats(self):
+        return {name: handler.stats for name, handler in self.rpc_handlers.items()}
 
     async def handle_event(self, event: Event):
         content = event.content
         if self.ENCRYPTED:
             try:
-                content = self.private_key.decrypt_message(content, event.pubkey)
+                content = await self.decrypt(content, event.pubkey)
             except Exception:
                 self.log.exception("decrypt")
                 return
         try:
-            command = loads(content)
-        except Exception:
-            self.log.exception("json")
+            method, args = self.codec.decode_command(content)
+        except CommandError as e:
+            self.log.warning("Bad command from %s: %s", event.pubkey, e)
             return
-        try:
-            func = getattr(self, f"on_{command['method']}")
-        except (KeyError, AttributeError, TypeError):
-            self.log.error("%s", command)
+        handler = self.rpc_handlers.get(method)
+        if handler is None:
+            self.log.error("Unknown method %s from %s", method, event.pubkey)
+            return
+        error = handler.check_args(args)
+        if error:
+            handler.invalid.inc()
+            self.log.warning("Bad call from %s: %s", event.pubkey, error)
             return
         try:
-            args = command['args']
-            response = await func(event, *args)
-            self.log.debug("Command %s from %s", command, event)
+            response = await handler(event, *args)
+            self.log.debug("Command %s%s from %s", method, args, event)
         except Exception as e:
             self.log.exception(str(e))
         else:
@@ -179,21 +825,34 @@ class RPCBot(CommunicatorBot):
                 await self.reply(response['event'])
 
     def make_response(self, event, **kwargs):
-        if self.ENCRYPTED:
-            kwargs['encrypt_to'] = event.pubkey
+        """
+        A response to the event, made by `make_event(**kwargs)`.
+        The kwargs are kept, so the response can be remade for another caller
+        """
         response = {
-            'event': self.make_event(**kwargs)
+            'kwargs': kwargs,
         }
+        if self.ENCRYPTED:
+            kwargs = dict(kwargs, encrypt_to=event.pubkey)
+        response['event'] = self.make_event(**kwargs)
         return response
 
+    def remake_response(self, event, response):
+        """
+        Make a cached response again for the caller of `event`
+        """
+        if not response or 'kwargs' not in response:
+            return response
+        return self.make_response(event, **response['kwargs'])
+
 
 class RegistrationBot(CommunicatorBot):
     LISTEN_KIND = 11141
     LIMIT = 100
 
     async def handle_event(self, event: Event):
-        if not event.verify():
-            self.log("Bad event: %s", event.id)
+        if not self.is_verified(event):
+            self.log.warning("Bad event: %s", event.id)
             return
         self.log.info("Got registration request %s", event)
 
@@ -214,22 +873,58 @@ class RegistrationBot(CommunicatorBot):
         return False
 
 
-async def start_multiple(bots, relays=None):
+def load_bots(classnames, **options):
     """
-    Start multiple bots in their own task
+    Create bots from their dotted class names, setting `options` as attributes on each
     """
-    import asyncio
+    import importlib
+
+    bots = []
+    for classname in classnames:
+        bot_module, bot_class = classname.rsplit('.', 1)
+        bot = getattr(importlib.import_module(bot_module), bot_class)()
+        for key, value in options.items():
+            setattr(bot, key, value)
+        bots.append(bot)
+    return bots
+
 
+async def start_multiple(bots, relays=None, merge=False, prioritize=False):
+    """
+    Start multiple bots in their own task
+
+    With `merge`, the bots share a single subscription. Each event is verified once
+    and routed to the bots with a matching query.
+
+    With `prioritize`, the bots' events are handled by a shared PriorityScheduler, so interactive
+    events aren't stuck behind a busy bulk bot. Events may then be handled out of order, even
+    with CONCURRENCY = 1
+    """
     if relays:
-        first_manager = None
+        # the bots' managers share connections through the relay pool
         for bot in bots:
             bot.RELAYS = relays
-            if not first_manager:
-                first_manager = bot.manager
-            bot.manager = first_manager
+
+    scheduler = None
+    if prioritize:
+        from .scheduler import PriorityScheduler
+        scheduler = PriorityScheduler(concurrency=sum(max(bot.CONCURRENCY, 1) for bot in bots))
+        for bot in bots:
+            bot.scheduler = scheduler
+
+    if merge:
+        from .router import BotRouter
+        bots = [BotRouter(bots)]
 
     tasks = [asyncio.create_task(bot.start()) for bot in bots]
     try:
         await asyncio.wait(tasks)
     except asyncio.exceptions.CancelledError:
+        # let each bot drain its queued events before returning
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
         return
+    finally:
+        if scheduler is not None:
+            await scheduler.close()
@@ -0,0 +1,186 @@
+"""
+In-memory caches
+"""
+import hashlib
+import math
+import os
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A size-bounded mapping that evicts the least recently used keys,
+    and optionally expires keys `ttl` seconds after they were set
+    """
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value, expires = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires and expires < time.monotonic():
+            del self.data[key]
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        self.data[key] = (value, time.monotonic() + ttl if ttl else None)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        value, expires = self.data.pop(key, (default, None))
+        return value
+
+    def clear(self):
+        self.data.clear()
+
+    def __getitem__(self, key):
+        sentinel = object()
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __contains__(self, key):
+        try:
+            value, expires = self.data[key]
+        except KeyError:
+            return False
+        return not expires or expires >= time.monotonic()
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def stats(self):
+        return {
+            'size': len(self.data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class BloomFilter:
+    """
+    A fixed-size set of strings that may report false positives, at about `error_rate`
+    once `capacity` items have been added
+    """
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        self.capacity = capacity
+        self.num_bits = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.num_hashes = max(int(round(self.num_bits / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+        # keyed hashing, so ids can't be crafted to collide
+        self.salt = os.urandom(16)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=16, key=self.salt).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def __len__(self):
+        return self.count
+
+
+class SeenCache:
+    """
+    Remembers recently seen ids.
+
+    By default, ids are kept in an LRU cache of `maxsize` ids, and forgotten after `ttl` seconds if set.
+    With `bloom_capacity`, ids are kept in two rotating Bloom filters instead,
+    remembering between `bloom_capacity` and twice that many ids (or `ttl` seconds) in a fixed amount of memory.
+    """
+    def __init__(self, maxsize=10000, ttl=None, bloom_capacity=0, error_rate=0.001):
+        self.ttl = ttl
+        self.bloom_capacity = bloom_capacity
+        self.error_rate = error_rate
+        if bloom_capacity:
+            self.current = BloomFilter(bloom_capacity, error_rate)
+            self.previous = None
+            self.rotated = time.monotonic()
+            self.ids = None
+        else:
+            self.ids = LRUCache(maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    def _rotate(self):
+        if len(self.current) >= self.bloom_capacity or (self.ttl and time.monotonic() - self.rotated > self.ttl):
+            self.previous = self.current
+            self.current = BloomFilter(self.bloom_capacity, self.error_rate)
+            self.rotated = time.monotonic()
+
+    def _contains(self, key):
+        if self.ids is not None:
+            return key in self.ids
+        return key in self.current or (self.previous is not None and key in self.previous)
+
+    def has(self, key):
+        """
+        Returns True if the id was already seen, without remembering it
+        """
+        found = self._contains(key)
+        if found:
+            self.hits += 1
+        return found
+
+    def seen(self, key):
+        """
+        Returns True if the id was already seen, otherwise remembers it
+        """
+        found = self._contains(key)
+        if not found:
+            if self.ids is not None:
+                self.ids[key] = True
+            else:
+                self._rotate()
+                self.current.add(key)
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return found
+
+    def discard(self, key):
+        """
+        Forget the id. Ids in Bloom filters can't be removed
+        """
+        if self.ids is not None:
+            self.ids.pop(key)
+
+    @property
+    def stats(self):
+        return {
+            'size': len(self.ids) if self.ids is not None else len(self.current) + len(self.previous or ()),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -13,12 +13,8 @@ except ImportError:
 
 DEFAULT_RELAYS = os.getenv('NOSTR_RELAYS', 'wss://nostr.mom,wss://relay.snort.social').split(',')
 
-def stop():
-    loop = asyncio.get_running_loop()
-    try:
-        loop.stop()
-    except RuntimeError:
-        return
+def stop(task):
+    task.cancel()
 
 
 def async_cmd(func):
@@ -28,14 +24,15 @@ def async_cmd(func):
             from signal import SIGINT, SIGTERM
 
             loop = asyncio.get_running_loop()
+            task = asyncio.current_task()
             for signal_enum in [SIGINT, SIGTERM]:
-                loop.add_signal_handler(signal_enum, stop)
+                loop.add_signal_handler(signal_enum, stop, task)
 
             await coro
         coro = func(*args, **kwargs)
         try:
             asyncio.run(_run(coro))
-        except RuntimeError:
+        except (RuntimeError, asyncio.CancelledError):
             return
   return wrapper
 
@@ -50,28 +47,206 @@ def main(args=None):
 @click.option('-c', '--cls', multiple=True, help='bot class(es) to run', default=['nostr_bot.NostrBot'])
 @click.option('-r', 'relays', multiple=True, help='Relay address (can be added multiple times)', default=DEFAULT_RELAYS)
 @click.option('-v', '--verbose', help='verbose results', is_flag=True, default=False)
+@click.option('--concurrency', type=int, help='Number of events each bot handles at the same time', default=None)
+@click.option('--verify-workers', type=int, help='Number of processes for verifying signatures', default=None)
+@click.option('--merge', help='Share one subscription between all bots', is_flag=True, default=False)
+@click.option('--prioritize', help='Share one priority scheduler between all bots, handling interactive events first',
+              is_flag=True, default=False)
+@click.option('--backfill', help='Load stored history in parallel before listening', is_flag=True, default=False)
+@click.option('--workers', type=int, help='Number of worker processes to shard events across', default=1)
+@click.option('--metrics-port', type=int, help='Serve Prometheus metrics on this port', default=None)
+@click.option('--record', 'record_path', help='Append received events to this JSONL file, for replay', default=None)
+@click.option('--profile', help='Sample stacks and trace memory from the start. SIGUSR1 writes the results',
+              is_flag=True, default=False)
+@click.option('--profile-dir', help='Directory for the profiling results', default='.')
+@click.option('--lag-threshold', type=float, help='Log the stack when the event loop is blocked this many seconds',
+              default=0.1)
 @async_cmd
-async def run(relays, cls, verbose):
+async def run(relays, cls, verbose, concurrency, verify_workers, merge, prioritize, backfill, workers, metrics_port,
+              record_path, profile, profile_dir, lag_threshold):
     """
     Run a bot
+
+    Send SIGUSR1 to start profiling a running bot, and again to write the results.
+    With --workers, each process is profiled separately: signal the worker's pid to profile it
     """
     import logging
-    import importlib
-    from .bot import start_multiple
-    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s – %(message)s', level=logging.DEBUG if verbose else logging.INFO)
+    from .bot import start_multiple, load_bots
+    level = logging.DEBUG if verbose else logging.INFO
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s – %(message)s', level=level)
+
+    options = {}
+    if concurrency:
+        options['CONCURRENCY'] = concurrency
+    if verify_workers is not None:
+        options['VERIFY_WORKERS'] = verify_workers
+    if backfill:
+        options['BACKFILL'] = True
+    if record_path:
+        options['RECORD_FILE'] = record_path
+
+    if metrics_port:
+        from .metrics import start_server
+        await start_server(metrics_port)
+
+    from .diagnostics import Profiler
+    profiler = Profiler(profile_dir, lag_threshold=lag_threshold)
+    profiler.install_signal()
+    profiler.start(profile=profile)
+    try:
+        if workers > 1:
+            from .workers import run_workers
+            await run_workers(
+                cls, workers=workers, relays=relays, log_level=level, metrics_port=metrics_port,
+                profiler={'directory': profile_dir, 'lag_threshold': lag_threshold}, profile=profile, **options
+            )
+            return
 
-    bots = []
-    for classname in cls:
         try:
-            bot_module, bot_class = classname.rsplit('.', 1)
-            bot_class = getattr(importlib.import_module(bot_module), bot_class)
-        except (ImportError, AttributeError):
-            click.echo(f"Class {classname} not found")
+            bots = load_bots(cls, **options)
+        except (ImportError, AttributeError, ValueError) as e:
+            click.echo(f"Class not found: {e}")
             return -1
-        bots.append(bot_class())
-    await start_multiple(bots, relays=relays)
+        if record_path and len(bots) > 1 and not merge:
+            # each bot has its own subscription, so give each its own file
+            root, ext = os.path.splitext(record_path)
+            for bot in bots:
+                bot.RECORD_FILE = f'{root}-{bot.get_origin()}{ext}'
+
+        await start_multiple(bots, relays=relays, merge=merge, prioritize=prioritize)
+    finally:
+        await profiler.close()
+
+
+
+@main.command()
+@click.option('-c', '--cls', multiple=True, help='bot class(es) to run', default=['nostr_bot.NostrBot'])
+@click.argument('path', default='-')
+@click.option('--speed', type=float, help='Replay at this multiple of the recorded pace. 0 is as fast as possible',
+              default=0)
+@click.option('--replies', 'reply_path', help='Write published events to this JSONL file', default=None)
+@click.option('--state', 'state_path', help='sqlite file for bot state. Defaults to a temporary database',
+              default=':memory:')
+@click.option('--concurrency', type=int, help='Number of events each bot handles at the same time', default=None)
+@click.option('--verify-workers', type=int, help='Number of processes for verifying signatures', default=None)
+@click.option('-v', '--verbose', help='verbose results', is_flag=True, default=False)
+@async_cmd
+async def replay(cls, path, speed, reply_path, state_path, concurrency, verify_workers, verbose):
+    """
+    Replay events from a JSONL file (or stdin) into bots, without connecting to relays
+    """
+    import logging
+    from .bot import load_bots
+    from .replay import replay as replay_events
+    from .router import BotRouter
+    logging.basicConfig(
+        format='%(asctime)s %(name)s %(levelname)s – %(message)s',
+        level=logging.DEBUG if verbose else logging.INFO,
+    )
+    options = {'STATE_FILE': state_path}
+    if concurrency:
+        options['CONCURRENCY'] = concurrency
+    if verify_workers is not None:
+        options['VERIFY_WORKERS'] = verify_workers
+    try:
+        bots = load_bots(cls, **options)
+    except (ImportError, AttributeError, ValueError) as e:
+        click.echo(f"Class not found: {e}")
+        return -1
+    bot = bots[0] if len(bots) == 1 else BotRouter(bots)
+    results = await replay_events(bot, path, speed=speed, reply_path=reply_path)
+    for key, value in results.items():
+        if isinstance(value, float):
+            value = f'{value:.2f}'
+        click.echo(f'{key:>20}: {value}', err=reply_path == '-')
+
+
+@main.command()
+@click.option('-c', '--cls', help='bot class to benchmark', default='nostr_bot.examples.ping.PingBot')
+@click.option('-n', '--events', 'count', type=int, help='Number of events to send', default=10000)
+@click.option('--rate', type=float, help='Events per second to send. 0 sends them as fast as possible', default=0)
+@click.option('--authors', type=int, help='Number of authors to generate events from', default=100)
+@click.option('--kind', 'kinds', type=int, multiple=True, help='Event kind (can be added multiple times)')
+@click.option('--rpc', 'rpc_method', help='Send RPC commands calling this method', default=None)
+@click.option('--relays', type=int, help='Number of local relays', default=1)
+@click.option('--duplicates', type=float, help='Fraction of events also sent by a second relay', default=0.0)
+@click.option('--stored', help='Store the events on the relays instead of sending them live', is_flag=True, default=False)
+@click.option('--concurrency', type=int, help='Number of events the bot handles at the same time', default=None)
+@click.option('--verify-workers', type=int, help='Number of processes for verifying signatures', default=None)
+@click.option('--trace-memory', help='Measure peak Python memory with tracemalloc (slower)', is_flag=True, default=False)
+@click.option('-v', '--verbose', help='show the bot\'s logs', is_flag=True, default=False)
+@async_cmd
+async def benchmark(cls, count, rate, authors, kinds, rpc_method, relays, duplicates, stored,
+                    concurrency, verify_workers, trace_memory, verbose):
+    """
+    Measure a bot against local relays
+    """
+    import logging
+    from .benchmark import run_benchmark
+    logging.basicConfig(
+        format='%(asctime)s %(name)s %(levelname)s – %(message)s',
+        level=logging.INFO if verbose else logging.WARNING,
+    )
+    options = {}
+    if concurrency:
+        options['CONCURRENCY'] = concurrency
+    if verify_workers is not None:
+        options['VERIFY_WORKERS'] = verify_workers
+    results = await run_benchmark(
+        cls,
+        count=count,
+        rate=rate,
+        authors=authors,
+        kinds=kinds or None,
+        rpc_method=rpc_method,
+        relays=relays,
+        duplicate_ratio=duplicates,
+        stored=stored,
+        trace_memory=trace_memory,
+        **options
+    )
+    for key, value in results.items():
+        if isinstance(value, float):
+            value = f'{value:.2f}'
+        click.echo(f'{key:>20}: {value}')
 
 
+@main.command()
+@click.option('-r', 'relays', multiple=True, help='Relay address (can be added multiple times)', default=DEFAULT_RELAYS)
+@click.option('-n', '--probes', type=int, help='Number of queries to time on each relay', default=3)
+@click.option('--timeout', type=float, help='Seconds to wait for each query', default=10.0)
+@async_cmd
+async def relays(relays, probes, timeout):
+    """
+    Measure and score relays
+    """
+    from .health import relay_health
+    from .pool import relay_pool
+    managers = [relay_pool.get_manager([url]) for url in relays]
+    await asyncio.gather(*[manager.connect() for manager in managers], return_exceptions=True)
+
+    async def query(manager):
+        # the end of stored events is timed in the relay's health
+        async for event in manager.get_events({'kinds': [1], 'limit': 1}):
+            pass
+
+    async def probe(manager):
+        for i in range(probes):
+            try:
+                await asyncio.wait_for(query(manager), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    try:
+        await asyncio.gather(*[probe(manager) for manager in managers if manager.relays])
+    finally:
+        await asyncio.gather(*[manager.close() for manager in managers], return_exceptions=True)
+    for url, health in relay_health.scores(relays).items():
+        click.echo(url)
+        for key, value in health.items():
+            if isinstance(value, float):
+                value = f'{value:.2f}'
+            click.echo(f'{key:>20}: {value}')
 
 
 if __name__ == "__main__":
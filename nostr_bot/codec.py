@@ -0,0 +1,136 @@
+"""
+JSON encoding and decoding, using the fastest library available
+"""
+import json
+import os
+
+
+class CommandError(ValueError):
+    """
+    Raised for RPC content that isn't a valid {"method": ..., "args": [...]} command
+    """
+
+
+def check_command(command):
+    """
+    Returns (method, args) from a decoded command, or raises CommandError
+    """
+    if not isinstance(command, dict):
+        raise CommandError('command is not an object')
+    method = command.get('method')
+    args = command.get('args')
+    if not isinstance(method, str) or not method:
+        raise CommandError('method must be a non-empty string')
+    if not isinstance(args, list):
+        raise CommandError('args must be a list')
+    return method, args
+
+
+class JSONCodec:
+    """
+    The standard library json module
+    """
+    name = 'json'
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj) -> str:
+        return json.dumps(obj)
+
+    def decode_command(self, data):
+        """
+        Returns (method, args) from RPC content, or raises CommandError
+        """
+        try:
+            command = self.loads(data)
+        except ValueError as e:
+            raise CommandError(f'invalid JSON: {e}') from None
+        return check_command(command)
+
+    def encode_command(self, method: str, args=()) -> str:
+        return self.dumps({'method': method, 'args': list(args)})
+
+
+class OrjsonCodec(JSONCodec):
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+
+    def loads(self, data):
+        return self.orjson.loads(data)
+
+    def dumps(self, obj) -> str:
+        return self.orjson.dumps(obj).decode()
+
+
+class MsgspecCodec(JSONCodec):
+    """
+    msgspec, which decodes RPC commands straight into a typed struct,
+    validating them without building a dict first
+    """
+    name = 'msgspec'
+
+    def __init__(self):
+        import msgspec
+
+        class Command(msgspec.Struct):
+            method: str
+            args: list
+
+        self.msgspec = msgspec
+        self.decoder = msgspec.json.Decoder()
+        self.command_decoder = msgspec.json.Decoder(Command)
+        self.encoder = msgspec.json.Encoder()
+
+    def loads(self, data):
+        try:
+            return self.decoder.decode(data)
+        except self.msgspec.DecodeError as e:
+            # the other codecs raise ValueError
+            raise ValueError(str(e)) from None
+
+    def dumps(self, obj) -> str:
+        return self.encoder.encode(obj).decode()
+
+    def decode_command(self, data):
+        try:
+            command = self.command_decoder.decode(data)
+        except (self.msgspec.DecodeError, self.msgspec.ValidationError) as e:
+            raise CommandError(str(e)) from None
+        if not command.method:
+            raise CommandError('method must be a non-empty string')
+        return command.method, command.args
+
+
+CODECS = {
+    'msgspec': MsgspecCodec,
+    'orjson': OrjsonCodec,
+    'json': JSONCodec,
+}
+
+
+def get_codec(name=None):
+    """
+    The codec called `name`, or the first one that can be imported,
+    in the order of CODECS. Set NOSTR_BOT_CODEC to choose one
+    """
+    name = name or os.getenv('NOSTR_BOT_CODEC')
+    if name:
+        if name not in CODECS:
+            raise ValueError(f"Unknown codec {name!r}. Choose one of: {', '.join(CODECS)}")
+        return CODECS[name]()
+    for cls in CODECS.values():
+        try:
+            return cls()
+        except ImportError:
+            continue
+
+
+codec = get_codec()
+loads = codec.loads
+dumps = codec.dumps
+decode_command = codec.decode_command
+encode_command = codec.encode_command
@@ -0,0 +1,256 @@
+"""
+Finding what slows down a running bot: event loop lag, stack samples and memory snapshots
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+from .metrics import LOOP_LAG
+
+log = logging.getLogger(__name__)
+
+
+class LagMonitor:
+    """
+    Measures how late the event loop wakes up from a sleep of `interval` seconds.
+
+    A watchdog thread logs the stack of the event loop's thread when the loop has been
+    blocked for more than `threshold` seconds, once per stall. The stack is taken while
+    the loop is still blocked, so it shows the synchronous code that is blocking it
+    """
+    def __init__(self, interval=0.05, threshold=0.1, log=log):
+        self.interval = interval
+        self.threshold = threshold
+        self.log = log
+        self.lag = LOOP_LAG.labels()
+        self.heartbeat = time.monotonic()
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.task = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    @property
+    def running(self):
+        return self.task is not None
+
+    def start(self):
+        self.loop_thread = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.stopped.clear()
+        self.task = asyncio.create_task(self._measure())
+        self.thread = threading.Thread(target=self._watch, name='lag-watchdog', daemon=True)
+        self.thread.start()
+
+    async def _measure(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.heartbeat = now
+            lag = max(0.0, now - start - self.interval)
+            self.lag.observe(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+            if lag > self.threshold:
+                self.log.warning("Event loop was blocked for %.3fs", lag)
+
+    def _watch(self):
+        reported = None
+        while not self.stopped.wait(self.threshold / 2):
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked > self.threshold and heartbeat != reported:
+                reported = heartbeat
+                self.stalls += 1
+                frame = sys._current_frames().get(self.loop_thread)
+                if frame is not None:
+                    stack = ''.join(traceback.format_stack(frame))
+                    self.log.warning("Event loop blocked for %.3fs so far, in:\n%s", blocked, stack)
+
+    async def stop(self):
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    @property
+    def stats(self):
+        lag = self.lag.get()
+        return {
+            'mean_lag_ms': lag['sum'] / lag['count'] * 1000 if lag['count'] else 0.0,
+            'max_lag_ms': self.max_lag * 1000,
+            'stalls': self.stalls,
+        }
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class StackSampler:
+    """
+    Samples the stack of a thread (by default, the one calling `start()`) every `interval`
+    seconds, from a background thread.
+
+    `dump(path)` writes the samples as collapsed stacks (`outer;inner count` lines),
+    which flamegraph.pl and speedscope can read
+    """
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = Counter()
+        self.samples = 0
+        self.thread = None
+        self.stopped = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self, thread_id=None):
+        self.thread_id = thread_id or threading.get_ident()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+                self.samples += 1
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def top(self, count=10):
+        """
+        The functions most often at the top of the stack, as [(name, samples)]
+        """
+        leaves = Counter()
+        for stack, samples in self.counts.items():
+            leaves[stack.rsplit(';', 1)[-1]] += samples
+        return leaves.most_common(count)
+
+    def dump(self, path):
+        """
+        Write the samples to `path` and start over. Returns the number of samples written
+        """
+        counts, samples = self.counts, self.samples
+        self.counts, self.samples = Counter(), 0
+        with open(path, 'w', encoding='utf8') as fileobj:
+            for stack, count in counts.most_common():
+                fileobj.write(f'{stack} {count}\n')
+        return samples
+
+
+def dump_memory(path, top=25):
+    """
+    Write the `top` source lines holding the most memory allocated since tracemalloc
+    started tracing. Returns False if it isn't tracing
+    """
+    import tracemalloc
+    if not tracemalloc.is_tracing():
+        return False
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ])
+    stats = snapshot.statistics('lineno')
+    current, peak = tracemalloc.get_traced_memory()
+    with open(path, 'w', encoding='utf8') as fileobj:
+        fileobj.write(f'traced: {current / 1024 / 1024:.1f} MiB, peak: {peak / 1024 / 1024:.1f} MiB\n')
+        for stat in stats[:top]:
+            fileobj.write(f'{stat}\n')
+    return True
+
+
+class Profiler:
+    """
+    Diagnostics for a live process: a LagMonitor, and on demand, a StackSampler and tracemalloc.
+
+    `toggle()` starts profiling, and the next `toggle()` writes the stack samples and the
+    top memory allocations to `directory` and stops. `install_signal()` toggles on SIGUSR1,
+    so a running bot can be profiled with `kill -USR1 <pid>`
+    """
+    def __init__(self, directory='.', lag_threshold=0.1, sample_interval=0.005, memory_top=25, memory_frames=1,
+                 log=log):
+        self.directory = directory
+        self.memory_top = memory_top
+        self.memory_frames = memory_frames
+        self.log = log
+        self.monitor = LagMonitor(threshold=lag_threshold, log=log)
+        self.sampler = StackSampler(interval=sample_interval)
+        self.started_tracing = False
+
+    def start(self, profile=False):
+        if not self.monitor.running:
+            self.monitor.start()
+        if profile:
+            self.start_profiling()
+
+    def start_profiling(self):
+        import tracemalloc
+        if not self.monitor.running:
+            self.monitor.start()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.memory_frames)
+            self.started_tracing = True
+        self.sampler.start()
+        self.log.info("Profiling started. Send SIGUSR1 to pid %d to write the results", os.getpid())
+
+    def stop_profiling(self):
+        import tracemalloc
+        self.sampler.stop()
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def dump(self):
+        """
+        Write the stack samples and the memory snapshot. Returns the paths written
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        prefix = os.path.join(self.directory, f'nostr-bot-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}')
+        paths = []
+        top = self.sampler.top()
+        samples = self.sampler.dump(f'{prefix}-stacks.txt')
+        paths.append(f'{prefix}-stacks.txt')
+        if dump_memory(f'{prefix}-memory.txt', self.memory_top):
+            paths.append(f'{prefix}-memory.txt')
+        self.log.info("Wrote %d stack samples to %s. Loop lag: %s", samples, ', '.join(paths), self.monitor.stats)
+        for name, count in top:
+            self.log.info("%5.1f%% %s", count / samples * 100 if samples else 0, name)
+        return paths
+
+    def toggle(self):
+        if self.sampler.running:
+            self.dump()
+            self.stop_profiling()
+        else:
+            self.start_profiling()
+
+    def install_signal(self):
+        import signal
+        if hasattr(signal, 'SIGUSR1'):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self.toggle)
+
+    async def close(self):
+        if self.sampler.running:
+            self.dump()
+            self.stop_profiling()
+        await self.monitor.stop()
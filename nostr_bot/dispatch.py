@@ -0,0 +1,101 @@
+"""
+Dispatching events to bot handlers
+"""
+import asyncio
+import logging
+import time
+
+from .metrics import EVENT_COUNT, STAGE_LATENCY
+
+
+class EventDispatcher:
+    """
+    Calls `handler(event)` for every event that is put into the dispatcher
+
+    With a concurrency of 1, events are handled inline, in the order they arrive.
+    Otherwise, events go into a bounded queue that is drained by `concurrency` worker tasks.
+    `put()` waits while the queue is full, which pushes back on the subscription.
+
+    If `ordered` is set, every pubkey is pinned to one worker, so events from the
+    same author are still handled in the order they were received.
+
+    Handling time and errors are recorded in the metrics under the bot `name`.
+    If `on_done` is set, it is called with each event once its handler has returned.
+    """
+    def __init__(self, handler, concurrency=1, queue_size=100, ordered=False, name='', log=None):
+        self.handler = handler
+        self.latency = STAGE_LATENCY.labels(bot=name, stage='handle')
+        self.handled = EVENT_COUNT.labels(bot=name, stage='handled')
+        self.errors = EVENT_COUNT.labels(bot=name, stage='error')
+        self.concurrency = max(int(concurrency or 1), 1)
+        self.queue_size = queue_size
+        self.ordered = ordered
+        self.log = log or logging.getLogger(__name__)
+        self.queues = []
+        self.workers = []
+        self.on_done = None
+
+    def start(self):
+        if self.concurrency == 1 or self.workers:
+            return
+        if self.ordered:
+            size = max(self.queue_size // self.concurrency, 1)
+            self.queues = [asyncio.Queue(maxsize=size) for i in range(self.concurrency)]
+        else:
+            self.queues = [asyncio.Queue(maxsize=self.queue_size)]
+        self.workers = [
+            asyncio.create_task(self._work(self.queues[i % len(self.queues)]))
+            for i in range(self.concurrency)
+        ]
+
+    async def put(self, event):
+        if self.concurrency == 1:
+            await self._handle(event)
+            return
+        self.start()
+        if self.ordered:
+            queue = self.queues[hash(event.pubkey) % len(self.queues)]
+        else:
+            queue = self.queues[0]
+        await queue.put(event)
+
+    @property
+    def pending(self):
+        return sum(queue.qsize() for queue in self.queues)
+
+    async def _handle(self, event):
+        start = time.perf_counter()
+        try:
+            await self.handler(event)
+        except Exception:
+            self.errors.inc()
+            self.log.exception('handle_event')
+        else:
+            self.handled.inc()
+        self.latency.observe(time.perf_counter() - start)
+        if self.on_done is not None:
+            self.on_done(event)
+
+    async def _work(self, queue):
+        while True:
+            event = await queue.get()
+            try:
+                await self._handle(event)
+            finally:
+                queue.task_done()
+
+    async def close(self, timeout=None):
+        """
+        Wait up to `timeout` seconds for queued events to be handled, then stop the workers
+        """
+        if not self.workers:
+            return
+        try:
+            await asyncio.wait_for(asyncio.gather(*[queue.join() for queue in self.queues]), timeout)
+        except asyncio.TimeoutError:
+            self.log.warning("Dropping %d unhandled events", self.pending)
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.queues = []
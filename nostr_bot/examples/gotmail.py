@@ -12,13 +12,11 @@ You can set env var VOICE to use a different voice
 from nostr_bot import NostrBot
 import os
 import subprocess
-import json
 
 
 class GotMailBot(NostrBot):
     VOICE = os.getenv("VOICE", "Fred")
     KINDS = [int(k) for k in os.getenv("KINDS", "4").split(',')]
-    seen_pubkeys = {}
 
     def get_query(self):
         my_pubkey = os.getenv('PUBLIC_KEY')
@@ -30,13 +28,7 @@ class GotMailBot(NostrBot):
         }
 
     async def handle_event(self, event):
-        if event.pubkey not in self.seen_pubkeys:
-            self.seen_pubkeys[event.pubkey] = event.pubkey[-4:]
-            async for profile in self.manager.get_events({"authors": [event.pubkey], "kinds": [0]}, single_event=True):
-                meta = json.loads(profile.content)
-                self.seen_pubkeys[event.pubkey] = meta.get('display_name', '') or meta.get('name', '') or event.pubkey[-4:]
-
-        name = self.seen_pubkeys[event.pubkey]
+        name = await self.profiles.get_name(event.pubkey, default=event.pubkey[-4:])
         kind = "mail"
         if event.kind == 7:
             kind = "a reaction"
@@ -2,83 +2,187 @@
 MirrorBot will mirror events from authors you follow. 
 The source relays are set with environment variable NOSTR_RELAYS or with -r on the command line
 
+When you follow or unfollow someone, the subscription is updated without restarting
+
 To run:
 
 TARGET=ws://target-relay.biz PUBLIC_KEY=<YOURPUBKEY> nostr-bot run -c nostr_bot.examples.mirror.MirrorFollowersBot
 """
 import os
 import time
-import shelve
+import asyncio
 from nostr_bot.bot import NostrBot
-from aionostr import Manager
+from nostr_bot.query import QueryPlanner
 
 
 class MirrorFollowersBot(NostrBot):
     MY_PUBKEY = os.getenv('PUBLIC_KEY')
     TARGET_RELAY = os.getenv('TARGET')
-    shelf = shelve.open(f'mirrorbot-{TARGET_RELAY.replace("://", "-")}')
+    # new events are checked against the target relay in batches of this size
+    CHECK_BATCH_SIZE = 100
+    # seconds to wait for a batch to fill up
+    CHECK_BATCH_DELAY = 1.0
+    # seconds to wait for the target relay to say which events of a batch it has
+    CHECK_TIMEOUT = 10.0
+
+    def __init__(self):
+        super().__init__()
+        self.pending = []
+        self.flush_lock = asyncio.Lock()
+        self.flush_task = None
+        self.stats = {'mirrored': 0, 'skipped': 0, 'skipped_bytes': 0}
+        # created_at of the contact list being followed
+        self.contacts_at = 0
+
+    def get_state_file(self):
+        return self.STATE_FILE or f'mirrorbot-{self.TARGET_RELAY.replace("://", "-")}.sqlite'
 
     def get_query(self):
         return self.query
 
-    def get_last_seen(self):
-        return self.shelf.get('last_seen', 1)
+    async def get_last_seen(self):
+        return await self.store.get_cursor(1)
 
-    def set_last_seen(self, timestamp):
-        if timestamp > self.get_last_seen():
-            self.shelf['last_seen'] = timestamp
+    @staticmethod
+    def followed_in(contacts):
+        return [tag[1] for tag in contacts.tags if len(tag) > 1 and tag[0] == 'p']
 
-    async def get_following(self):
+    async def get_contacts(self):
+        """
+        My newest contact list (kind 3) event, or None
+        """
         find_query = {
             'kinds': [3],
             'authors': [self.MY_PUBKEY]
         }
-        following = [self.MY_PUBKEY]
         self.log.info("Getting following for %s %s", self.MY_PUBKEY, find_query)
-        async for event in self.manager.get_events(find_query):
-            for tag in event.tags:
-                if tag[0] == 'p':
-                    following.append(tag[1])
+        newest = None
+        async for event in self.get_events(find_query):
+            if newest is None or event.created_at > newest.created_at:
+                newest = event
+        return newest
+
+    async def get_following(self, contacts):
+        """
+        The authors to mirror, given my contact list
+        """
+        following = [self.MY_PUBKEY]
+        if contacts is not None:
+            following.extend(self.followed_in(contacts))
         return following
 
-    async def start(self):
-        self.target_manager = Manager([self.TARGET_RELAY])
+    async def set_following(self, following):
+        """
+        Update the running subscription with only the authors that changed
+        """
+        before = set(self.query['authors'])
+        added = len(set(following) - before)
+        removed = len(before - set(following))
+        if not (added or removed):
+            return
+        self.log.info("Following %d new authors, unfollowed %d", added, removed)
+        self.query = dict(self.query, authors=list(following))
+        await self.update_query()
+
+    async def setup(self):
+        self.target_manager = self.get_manager([self.TARGET_RELAY])
         await self.target_manager.connect()
-        await self.manager.connect()
+        contacts = await self.get_contacts()
+        if contacts is not None:
+            self.contacts_at = contacts.created_at
         self.query = {
-            'authors': await self.get_following(),
-            'since': self.get_last_seen()
+            'authors': await self.get_following(contacts),
+            'since': await self.get_last_seen()
         }
-        return await super().start()
 
     async def handle_event(self, event):
-        if event.id in self.shelf:
+        # my own events are mirrored, so my new contact lists arrive here too
+        if event.kind == 3 and event.pubkey == self.MY_PUBKEY and event.created_at > self.contacts_at:
+            self.contacts_at = event.created_at
+            await self.set_following(await self.get_following(event))
+        if await self.store.contains(event.id):
             return
-        await self.target_manager.add_event(event)
-        self.log.info("Mirrored %s from %s to %s", event.id[:8], event.pubkey, self.TARGET_RELAY)
-        self.set_last_seen(event.created_at)
-        self.shelf[event.id] = time.time()
+        # the cursor waits for the event until it is mirrored
+        self.store.checkpoint.begin(event.created_at)
+        self.pending.append(event)
+        if len(self.pending) >= self.CHECK_BATCH_SIZE:
+            await self.flush()
+        elif self.flush_task is None:
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.CHECK_BATCH_DELAY)
+        self.flush_task = None
+        try:
+            await self.flush()
+        except Exception:
+            self.log.exception("Failed to mirror the pending events")
+
+    async def find_on_target(self, event_ids):
+        """
+        Returns the ids that the target relay already has
+        """
+        found = set()
+        # closes the subscription if it times out
+        planner = QueryPlanner(self.target_manager, log=self.log)
+        async for event in planner.get_events({'ids': event_ids, 'limit': len(event_ids)}):
+            found.add(event.id)
+        return found
+
+    async def flush(self):
+        """
+        Mirror the pending events that the target relay doesn't have yet
+        """
+        async with self.flush_lock:
+            batch, self.pending = self.pending, []
+            if not batch:
+                return
+            try:
+                found = await asyncio.wait_for(self.find_on_target([event.id for event in batch]), self.CHECK_TIMEOUT)
+            except Exception as e:
+                # the target relay ignores the ones it already has
+                self.log.error("Could not check %d events on %s (%r). Mirroring them all",
+                               len(batch), self.TARGET_RELAY, e)
+                found = set()
+            now = time.time()
+            for i, event in enumerate(batch):
+                try:
+                    if event.id in found:
+                        self.stats['skipped'] += 1
+                        self.stats['skipped_bytes'] += len(str(event))
+                    else:
+                        await self.target_manager.add_event(event)
+                        self.stats['mirrored'] += 1
+                        self.log.info("Mirrored %s from %s to %s", event.id[:8], event.pubkey, self.TARGET_RELAY)
+                except Exception:
+                    # keep the rest for the next flush
+                    self.pending[:0] = batch[i:]
+                    raise
+                await self.store.set(event.id, now)
+                self.store.checkpoint.end(event.created_at)
+            self.log.info("Mirrored %d, skipped %d already on %s (%d bytes)",
+                          len(batch) - len(found), len(found), self.TARGET_RELAY, self.stats['skipped_bytes'])
+
+    async def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        await self.target_manager.close()
+        await super().close()
 
 
 class MirrorFOAFBot(MirrorFollowersBot):
     """
     Mirrors authors you follow, and their follows
     """
-    async def get_following(self):
+    async def get_following(self, contacts):
+        following = set(await super().get_following(contacts))
+        self.log.info("Getting extended network")
         find_query = {
             'kinds': [3],
-            'authors': [self.MY_PUBKEY]
+            'authors': list(following)
         }
-        following = set([self.MY_PUBKEY])
-        self.log.info("Getting following for %s %s", self.MY_PUBKEY, find_query)
-        async for event in self.manager.get_events(find_query):
-            for tag in event.tags:
-                if tag[0] == 'p':
-                    following.add(tag[1])
-        self.log.info("Getting extended network")
-        find_query['authors'] = list(following)
-        async for event in self.manager.get_events(find_query):
-            for tag in event.tags:
-                if tag[0] == 'p':
-                    following.add(tag[1])
+        async for event in self.get_events(find_query):
+            following.update(self.followed_in(event))
         return list(following)
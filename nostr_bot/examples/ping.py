@@ -3,7 +3,6 @@ Ping bot
 """
 
 import os
-import json
 from nostr_bot import RPCBot
 
 
@@ -17,7 +16,7 @@ class PingBot(RPCBot):
     async def on_ping(self, event, *args):
         self.log.info("Got ping %s", event)
         self.log.info("Sending pong")
-        return self.make_response(event, kind=event.kind, content=json.dumps({"method": "pong", "args": []}))
+        return self.make_response(event, kind=event.kind, content=self.codec.encode_command("pong"))
 
     async def on_pong(self, event, *args):
         self.log.info("Got pong %s", event)
\ No newline at end of file
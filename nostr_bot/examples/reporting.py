@@ -11,33 +11,30 @@ TATTLE_WATCH=<mypubkey> NOSTR_KEY=<bot_private_key> nostr-bot run -c nostr_bot.e
 
 from nostr_bot.bot import CommunicatorBot
 from aionostr.util import to_nip19
-import shelve
 import os
 import time
 
 
 class TattleBot(CommunicatorBot):
     SEND_MESSAGE = False
+    STATE_FILE = 'tattlebot.sqlite'
 
-    shelf = shelve.open('tattlebot')
+    async def setup(self):
+        self.last_seen = await self.get_last_seen()
 
     def get_query(self):
         query = {
             'kinds': [1984]
         }
-        last_seen = self.get_last_seen()
-        if last_seen:
-            query['since'] = last_seen
+        if self.last_seen:
+            query['since'] = self.last_seen
         pubkeys = self.get_watch_for_pubkeys()
         if pubkeys:
             query['#p'] = pubkeys
         return query
 
-    def get_last_seen(self):
-        return self.shelf.get('last_seen', 0)
-
-    def set_last_seen(self, event):
-        self.shelf['last_seen'] = max(event.created_at, self.get_last_seen())
+    async def get_last_seen(self):
+        return await self.store.get_cursor(0)
 
     def get_watch_for_pubkeys(self):
         pubkeys = os.getenv('TATTLE_WATCH', '').split(',')
@@ -45,7 +42,7 @@ class TattleBot(CommunicatorBot):
             return pubkeys
 
     async def handle_event(self, event):
-        if event.id in self.shelf:
+        if await self.store.contains(event.id):
             self.log.info("Skipping %s", event.id)
             return
         report_type = ''
@@ -66,8 +63,7 @@ class TattleBot(CommunicatorBot):
         message = self.create_message(event, report_type, tattled_event_id, impersonation)
 
         response = await self.handle_message(event, tattle_subject, message)
-        self.set_last_seen(event)
-        self.shelf[event.id] = {'seen': time.time(), 'response': response}
+        await self.store.set(event.id, {'seen': time.time(), 'response': response})
 
     def create_message(self, event, report_type, tattled_event_id, impersonation):
         reporter = to_nip19('npub', event.pubkey)
@@ -0,0 +1,93 @@
+"""
+Matching events against nostr filters locally
+"""
+from collections import defaultdict
+
+# tags that are indexed by FilterIndex
+INDEXED_TAGS = ('p', 'e')
+
+
+def event_matches(filter_obj: dict, event) -> bool:
+    """
+    Returns True if the event matches the filter. `limit` is ignored
+    """
+    for key, value in filter_obj.items():
+        if key == 'ids':
+            if event.id not in value:
+                return False
+        elif key == 'authors':
+            if event.pubkey not in value:
+                return False
+        elif key == 'kinds':
+            if event.kind not in value:
+                return False
+        elif key == 'since':
+            if event.created_at < value:
+                return False
+        elif key == 'until':
+            if event.created_at > value:
+                return False
+        elif key.startswith('#'):
+            name = key[1:]
+            if not any(len(tag) > 1 and tag[0] == name and tag[1] in value for tag in event.tags):
+                return False
+    return True
+
+
+class FilterIndex:
+    """
+    Finds the targets whose filters match an event.
+
+    Each filter is indexed by its most selective field (authors, then #p/#e tags, then kinds),
+    so only a few candidate filters are fully checked for each event.
+    """
+    def __init__(self):
+        self.by_author = defaultdict(list)
+        self.by_tag = defaultdict(list)
+        self.by_kind = defaultdict(list)
+        self.unindexed = []
+        self.order = {}
+
+    def add(self, filter_obj: dict, target):
+        entry = (filter_obj, target)
+        self.order.setdefault(id(target), len(self.order))
+        if filter_obj.get('authors'):
+            for author in filter_obj['authors']:
+                self.by_author[author].append(entry)
+            return
+        for name in INDEXED_TAGS:
+            values = filter_obj.get(f'#{name}')
+            if values:
+                for value in values:
+                    self.by_tag[(name, value)].append(entry)
+                return
+        if filter_obj.get('kinds'):
+            for kind in filter_obj['kinds']:
+                self.by_kind[kind].append(entry)
+            return
+        self.unindexed.append(entry)
+
+    def candidates(self, event):
+        yield from self.by_author.get(event.pubkey, ())
+        yield from self.by_kind.get(event.kind, ())
+        if self.by_tag:
+            for tag in event.tags:
+                if len(tag) > 1 and tag[0] in INDEXED_TAGS:
+                    yield from self.by_tag.get((tag[0], tag[1]), ())
+        yield from self.unindexed
+
+    def matches(self, event) -> bool:
+        """
+        Returns True if any filter matches the event
+        """
+        return any(event_matches(filter_obj, event) for filter_obj, target in self.candidates(event))
+
+    def match(self, event) -> list:
+        """
+        Returns the targets with a filter matching the event, in the order they were added
+        """
+        targets = {}
+        for filter_obj, target in self.candidates(event):
+            if id(target) not in targets and event_matches(filter_obj, event):
+                targets[id(target)] = target
+        return sorted(targets.values(), key=lambda target: self.order[id(target)])
@@ -0,0 +1,141 @@
+"""
+Tracking the health of relays, for routing reads and writes
+"""
+import logging
+import time
+
+from .metrics import RELAY_SCORE
+
+log = logging.getLogger(__name__)
+
+
+class RelayHealth:
+    """
+    The health of one relay, from what it has done recently.
+
+    Latencies (to EOSE, and to the OK for a published event) and the error rate
+    (over connection attempts and publishes) are exponentially weighted averages,
+    where each new sample has a weight of `alpha`.
+
+    After `eject_after` failures in a row, the relay is ejected for `eject_seconds`.
+    Each ejection in a row doubles that, up to `max_eject_seconds`
+    """
+    def __init__(self, url, alpha=0.2, eject_after=5, eject_seconds=30.0, max_eject_seconds=600.0):
+        self.url = url
+        self.alpha = alpha
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self.eose_latency = None
+        self.ok_latency = None
+        self.error_rate = 0.0
+        self.counts = dict.fromkeys(('connects', 'connect_failures', 'published', 'publish_failures', 'disconnects'), 0)
+        self.failures_in_a_row = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.gauge = RELAY_SCORE.labels(relay=url)
+
+    def _average(self, average, value):
+        return value if average is None else average + self.alpha * (value - average)
+
+    def _outcome(self, ok):
+        self.error_rate = self._average(self.error_rate, 0.0 if ok else 1.0)
+        if ok:
+            self.failures_in_a_row = 0
+            if not self.ejected():
+                self.ejections = 0
+        else:
+            self.failures_in_a_row += 1
+            if self.failures_in_a_row >= self.eject_after and not self.ejected():
+                seconds = min(self.eject_seconds * 2 ** self.ejections, self.max_eject_seconds)
+                self.ejected_until = time.monotonic() + seconds
+                self.ejections += 1
+                self.failures_in_a_row = 0
+                log.warning("Ejected %s for %.0fs after %d failures", self.url, seconds, self.eject_after)
+        self.gauge.set(self.score)
+
+    def record_connect(self, ok):
+        self.counts['connects' if ok else 'connect_failures'] += 1
+        self._outcome(ok)
+
+    def record_disconnect(self):
+        self.counts['disconnects'] += 1
+        self._outcome(False)
+
+    def record_eose(self, seconds):
+        self.eose_latency = self._average(self.eose_latency, seconds)
+        self.gauge.set(self.score)
+
+    def record_ok(self, seconds):
+        self.counts['published'] += 1
+        self.ok_latency = self._average(self.ok_latency, seconds)
+        self._outcome(True)
+
+    def record_publish_failure(self):
+        self.counts['publish_failures'] += 1
+        self._outcome(False)
+
+    def ejected(self, now=None):
+        return (time.monotonic() if now is None else now) < self.ejected_until
+
+    @property
+    def latency(self):
+        """
+        The expected latency: of OK responses if any were received, otherwise of EOSE, or None
+        """
+        return self.ok_latency if self.ok_latency is not None else self.eose_latency
+
+    @property
+    def score(self):
+        """
+        The expected latency in seconds (1 if unknown), penalized by the error rate. Lower is better
+        """
+        latency = self.latency
+        return (1.0 if latency is None else latency) * (1 + 10 * self.error_rate)
+
+    def to_dict(self):
+        ejected_for = max(self.ejected_until - time.monotonic(), 0.0)
+        return {
+            'score': self.score,
+            'ok_ms': self.ok_latency * 1000 if self.ok_latency is not None else None,
+            'eose_ms': self.eose_latency * 1000 if self.eose_latency is not None else None,
+            'error_rate': self.error_rate,
+            'ejected_for': ejected_for,
+            **self.counts,
+        }
+
+
+class RelayHealthTracker:
+    """
+    The health of every relay used in the process, by url
+    """
+    def __init__(self, **options):
+        self.options = options
+        self.relays = {}
+
+    def get(self, url):
+        health = self.relays.get(url)
+        if health is None:
+            health = self.relays[url] = RelayHealth(url, **self.options)
+        return health
+
+    def rank(self, relays):
+        """
+        The relays (with a `url`) from best to worst, leaving out ejected ones
+        unless all of them are ejected
+        """
+        now = time.monotonic()
+        ranked = sorted(relays, key=lambda relay: self.get(relay.url).score)
+        available = [relay for relay in ranked if not self.get(relay.url).ejected(now)]
+        return available or ranked
+
+    def scores(self, urls=None):
+        """
+        {url: health} for `urls`, or every relay, from best to worst
+        """
+        urls = self.relays if urls is None else urls
+        healths = sorted((self.get(url) for url in urls), key=lambda health: health.score)
+        return {health.url: health.to_dict() for health in healths}
+
+
+relay_health = RelayHealthTracker()
@@ -0,0 +1,315 @@
+"""
+Counters and latency histograms, with a Prometheus text endpoint
+"""
+import asyncio
+import bisect
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        return self.value
+
+
+class GaugeValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def get(self):
+        return self.value
+
+
+class HistogramValue:
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+    def get(self):
+        cumulative = {}
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            cumulative[bound] = total
+        return {'count': self.count, 'sum': self.sum, 'buckets': cumulative}
+
+
+class Timer:
+    """
+    Observes the seconds spent in a `with` block
+    """
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Metric:
+    """
+    A named metric with a value for each combination of labels.
+
+    `labels(**labels)` returns the value for those labels. It is cached,
+    so hot paths should look it up once and keep it
+    """
+    TYPE = ''
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def new_value(self):
+        raise NotImplementedError
+
+    def labels(self, **labels):
+        key = tuple(sorted(labels.items()))
+        value = self.values.get(key)
+        if value is None:
+            value = self.values[key] = self.new_value()
+        return value
+
+    def samples(self, **match):
+        """
+        Yields (labels, value) for the label sets that include `match`
+        """
+        for key, value in list(self.values.items()):
+            labels = dict(key)
+            if all(labels.get(k) == v for k, v in match.items()):
+                yield labels, value
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def new_value(self):
+        return CounterValue()
+
+    def inc(self, amount=1, **labels):
+        self.labels(**labels).inc(amount)
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def new_value(self):
+        return GaugeValue()
+
+    def set(self, value, **labels):
+        self.labels(**labels).set(value)
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, help='', buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+
+    def new_value(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value, **labels):
+        self.labels(**labels).observe(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in sorted(labels.items())
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+class Registry:
+    """
+    A collection of metrics
+    """
+    def __init__(self):
+        self.metrics = {}
+
+    def _get(self, cls, name, help, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError(f"{name} is already registered as a {metric.TYPE}")
+        return metric
+
+    def counter(self, name, help=''):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help=''):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def snapshot(self, **match):
+        """
+        The current values, as {name: [{'labels': {...}, 'value': ...}]}.
+        Histogram values are dicts of count, sum and cumulative bucket counts.
+        Pass labels to only include matching values, e.g. `snapshot(bot='MirrorBot')`
+        """
+        return {
+            name: [{'labels': labels, 'value': value.get()} for labels, value in metric.samples(**match)]
+            for name, metric in self.metrics.items()
+        }
+
+    def to_prometheus(self):
+        """
+        The metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for name, metric in self.metrics.items():
+            lines.append(f'# HELP {name} {metric.help}')
+            lines.append(f'# TYPE {name} {metric.TYPE}')
+            for labels, value in metric.samples():
+                if metric.TYPE == 'histogram':
+                    data = value.get()
+                    for bound, count in data['buckets'].items():
+                        lines.append(f'{name}_bucket{format_labels(dict(labels, le=repr(bound)))} {count}')
+                    lines.append(f'{name}_bucket{format_labels(dict(labels, le="+Inf"))} {data["count"]}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {data["sum"]}')
+                    lines.append(f'{name}_count{format_labels(labels)} {data["count"]}')
+                else:
+                    lines.append(f'{name}{format_labels(labels)} {value.get()}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+EVENT_COUNT = registry.counter(
+    'nostr_bot_events_total',
+    'Events at each stage of a bot: received, duplicate, invalid, handled, error',
+)
+STAGE_LATENCY = registry.histogram(
+    'nostr_bot_stage_seconds',
+    'Seconds spent in each stage of a bot: verify, decrypt, handle, reply',
+)
+RPC_COUNT = registry.counter(
+    'nostr_bot_rpc_calls_total',
+    'RPC calls to each method, by status: ok, error, invalid',
+)
+RPC_LATENCY = registry.histogram(
+    'nostr_bot_rpc_seconds',
+    'Seconds spent in each RPC method',
+)
+RPC_CACHE_COUNT = registry.counter(
+    'nostr_bot_rpc_cache_total',
+    'Lookups in the response cache of each RPC method, by result: hit, coalesced, miss',
+)
+PROFILE_COUNT = registry.counter(
+    'nostr_bot_profile_lookups_total',
+    'Profile lookups, by result: hit, coalesced, miss',
+)
+SHED_COUNT = registry.counter(
+    'nostr_bot_shed_total',
+    'Events shed before verification, by reason: size, query, rate, global_rate',
+)
+SCHEDULER_QUEUED = registry.gauge(
+    'nostr_bot_scheduler_queued',
+    'Events waiting in the priority scheduler, by bot and priority class',
+)
+SCHEDULER_WAIT = registry.histogram(
+    'nostr_bot_scheduler_wait_seconds',
+    'Seconds events waited in the priority scheduler, by bot and priority class',
+)
+LOOP_LAG = registry.histogram(
+    'nostr_bot_loop_lag_seconds',
+    'Seconds the event loop was late to run a scheduled callback',
+)
+RELAY_EVENT_COUNT = registry.counter(
+    'nostr_bot_relay_events_total',
+    'Events received from each relay, before deduplication',
+)
+PUBLISH_COUNT = registry.counter(
+    'nostr_bot_relay_published_total',
+    'Events published to each relay, by status: accepted, failed',
+)
+RELAY_SCORE = registry.gauge(
+    'nostr_bot_relay_score',
+    'Health score of each relay: expected latency in seconds, penalized by errors. Lower is better',
+)
+PUBLISH_LATENCY = registry.histogram(
+    'nostr_bot_relay_publish_seconds',
+    'Seconds between sending an event to a relay and its OK response',
+)
+
+
+async def start_server(port, host='', registry=registry):
+    """
+    Serve the registry's metrics over HTTP at /metrics. Returns the asyncio Server
+    """
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            # skip the headers
+            while (await asyncio.wait_for(reader.readline(), 10)).strip():
+                pass
+            parts = request.decode('latin-1').split()
+            if len(parts) >= 2 and parts[1].split('?')[0] in ('/', '/metrics'):
+                status, body = '200 OK', registry.to_prometheus().encode()
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'
+                'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                'Connection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host or None, port)
+    log.info("Serving metrics on port %d", port)
+    return server
@@ -0,0 +1,72 @@
+"""
+NIP-04 encrypted messages, with cached shared secrets
+"""
+import base64
+import secrets
+import threading
+
+import coincurve
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+from .cache import LRUCache
+
+
+def compute_shared_secret(private_key, public_key_hex: str) -> bytes:
+    """
+    The NIP-04 shared secret: the x coordinate of the ECDH point, unhashed.
+    aionostr's `compute_shared_secret` hashes the point with its y parity,
+    so the two parties can end up with different secrets
+    """
+    point = coincurve.PublicKey(bytes.fromhex('02' + public_key_hex)).multiply(private_key.raw_secret)
+    return point.format(compressed=True)[1:]
+
+
+def encrypt(shared_secret: bytes, message: str) -> str:
+    padder = padding.PKCS7(128).padder()
+    padded_data = padder.update(message.encode()) + padder.finalize()
+    iv = secrets.token_bytes(16)
+    encryptor = Cipher(algorithms.AES(shared_secret), modes.CBC(iv)).encryptor()
+    encrypted = encryptor.update(padded_data) + encryptor.finalize()
+    return f"{base64.b64encode(encrypted).decode()}?iv={base64.b64encode(iv).decode()}"
+
+
+def decrypt(shared_secret: bytes, encoded_message: str) -> str:
+    encoded_content, encoded_iv = encoded_message.split('?iv=')
+    iv = base64.b64decode(encoded_iv)
+    decryptor = Cipher(algorithms.AES(shared_secret), modes.CBC(iv)).decryptor()
+    decrypted = decryptor.update(base64.b64decode(encoded_content)) + decryptor.finalize()
+    unpadder = padding.PKCS7(128).unpadder()
+    return (unpadder.update(decrypted) + unpadder.finalize()).decode()
+
+
+class SharedSecrets:
+    """
+    Encrypts and decrypts messages between `private_key` and other public keys,
+    caching the ECDH shared secret for the `maxsize` most recent public keys.
+    It can be used from several threads
+    """
+    def __init__(self, private_key, maxsize=1024):
+        self.private_key = private_key
+        self.cache = LRUCache(maxsize)
+        self.lock = threading.Lock()
+
+    def get(self, public_key_hex: str) -> bytes:
+        with self.lock:
+            secret = self.cache.get(public_key_hex)
+        if secret is None:
+            secret = compute_shared_secret(self.private_key, public_key_hex)
+            with self.lock:
+                self.cache[public_key_hex] = secret
+        return secret
+
+    def encrypt(self, message: str, public_key_hex: str) -> str:
+        return encrypt(self.get(public_key_hex), message)
+
+    def decrypt(self, encoded_message: str, public_key_hex: str) -> str:
+        return decrypt(self.get(public_key_hex), encoded_message)
+
+    @property
+    def stats(self):
+        with self.lock:
+            return self.cache.stats
@@ -0,0 +1,309 @@
+"""
+Pipelined publishing of events
+"""
+import asyncio
+import logging
+import time
+import weakref
+
+from .health import relay_health
+from .metrics import PUBLISH_COUNT, PUBLISH_LATENCY
+
+# OK messages starting with these won't succeed if they're sent again
+PERMANENT_ERRORS = ('blocked:', 'invalid:', 'pow:', 'restricted:')
+
+
+class PublishResult:
+    """
+    The outcome of publishing an event to a set of relays.
+
+    Await it to wait until every relay has answered (or given up on),
+    which returns a dict of relay url -> (accepted, message).
+    `on_result(result, url)` is called after each answer
+    """
+    def __init__(self, event, urls, on_result=None):
+        self.event = event
+        self.results = {}
+        self.waiting = set(urls)
+        self.on_result = on_result
+        self.future = asyncio.get_running_loop().create_future()
+        if not self.waiting:
+            self.future.set_result(self.results)
+
+    def set_result(self, url, accepted, message=''):
+        if url not in self.waiting:
+            return
+        self.waiting.discard(url)
+        self.results[url] = (accepted, message)
+        if not self.waiting and not self.future.done():
+            self.future.set_result(self.results)
+        if self.on_result is not None:
+            self.on_result(self, url)
+
+    @property
+    def accepted(self):
+        return any(accepted for accepted, message in self.results.values())
+
+    def done(self):
+        return self.future.done()
+
+    def __await__(self):
+        return self.future.__await__()
+
+
+class RelayWriter:
+    """
+    Sends events to one relay without waiting for each OK response.
+    Responses are matched to events by id as they arrive, and failed events are retried.
+
+    Only one reader can consume a relay's OK responses, so use `RelayWriter.acquire(relay)`
+    to share the relay's writer, and `release()` it when done.
+    """
+    _writers = weakref.WeakKeyDictionary()
+
+    def __init__(self, relay, retries=2, retry_delay=1.0, timeout=10.0, queue_size=1000, log=None):
+        self.relay = relay
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.log = log or logging.getLogger(__name__)
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        # event id -> [event, [PublishResult], attempts, timeout handle, send time]
+        self.inflight = {}
+        self.accepted = PUBLISH_COUNT.labels(relay=relay.url, status='accepted')
+        self.failed = PUBLISH_COUNT.labels(relay=relay.url, status='failed')
+        self.latency = PUBLISH_LATENCY.labels(relay=relay.url)
+        self.health = relay_health.get(relay.url)
+        self.tasks = []
+        self.users = 0
+
+    @classmethod
+    def acquire(cls, relay, **kwargs):
+        writer = cls._writers.get(relay)
+        if writer is None:
+            writer = cls._writers[relay] = cls(relay, **kwargs)
+        writer.users += 1
+        return writer
+
+    async def release(self):
+        self.users -= 1
+        if self.users <= 0:
+            await self.close()
+            if self._writers.get(self.relay) is self:
+                del self._writers[self.relay]
+
+    def start(self):
+        if not self.tasks:
+            self.tasks = [
+                asyncio.create_task(self._write()),
+                asyncio.create_task(self._read()),
+            ]
+
+    async def put(self, event, result):
+        self.start()
+        await self.queue.put((event, [result], 0))
+
+    async def _write(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            event, results, attempts = await self.queue.get()
+            results = [result for result in results if not result.done()]
+            if not results:
+                continue
+            entry = self.inflight.get(event.id)
+            if entry:
+                # the same event is already waiting for its OK
+                entry[1].extend(results)
+                continue
+            self.inflight[event.id] = [
+                event, results, attempts + 1,
+                loop.call_later(self.timeout, self._failed, event.id, 'timeout'),
+                time.perf_counter(),
+            ]
+            try:
+                await self.relay.send(["EVENT", event.to_json_object()])
+            except Exception as e:
+                self._failed(event.id, f'error: {e}')
+
+    async def _read(self):
+        while True:
+            message = await self.relay.event_adds.get()
+            try:
+                event_id, accepted = message[1], message[2]
+                reason = message[3] if len(message) > 3 else ''
+            except (IndexError, TypeError):
+                continue
+            if accepted or reason.startswith('duplicate:'):
+                entry = self.inflight.pop(event_id, None)
+                if entry:
+                    entry[3].cancel()
+                    latency = time.perf_counter() - entry[4]
+                    self.latency.observe(latency)
+                    self.health.record_ok(latency)
+                    self.accepted.inc()
+                    for result in entry[1]:
+                        result.set_result(self.relay.url, True, reason)
+            else:
+                self._failed(event_id, reason)
+
+    def _failed(self, event_id, reason):
+        entry = self.inflight.pop(event_id, None)
+        if not entry:
+            return
+        event, results, attempts, handle, sent = entry
+        handle.cancel()
+        if reason == 'timeout' or reason.startswith('error:'):
+            # rejections are about the event, these are about the relay
+            self.health.record_publish_failure()
+        # once the writer is closed, there's nothing left to retry with
+        if self.tasks and attempts <= self.retries and not reason.startswith(PERMANENT_ERRORS):
+            self.log.debug("Retrying %s on %s: %s", event_id, self.relay.url, reason)
+            loop = asyncio.get_running_loop()
+            loop.call_later(self.retry_delay * attempts, self._retry, event, results, attempts)
+        else:
+            self.log.warning("Failed to publish %s to %s: %s", event_id, self.relay.url, reason)
+            self.failed.inc()
+            for result in results:
+                result.set_result(self.relay.url, False, reason)
+
+    def _retry(self, event, results, attempts):
+        if not self.tasks:
+            reason = 'closed: outbox stopped'
+        else:
+            try:
+                self.queue.put_nowait((event, results, attempts))
+                return
+            except asyncio.QueueFull:
+                reason = 'error: queue is full'
+        for result in results:
+            result.set_result(self.relay.url, False, reason)
+
+    async def close(self):
+        """
+        Stop writing, and fail the events that are still queued or waiting for their OK
+        """
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        for event_id in list(self.inflight):
+            self._failed(event_id, 'closed: outbox stopped')
+        while not self.queue.empty():
+            event, results, attempts = self.queue.get_nowait()
+            for result in results:
+                result.set_result(self.relay.url, False, 'closed: outbox stopped')
+
+
+class Hedge:
+    """
+    Sends an event to more relays if the relays it was sent to first don't accept it in time.
+
+    The rest of the relays get the event after `delay` seconds, or as soon as all
+    the first ones have failed. If one of the first relays accepts it before that,
+    the rest are skipped, with a 'skipped:' result
+    """
+    def __init__(self, outbox, result, relays, delay):
+        self.outbox = outbox
+        self.result = result
+        self.relays = relays
+        self.urls = {relay.url for relay in relays}
+        self.decided = False
+        self.timer = asyncio.get_running_loop().call_later(delay, self.send)
+        result.on_result = self.on_result
+
+    def on_result(self, result, url):
+        if self.decided:
+            return
+        if result.accepted:
+            self.decided = True
+            self.timer.cancel()
+            for relay in self.relays:
+                result.set_result(relay.url, False, 'skipped: accepted by a faster relay')
+        elif result.waiting <= self.urls:
+            self.send()
+
+    def send(self):
+        if self.decided:
+            return
+        self.decided = True
+        self.timer.cancel()
+        self.outbox.log.debug("Hedging %s to %d more relays", self.result.event.id, len(self.relays))
+        task = asyncio.ensure_future(self._send())
+        self.outbox.tasks.add(task)
+        task.add_done_callback(self.outbox.tasks.discard)
+
+    async def _send(self):
+        for relay in self.relays:
+            await self.outbox.get_writer(relay).put(self.result.event, self.result)
+
+
+class Outbox:
+    """
+    Publishes events to the relays of a manager, through the relays' RelayWriters.
+
+    `publish(event)` returns as soon as the event is queued, with a PublishResult
+    that can be awaited for confirmation.
+
+    Relays are ranked by their health, and ejected relays are left out. With a `fanout`,
+    events are sent to the best `fanout` relays, and hedged to the rest if those don't
+    accept them within `hedge_delay` seconds (or 3 times their expected latency, if that's shorter)
+    """
+    def __init__(self, manager, retries=2, retry_delay=1.0, timeout=10.0, fanout=0, hedge_delay=0.5, log=None):
+        self.manager = manager
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.fanout = fanout
+        self.hedge_delay = hedge_delay
+        self.log = log or logging.getLogger(__name__)
+        self.writers = {}
+        self.pending = set()
+        self.tasks = set()
+
+    def get_writer(self, relay):
+        writer = self.writers.get(relay)
+        if writer is None:
+            writer = self.writers[relay] = RelayWriter.acquire(
+                relay,
+                retries=self.retries,
+                retry_delay=self.retry_delay,
+                timeout=self.timeout,
+                log=self.log,
+            )
+        return writer
+
+    def get_hedge_delay(self, relays):
+        latencies = [relay_health.get(relay.url).latency for relay in relays]
+        if None in latencies:
+            return self.hedge_delay
+        return min(self.hedge_delay, max(0.05, 3 * max(latencies)))
+
+    async def publish(self, event):
+        relays = relay_health.rank(self.manager.relays)
+        result = PublishResult(event, [relay.url for relay in relays])
+        if self.fanout and len(relays) > self.fanout:
+            relays, rest = relays[:self.fanout], relays[self.fanout:]
+            Hedge(self, result, rest, self.get_hedge_delay(relays))
+        for relay in relays:
+            await self.get_writer(relay).put(event, result)
+        if not result.done():
+            self.pending.add(result)
+            result.future.add_done_callback(lambda f: self.pending.discard(result))
+        return result
+
+    async def flush(self, timeout=None):
+        """
+        Wait up to `timeout` seconds for every published event to be answered
+        """
+        if self.pending:
+            await asyncio.wait([result.future for result in self.pending], timeout=timeout)
+
+    async def close(self, timeout=None):
+        """
+        Flush, then release the relay writers
+        """
+        await self.flush(timeout)
+        for task in self.tasks:
+            task.cancel()
+        for writer in self.writers.values():
+            await writer.release()
+        self.writers = {}
@@ -0,0 +1,271 @@
+"""
+Sharing relay connections
+"""
+import asyncio
+import random
+import time
+
+from aionostr.event import Event
+from aionostr.relay import Manager, Relay, Subscription
+from websockets import exceptions
+from .cache import SeenCache
+from .codec import loads
+from .health import relay_health
+from .metrics import RELAY_EVENT_COUNT
+from .outbox import PublishResult, RelayWriter
+
+
+class CountingQueue(asyncio.Queue):
+    """
+    A subscription queue that counts the events put into it
+    """
+    def __init__(self, counter):
+        super().__init__()
+        self.counter = counter
+
+    def put_nowait(self, item):
+        if item is not None:
+            self.counter.inc()
+        super().put_nowait(item)
+
+
+class PooledRelay(Relay):
+    """
+    A Relay connection shared by several managers.
+
+    `connect()` only connects the first time, `close()` only disconnects when the last
+    user closes it, and reconnects back off exponentially. A connection the relay closes,
+    even cleanly, is reconnected once, however many users notice it. Subscriptions from all
+    users are multiplexed over the one websocket, keyed by their subscription ids.
+    Connection attempts and drops are recorded in the relay's health.
+
+    Every publish goes through the relay's RelayWriter, since only one reader
+    can consume the OK responses. The last `close()` waits up to `drain_timeout`
+    seconds for them
+    """
+    def __init__(self, url, pool, origin='', private_key='', min_backoff=0.5, max_backoff=60.0, drain_timeout=10.0):
+        super().__init__(url, origin=origin, private_key=private_key)
+        self.pool = pool
+        self.users = 0
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.is_connected = False
+        self._connectlock = asyncio.Lock()
+        self.received = RELAY_EVENT_COUNT.labels(relay=url)
+        self.health = relay_health.get(url)
+        self.writer = None
+        self.drain_timeout = drain_timeout
+        # PublishResults of add_event() still waiting for their OK
+        self.pending = set()
+
+    async def connect(self, retries=5):
+        async with self._connectlock:
+            if self.is_connected:
+                return
+            await self._connect(retries)
+
+    async def _connect(self, retries):
+        delay = self.min_backoff
+        for i in range(retries):
+            try:
+                await super().connect(1)
+            except Exception:
+                self.health.record_connect(False)
+                if i == retries - 1:
+                    raise
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(delay * 2, self.max_backoff)
+            else:
+                self.health.record_connect(True)
+                self.is_connected = True
+                return
+
+    async def subscribe(self, sub_id, *filters, queue=None):
+        self.subscriptions[sub_id] = Subscription(filters=filters, queue=queue or CountingQueue(self.received))
+        await self.send(["REQ", sub_id, *filters])
+        return self.subscriptions[sub_id].queue
+
+    async def add_event(self, event, check_response=False):
+        if not isinstance(event, Event):
+            event = Event(**event)
+        if self.writer is None:
+            self.writer = RelayWriter.acquire(self)
+        result = PublishResult(event, [self.url])
+        self.pending.add(result)
+        result.future.add_done_callback(lambda f: self.pending.discard(result))
+        await self.writer.put(event, result)
+        if check_response:
+            await result
+            return event.id
+
+    async def reconnect(self, ws=None):
+        """
+        Reconnect after the websocket `ws` (by default, the current one) closed
+        """
+        ws = ws or self.ws
+        async with self._connectlock:
+            if self.ws is not ws and self.is_connected:
+                # another user already reconnected
+                return
+            self.health.record_disconnect()
+            self.is_connected = False
+            await self._connect(20)
+        for sub_id, sub in list(self.subscriptions.items()):
+            await self.send(["REQ", sub_id, *sub.filters])
+
+    async def send(self, message):
+        ws = self.ws
+        try:
+            await super().send(message)
+        except exceptions.ConnectionClosed:
+            await self.reconnect(ws)
+            await super().send(message)
+
+    async def _receive_messages(self):
+        # unlike Relay._receive_messages, a connection closed cleanly (e.g. 1001 when the relay restarts)
+        # is reconnected too, instead of failing on every recv() without yielding
+        while True:
+            ws = self.ws
+            try:
+                message = await asyncio.wait_for(ws.recv(), 30.0)
+                self.log.debug(message)
+                await self.handle_message(loads(message))
+            except asyncio.CancelledError:
+                return
+            except asyncio.TimeoutError:
+                continue
+            except exceptions.ConnectionClosed:
+                try:
+                    await self.reconnect(ws)
+                except Exception:
+                    self.log.exception("Could not reconnect to %s", self.url)
+                    await asyncio.sleep(self.max_backoff)
+            except Exception:
+                self.log.exception("Bad message from %s", self.url)
+
+    async def handle_message(self, message):
+        if message[0] == 'EVENT':
+            sub = self.subscriptions.get(message[1])
+            if sub is not None:
+                await sub.queue.put(Event(**message[2]))
+        elif message[0] == 'EOSE':
+            sub = self.subscriptions.get(message[1])
+            if sub is not None:
+                await sub.queue.put(None)
+        elif message[0] == 'OK':
+            await self.event_adds.put(message)
+        elif message[0] == 'NOTICE':
+            await self.notices.put(message[1])
+        elif message[0] == 'AUTH':
+            await self.authenticate(message[1])
+
+    async def close(self):
+        self.users -= 1
+        if self.users > 0:
+            return
+        self.pool.discard(self)
+        self.is_connected = False
+        if self.writer is not None:
+            if self.pending:
+                await asyncio.wait([result.future for result in self.pending], timeout=self.drain_timeout)
+            await self.writer.release()
+            self.writer = None
+        if self.receive_task:
+            self.receive_task.cancel()
+            self.receive_task = None
+        if self.ws:
+            await self.ws.close()
+        self.connected = False
+
+
+class PooledManager(Manager):
+    """
+    A Manager whose relays come from a RelayPool.
+
+    Subscriptions forward each relay's events as soon as they arrive, instead of
+    waiting for every relay to produce one, and the ids used for deduplication are bounded.
+    The end of stored events doesn't wait for ejected relays, but their events are still forwarded
+    """
+    def __init__(self, relays, dedup_size=10000, **kwargs):
+        super().__init__(**kwargs)
+        self.relays = relays
+        self.dedup_size = dedup_size
+
+    async def subscribe(self, sub_id, *filters):
+        relays = list(self.relays)
+        queues = [await relay.subscribe(sub_id, *filters) for relay in relays]
+        queue = asyncio.Queue()
+        self.subscriptions[sub_id] = asyncio.create_task(self.monitor_queues(queues, queue, relays))
+        return queue
+
+    async def monitor_queues(self, queues, output, relays=None):
+        seen = SeenCache(self.dedup_size)
+        start = time.perf_counter()
+        healths = [relay_health.get(relay.url) for relay in relays] if relays else [None] * len(queues)
+        # ejected relays don't hold up the end of stored events, unless all of them are ejected
+        waited = [health is None or not health.ejected() for health in healths]
+        if not any(waited):
+            waited = [True] * len(queues)
+        waiting = sum(waited)
+        if not waiting:
+            await output.put(None)
+
+        async def forward(queue, health, wait):
+            nonlocal waiting
+            stored = True
+            while True:
+                event = await queue.get()
+                if event is not None:
+                    if not seen.seen(event.id):
+                        await output.put(event)
+                elif stored:
+                    # EOSE. relays send it again after reconnecting
+                    stored = False
+                    if health is not None:
+                        health.record_eose(time.perf_counter() - start)
+                    if wait:
+                        waiting -= 1
+                        if not waiting:
+                            await output.put(None)
+
+        await asyncio.gather(*[forward(*args) for args in zip(queues, healths, waited)])
+
+    async def close(self):
+        for task in self.subscriptions.values():
+            task.cancel()
+        self.subscriptions = {}
+        await super().close()
+
+
+class RelayPool:
+    """
+    Process-wide relay connections, keyed by url and reference counted
+    """
+    def __init__(self):
+        self.relays = {}
+
+    def acquire(self, url, origin='', private_key=''):
+        relay = self.relays.get(url)
+        if relay is None:
+            relay = self.relays[url] = PooledRelay(url, self, origin=origin, private_key=private_key)
+        elif private_key and not relay.private_key:
+            relay.private_key = private_key
+        relay.users += 1
+        return relay
+
+    def discard(self, relay):
+        if self.relays.get(relay.url) is relay:
+            del self.relays[relay.url]
+
+    def get_manager(self, relays, origin='', private_key=None):
+        """
+        A Manager whose relays come from the pool. Closing it releases them
+        """
+        return PooledManager(
+            [self.acquire(url, origin=origin, private_key=private_key) for url in relays],
+            origin=origin,
+            private_key=private_key,
+        )
+
+
+relay_pool = RelayPool()
@@ -0,0 +1,147 @@
+"""
+Resolving pubkeys to their profiles (kind 0 metadata)
+"""
+import asyncio
+import logging
+
+from .batch import Batcher
+from .cache import LRUCache
+from .codec import loads
+from .metrics import PROFILE_COUNT
+
+MISSING = object()
+
+
+class Profile:
+    """
+    The metadata of a kind 0 event. The content is only parsed when it's first needed
+    """
+    __slots__ = ('pubkey', 'created_at', 'content', '_meta')
+
+    def __init__(self, pubkey, created_at, content):
+        self.pubkey = pubkey
+        self.created_at = created_at
+        self.content = content
+        self._meta = None
+
+    @classmethod
+    def from_event(cls, event):
+        return cls(event.pubkey, event.created_at, event.content)
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            try:
+                meta = loads(self.content)
+            except ValueError:
+                meta = None
+            self._meta = meta if isinstance(meta, dict) else {}
+        return self._meta
+
+    @property
+    def name(self):
+        """
+        The display name, or name, or '' if neither is set
+        """
+        return self.meta.get('display_name', '') or self.meta.get('name', '') or ''
+
+    def __repr__(self):
+        return f'Profile({self.pubkey!r}, {self.created_at})'
+
+
+class ProfileResolver:
+    """
+    Looks up the profiles of pubkeys, with as few queries as possible.
+
+    Lookups made within `delay` seconds of each other are fetched with one
+    {"kinds": [0], "authors": [...]} query of up to `batch_size` authors, and concurrent
+    lookups of the same pubkey share one fetch. Profiles are cached for `ttl` seconds,
+    and pubkeys without a profile for `missing_ttl` seconds.
+
+    `get_events(*filters)` runs the queries. Fetched events are checked with `verify`, if given.
+    Kind 0 events seen elsewhere can be added to the cache with `feed(event)`.
+    """
+    def __init__(self, get_events, verify=None, batch_size=100, delay=0.05, maxsize=10000, ttl=3600,
+                 missing_ttl=300, timeout=10, name='', log=None):
+        self.get_events = get_events
+        self.verify = verify
+        self.ttl = ttl
+        self.missing_ttl = missing_ttl
+        self.timeout = timeout
+        self.cache = LRUCache(maxsize, ttl=ttl)
+        self.batcher = Batcher(self._fetch, size=batch_size, delay=delay)
+        # pubkey -> future of the fetch in progress
+        self.inflight = {}
+        self.log = log or logging.getLogger(__name__)
+        self.hits = PROFILE_COUNT.labels(bot=name, result='hit')
+        self.coalesced = PROFILE_COUNT.labels(bot=name, result='coalesced')
+        self.misses = PROFILE_COUNT.labels(bot=name, result='miss')
+
+    def feed(self, event):
+        """
+        Cache the profile in a kind 0 event, unless a newer one is cached
+        """
+        if event.kind != 0:
+            return
+        cached = self.cache.get(event.pubkey)
+        if cached is None or cached.created_at < event.created_at:
+            self.cache[event.pubkey] = Profile.from_event(event)
+
+    async def resolve(self, pubkey):
+        """
+        Returns the pubkey's Profile, or None if it doesn't have one
+        """
+        profile = self.cache.get(pubkey, MISSING)
+        if profile is not MISSING:
+            self.hits.inc()
+            return profile
+        future = self.inflight.get(pubkey)
+        if future is not None:
+            self.coalesced.inc()
+        else:
+            self.misses.inc()
+            future = self.inflight[pubkey] = self.batcher.submit(pubkey)
+            future.add_done_callback(lambda f: self.inflight.pop(pubkey, None))
+        return await asyncio.shield(future)
+
+    async def get_name(self, pubkey, default=''):
+        """
+        The pubkey's display name or name, or `default`
+        """
+        profile = await self.resolve(pubkey)
+        return (profile.name if profile is not None else '') or default
+
+    async def _fetch(self, pubkeys):
+        authors = list(dict.fromkeys(pubkeys))
+        try:
+            await asyncio.wait_for(self._query(authors), self.timeout)
+        except Exception as e:
+            # don't remember the missing profiles; they may be found next time
+            self.log.warning("Fetching %d profiles failed: %r", len(authors), e)
+            return [self.cache.get(pubkey) for pubkey in pubkeys]
+        profiles = []
+        for pubkey in pubkeys:
+            profile = self.cache.get(pubkey, MISSING)
+            if profile is MISSING:
+                profile = None
+                self.cache.set(pubkey, None, ttl=self.missing_ttl)
+            profiles.append(profile)
+        return profiles
+
+    async def _query(self, authors):
+        wanted = set(authors)
+        async for event in self.get_events({'kinds': [0], 'authors': authors}):
+            if event.pubkey in wanted and (self.verify is None or self.verify(event)):
+                self.feed(event)
+
+    async def close(self):
+        await self.batcher.close()
+
+    @property
+    def stats(self):
+        return {
+            'hits': self.hits.get(),
+            'coalesced': self.coalesced.get(),
+            'misses': self.misses.get(),
+            'size': len(self.cache),
+        }
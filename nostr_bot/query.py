@@ -0,0 +1,296 @@
+"""
+Planning queries that are too large for one subscription, and changing live ones
+"""
+import asyncio
+import json
+import logging
+import secrets
+
+from .cache import SeenCache
+
+# yielded by live queries that are asked to mark it, once all the stored events have been received
+LOADED = object()
+
+
+def split_filter(filter_obj: dict, max_authors=500):
+    """
+    Split a filter into filters with at most `max_authors` authors each
+    """
+    authors = filter_obj.get('authors')
+    if not authors or len(authors) <= max_authors:
+        return [filter_obj]
+    authors = list(authors)
+    return [
+        dict(filter_obj, authors=authors[i:i + max_authors])
+        for i in range(0, len(authors), max_authors)
+    ]
+
+
+class QueryPlanner:
+    """
+    Runs filters with long author lists as several smaller subscriptions.
+
+    Each chunk of `max_authors` authors gets its own subscription. At most `fan_out`
+    chunks load stored events at the same time; live subscriptions stay open after that.
+    A chunk that hasn't loaded its stored events after `eose_timeout` seconds keeps loading,
+    but lets the next chunk start, so a relay that never sends EOSE can't hold up the rest.
+    The results are merged back into one stream, without duplicates.
+    With `mark_loaded`, a live query yields LOADED once every subscription has sent its stored events.
+    """
+    def __init__(self, manager, max_authors=500, fan_out=4, dedup_size=100000, eose_timeout=10.0, log=None):
+        self.manager = manager
+        self.max_authors = max_authors
+        self.fan_out = fan_out
+        self.eose_timeout = eose_timeout
+        self.dedup_size = dedup_size
+        self.log = log or logging.getLogger(__name__)
+
+    def plan(self, filters):
+        """
+        Returns the filters to use for each subscription
+        """
+        chunks = []
+        plain = []
+        for filter_obj in filters:
+            split = split_filter(filter_obj, self.max_authors)
+            if len(split) == 1:
+                plain.append(filter_obj)
+            else:
+                chunks.extend([chunk] for chunk in split)
+        if plain:
+            chunks.insert(0, plain)
+        return chunks
+
+    async def get_events(self, *filters, only_stored=True, mark_loaded=False):
+        chunks = self.plan(filters)
+        if len(chunks) <= 1:
+            # unlike Manager.get_events, this closes the subscription when the caller stops early
+            sub_id = secrets.token_hex(4)
+            queue = await self.manager.subscribe(sub_id, *filters)
+            try:
+                while True:
+                    event = await queue.get()
+                    if event is not None:
+                        yield event
+                    elif only_stored:
+                        return
+                    elif mark_loaded:
+                        mark_loaded = False
+                        yield LOADED
+            finally:
+                if sub_id in self.manager.subscriptions:
+                    await self.manager.unsubscribe(sub_id)
+
+        self.log.debug("Split query into %d subscriptions", len(chunks))
+        output = asyncio.Queue(maxsize=1000)
+        semaphore = asyncio.Semaphore(self.fan_out)
+        seen = SeenCache(self.dedup_size)
+        loading = len(chunks)
+
+        async def load(queue):
+            while True:
+                event = await queue.get()
+                if event is None:
+                    return
+                await output.put(event)
+
+        async def run_chunk(chunk):
+            nonlocal loading
+            sub_id = secrets.token_hex(4)
+            stored = None
+            try:
+                async with semaphore:
+                    queue = await self.manager.subscribe(sub_id, *chunk)
+                    stored = asyncio.ensure_future(load(queue))
+                    done, pending = await asyncio.wait([stored], timeout=self.eose_timeout)
+                    if pending:
+                        self.log.warning("No EOSE after %ss. Starting the next subscription", self.eose_timeout)
+                await stored
+                loading -= 1
+                if mark_loaded and not loading and not only_stored:
+                    await output.put(LOADED)
+                if not only_stored:
+                    while True:
+                        event = await queue.get()
+                        if event is not None:
+                            await output.put(event)
+            finally:
+                if stored is not None:
+                    stored.cancel()
+                if sub_id in self.manager.subscriptions:
+                    await self.manager.unsubscribe(sub_id)
+
+        tasks = [asyncio.create_task(run_chunk(chunk)) for chunk in chunks]
+        done = asyncio.ensure_future(asyncio.gather(*tasks))
+        done.add_done_callback(lambda f: asyncio.ensure_future(output.put(None)))
+        try:
+            while True:
+                event = await output.get()
+                if event is None:
+                    break
+                if event is LOADED or not seen.seen(event.id):
+                    yield event
+            # raise any errors from the subscriptions
+            await done
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def filter_key(filter_obj: dict):
+    """
+    The parts of a filter other than its authors, since and limit
+    """
+    return json.dumps(
+        {key: value for key, value in filter_obj.items() if key not in ('authors', 'since', 'limit')},
+        sort_keys=True,
+    )
+
+
+def diff_filters(old, new):
+    """
+    Returns the filters to subscribe to in addition to `old`, to get the events of `new`.
+    That is possible when filters were only added, or authors were only added to filters.
+    Returns None if the subscriptions have to be reopened
+    """
+    old_keys = {filter_key(f): f for f in old}
+    new_keys = {filter_key(f): f for f in new}
+    if len(old_keys) != len(old) or len(new_keys) != len(new) or not old_keys.keys() <= new_keys.keys():
+        return None
+    added = []
+    for key, filter_obj in new_keys.items():
+        before = old_keys.get(key)
+        if before is None:
+            added.append(filter_obj)
+        elif 'authors' in filter_obj or 'authors' in before:
+            if 'authors' not in filter_obj or 'authors' not in before:
+                return None
+            previous = set(before['authors'])
+            if not previous.issubset(filter_obj['authors']):
+                return None
+            authors = [author for author in filter_obj['authors'] if author not in previous]
+            if authors:
+                added.append(dict(filter_obj, authors=authors))
+    return added
+
+
+def resume_filter(filter_obj: dict, since=None):
+    """
+    The filter for resuming a subscription at `since`, without its limit
+    """
+    if not since:
+        return filter_obj
+    filter_obj = dict(filter_obj, since=max(filter_obj.get('since') or 0, since))
+    filter_obj.pop('limit', None)
+    return filter_obj
+
+
+class LiveQuery:
+    """
+    A live subscription whose filters can be changed with `update()` while it runs,
+    on the connections that are already open.
+
+    Authors and filters that are added get subscriptions of their own. Any other change
+    closes the subscriptions and opens them again with the new filters, and so does
+    an addition once there are `max_streams` subscriptions. Subscriptions opened by
+    an update start at its `since`; the events they repeat are dropped by the bot's deduplication.
+
+    `get_events(*filters, only_stored=False)` opens each subscription. With `mark_loaded`,
+    events() yields LOADED once the subscriptions have sent their stored events. Until then,
+    updates open their subscriptions from the filters' own `since`, and LOADED waits for them too
+    """
+    def __init__(self, get_events, filters, max_streams=8, queue_size=1000, mark_loaded=False, log=None):
+        self.get_events = get_events
+        self.filters = list(filters)
+        self.max_streams = max_streams
+        # waiting for LOADED
+        self.loading = mark_loaded
+        self.output = asyncio.Queue(maxsize=queue_size)
+        self.streams = set()
+        # the streams whose stored events LOADED waits for
+        self.loading_streams = set()
+        self.started = False
+        self.log = log or logging.getLogger(__name__)
+
+    def _open(self, filters, mark_loaded=False):
+        task = asyncio.create_task(self._forward(filters, mark_loaded))
+        self.streams.add(task)
+        if mark_loaded:
+            self.loading_streams.add(task)
+        task.add_done_callback(self._closed)
+
+    async def _forward(self, filters, mark_loaded=False):
+        options = {'mark_loaded': True} if mark_loaded else {}
+        task = asyncio.current_task()
+        async for event in self.get_events(*filters, only_stored=False, **options):
+            if event is LOADED:
+                self.loading_streams.discard(task)
+                if self.loading_streams:
+                    continue
+            await self.output.put(event)
+
+    def _closed(self, task):
+        self.streams.discard(task)
+        self.loading_streams.discard(task)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None or not self.streams:
+            # None ends events()
+            asyncio.ensure_future(self.output.put(error))
+
+    async def events(self):
+        """
+        Yield the events of all the subscriptions
+        """
+        self.started = True
+        self._open(self.filters, mark_loaded=self.loading)
+        try:
+            while True:
+                item = await self.output.get()
+                if item is None:
+                    return
+                elif isinstance(item, Exception):
+                    raise item
+                elif item is LOADED:
+                    self.loading = False
+                yield item
+        finally:
+            await self.close()
+
+    async def update(self, filters, since=None):
+        """
+        Change the filters. Returns the filters of the subscriptions that were opened
+        """
+        filters = list(filters)
+        added = diff_filters(self.filters, filters)
+        self.filters = filters
+        if not self.started:
+            return []
+        # while the stored events are loading, `since` is the newest of them, not the oldest
+        loading = self.loading
+        if loading:
+            since = None
+        if added is None or (added and len(self.streams) >= self.max_streams):
+            old = list(self.streams)
+            opened = [resume_filter(f, since) for f in filters]
+            self.log.debug("Reopening the subscription with %s", opened)
+            # open the new subscription before closing the old ones, so nothing is missed
+            self._open(opened, mark_loaded=loading)
+            for task in old:
+                self.loading_streams.discard(task)
+                task.cancel()
+            await asyncio.gather(*old, return_exceptions=True)
+            return opened
+        opened = [resume_filter(f, since) for f in added]
+        if opened:
+            self.log.debug("Adding a subscription for %s", opened)
+            self._open(opened, mark_loaded=loading)
+        return opened
+
+    async def close(self):
+        streams = list(self.streams)
+        for task in streams:
+            task.cancel()
+        await asyncio.gather(*streams, return_exceptions=True)
@@ -0,0 +1,232 @@
+"""
+Recording events to JSONL files and replaying them into bots
+"""
+import asyncio
+import gzip
+import json
+import logging
+import sys
+import time
+
+from aionostr.event import Event
+from .query import LOADED
+
+log = logging.getLogger(__name__)
+
+
+def open_file(path, mode='r'):
+    """
+    Open a text file, or stdin/stdout for '-'. Files ending in .gz are compressed
+    """
+    if path == '-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf8')
+    return open(path, mode, encoding='utf8')
+
+
+def parse_line(line):
+    """
+    Returns (event dict, received_at) for a line holding an event, a recorded event
+    ({"received_at": ..., "event": {...}}) or a relay message (["EVENT", sub_id, {...}])
+    """
+    row = json.loads(line)
+    if isinstance(row, list):
+        return row[-1], None
+    if 'event' in row:
+        return row['event'], row.get('received_at')
+    return row, None
+
+
+async def read_events(path, chunk_size=1 << 16):
+    """
+    Yield (Event, received_at) from the JSONL file at `path`, reading it lazily
+    in chunks of about `chunk_size` bytes off the event loop
+    """
+    loop = asyncio.get_running_loop()
+    fileobj = open_file(path)
+    try:
+        while True:
+            lines = await loop.run_in_executor(None, fileobj.readlines, chunk_size)
+            if not lines:
+                return
+            for line in lines:
+                if not line.strip():
+                    continue
+                try:
+                    row, received_at = parse_line(line)
+                    event = Event(**row)
+                except Exception as e:
+                    log.warning("Skipping bad line %r: %s", line[:100], e)
+                    continue
+                yield event, received_at
+    finally:
+        if fileobj is not sys.stdin:
+            fileobj.close()
+
+
+async def paced(events, speed=1.0):
+    """
+    Yield the events from (Event, received_at) pairs, at `speed` times the pace they were
+    received at (or created at, if the receive time wasn't recorded).
+    A speed of 0 yields them as fast as possible
+    """
+    first = None
+    async for event, received_at in events:
+        if speed:
+            timestamp = received_at or event.created_at
+            if first is None:
+                first = (timestamp, time.monotonic())
+            delay = (timestamp - first[0]) / speed - (time.monotonic() - first[1])
+            if delay > 0:
+                await asyncio.sleep(delay)
+        yield event
+
+
+class EventRecorder:
+    """
+    Appends events to a JSONL file as {"received_at": ..., "event": {...}} lines
+    """
+    def __init__(self, path, flush_interval=1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.fileobj = None
+        self.last_flush = 0
+        self.count = 0
+
+    def write(self, event):
+        if self.fileobj is None:
+            self.fileobj = open_file(self.path, 'a')
+        now = time.time()
+        self.fileobj.write(json.dumps({'received_at': now, 'event': event.to_json_object()}) + '\n')
+        self.count += 1
+        if now - self.last_flush > self.flush_interval:
+            self.fileobj.flush()
+            self.last_flush = now
+
+    async def record(self, events):
+        """
+        Yield the events from `events`, recording each one
+        """
+        try:
+            async for event in events:
+                if event is not LOADED:
+                    self.write(event)
+                yield event
+        finally:
+            self.close()
+
+    def close(self):
+        if self.fileobj is not None:
+            self.fileobj.flush()
+            if self.fileobj is not sys.stdout:
+                self.fileobj.close()
+            self.fileobj = None
+
+
+class CaptureRelay:
+    """
+    Stands in for a relay when replaying: published events are written to `fileobj`
+    (if given) and accepted
+    """
+    url = 'capture:'
+
+    def __init__(self, fileobj=None):
+        self.fileobj = fileobj
+        self.event_adds = asyncio.Queue()
+        self.connected = True
+        self.count = 0
+
+    async def send(self, message):
+        if message[0] != 'EVENT':
+            return
+        row = message[1]
+        self.count += 1
+        if self.fileobj is not None:
+            self.fileobj.write(json.dumps(row) + '\n')
+        self.event_adds.put_nowait(['OK', row['id'], True, ''])
+
+    def close(self):
+        if self.fileobj is not None:
+            self.fileobj.flush()
+            if self.fileobj is not sys.stdout:
+                self.fileobj.close()
+            self.fileobj = None
+
+
+class OfflineManager:
+    """
+    A Manager that doesn't connect anywhere. Queries return nothing,
+    and published events go to a CaptureRelay
+    """
+    def __init__(self, reply_path=None):
+        self.reply_path = reply_path
+        self.relay = CaptureRelay(open_file(reply_path, 'a') if reply_path else None)
+        self.relays = [self.relay]
+        self.subscriptions = {}
+        self.private_key = None
+
+    async def connect(self):
+        pass
+
+    async def close(self):
+        # the bots sharing this manager may still be publishing. replay() closes the relay
+        pass
+
+    async def subscribe(self, sub_id, *filters):
+        queue = asyncio.Queue()
+        queue.put_nowait(None)
+        self.subscriptions[sub_id] = filters
+        return queue
+
+    async def unsubscribe(self, sub_id):
+        self.subscriptions.pop(sub_id, None)
+
+    async def get_events(self, *filters, only_stored=True, single_event=False):
+        return
+        yield
+
+    async def add_event(self, event, check_response=False):
+        if isinstance(event, Event):
+            event = event.to_json_object()
+        await self.relay.send(['EVENT', event])
+        return event['id'] if check_response else None
+
+
+def set_offline(bot, manager):
+    """
+    Make the bot (and the bots of a BotRouter) use `manager` for everything
+    """
+    for each in [bot, *getattr(bot, 'bots', [])]:
+        each.manager = manager
+        each.get_manager = lambda relays=None: manager
+
+
+async def replay(bot, path, speed=0, reply_path=None):
+    """
+    Feed the events in the JSONL file at `path` through the bot's verification and handlers,
+    without connecting to any relays. Replies are written to `reply_path`, if given.
+    Returns a dict of statistics
+    """
+    manager = OfflineManager(reply_path)
+    set_offline(bot, manager)
+    read = 0
+
+    async def counted(events):
+        nonlocal read
+        async for event in events:
+            read += 1
+            yield event
+
+    start = time.perf_counter()
+    try:
+        await bot.start(events=counted(paced(read_events(path), speed)))
+    finally:
+        manager.relay.close()
+    elapsed = time.perf_counter() - start
+    return {
+        'events': read,
+        'replies': manager.relay.count,
+        'seconds': elapsed,
+        'events_per_second': read / elapsed if elapsed > 0 else 0.0,
+    }
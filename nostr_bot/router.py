@@ -0,0 +1,141 @@
+"""
+Running several bots over one subscription
+"""
+import asyncio
+
+from .bot import NostrBot
+from .filters import FilterIndex
+
+
+def most_permissive(limits):
+    """
+    The highest limit, or 0 (no limit) if any of them is 0
+    """
+    limits = list(limits)
+    return max(limits) if limits and all(limits) else 0
+
+
+class BotRouter(NostrBot):
+    """
+    Runs several bots over a single subscription.
+
+    The bots' queries are sent together as one multi-filter subscription per relay.
+    Each event is deduplicated and verified once, then dispatched to every bot
+    with a matching query, using that bot's own dispatcher.
+    """
+    LISTEN_KIND = None
+
+    def __init__(self, bots):
+        super().__init__()
+        self.bots = list(bots)
+        self.index = FilterIndex()
+        self.dispatchers = {}
+        # id(event) -> the bots whose cursors are waiting for the event
+        self.tracked = {}
+        # bot number -> the query it asked for with update_query(), instead of get_query()
+        self.bot_queries = {}
+        # the router does the receiving for all the bots, so it takes their settings
+        if self.bots:
+            self.VERIFY_WORKERS = max(bot.VERIFY_WORKERS for bot in self.bots)
+            self.VERIFY_THREADS = all(bot.VERIFY_THREADS for bot in self.bots)
+            self.BACKFILL = any(bot.BACKFILL for bot in self.bots)
+            self.RECORD_FILE = next((bot.RECORD_FILE for bot in self.bots if bot.RECORD_FILE), None)
+            # events are shed for every bot at once, so only shed what no bot would accept
+            for name in ('RATE_LIMIT', 'RATE_LIMIT_BURST', 'GLOBAL_RATE_LIMIT', 'GLOBAL_RATE_LIMIT_BURST',
+                         'MAX_CONTENT_SIZE', 'MAX_TAGS'):
+                setattr(self, name, most_permissive(getattr(bot, name) for bot in self.bots))
+            self.CHECK_QUERY = all(bot.CHECK_QUERY for bot in self.bots)
+
+    def get_origin(self):
+        return 'BotRouter'
+
+    def get_relays(self):
+        relays = []
+        for bot in self.bots:
+            for relay in bot.get_relays():
+                if relay not in relays:
+                    relays.append(relay)
+        return relays
+
+    def get_query(self):
+        return self.queries
+
+    def index_queries(self):
+        """
+        Collect the bots' queries, and index them for dispatching
+        """
+        self.queries = []
+        self.index = FilterIndex()
+        for i, bot in enumerate(self.bots):
+            query = self.bot_queries.get(i) or bot.get_query()
+            for filter_obj in (query if isinstance(query, (list, tuple)) else [query]):
+                self.index.add(filter_obj, bot)
+                self.queries.append(filter_obj)
+
+    async def setup(self):
+        for bot in self.bots:
+            # events are verified by the router, so share the verified ids and the profiles it sees
+            bot.verified_ids = self.verified_ids
+            bot.profiles = self.profiles
+            bot.router = self
+            bot.loading = self.loading
+            await bot.manager.connect()
+            await bot.setup()
+            self.dispatchers[bot] = bot.get_dispatcher()
+        self.index_queries()
+
+    def set_query(self, index, query):
+        """
+        Use `query` for bot number `index`, or its get_query() if it's None
+        """
+        if query is None:
+            self.bot_queries.pop(index, None)
+        else:
+            self.bot_queries[index] = query
+
+    async def update_query(self, query=None, since=None, bot=None):
+        """
+        Update the subscription with the bots' current queries, and `query` for `bot`
+        """
+        if bot is not None:
+            self.set_query(self.bots.index(bot), query)
+        self.index_queries()
+        await super().update_query(since=since)
+
+    async def process_events(self, events):
+        try:
+            await super().process_events(events)
+        finally:
+            await asyncio.gather(*[
+                dispatcher.close(bot.DRAIN_TIMEOUT) for bot, dispatcher in self.dispatchers.items()
+            ])
+            for bot in self.bots:
+                await bot.close()
+
+    async def stored_loaded(self):
+        await super().stored_loaded()
+        for bot in self.bots:
+            await bot.stored_loaded()
+
+    def begin_event(self, event):
+        # the bots' own dispatchers end the event for them
+        if any(bot.checkpoint is not None for bot in self.bots):
+            bots = [bot for bot in self.index.match(event) if bot.checkpoint is not None]
+            if bots:
+                self.tracked[id(event)] = bots
+                for bot in bots:
+                    bot.begin_event(event)
+
+    def drop_event(self, event):
+        for bot in self.tracked.pop(id(event), ()):
+            bot.end_event(event)
+
+    async def handle_event(self, event):
+        tracked = self.tracked.pop(id(event), ())
+        matched = self.index.match(event)
+        for bot in tracked:
+            # the queries changed since the event was received
+            if bot not in matched:
+                bot.end_event(event)
+        for bot in matched:
+            await self.dispatchers[bot].put(event)
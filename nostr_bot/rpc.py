@@ -0,0 +1,232 @@
+"""
+The RPC method table for RPCBot
+"""
+import asyncio
+import inspect
+import json
+import time
+import typing
+
+from .cache import LRUCache
+from .metrics import RPC_CACHE_COUNT, RPC_COUNT, RPC_LATENCY
+
+MISSING = object()
+
+
+class RPCMethod:
+    """
+    An RPC method, with what its signature accepts.
+
+    Arguments annotated with a plain class (int, str, list...) are type checked.
+    An `int` is accepted for `float`, but a `bool` isn't accepted for `int`
+
+    With a `cache_ttl`, responses are cached by arguments for that many seconds.
+    Only responses made with the bot's `make_response()` can be remade for other
+    callers, so other responses aren't cached.
+    """
+    def __init__(self, func, name=None, concurrency=0, cache_ttl=0, cache_size=1024):
+        self.func = func
+        if name is None:
+            name = func.__name__[3:] if func.__name__.startswith('on_') else func.__name__
+        self.name = name
+        self.concurrency = concurrency
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        try:
+            hints = typing.get_type_hints(func)
+        except Exception:
+            hints = {}
+        # skip self and the event
+        params = list(inspect.signature(func).parameters.values())[2:]
+        self.types = []
+        self.min_args = 0
+        self.max_args = 0
+        for param in params:
+            if param.kind == param.VAR_POSITIONAL:
+                self.max_args = None
+                break
+            if param.kind not in (param.POSITIONAL_ONLY, param.POSITIONAL_OR_KEYWORD):
+                break
+            self.max_args += 1
+            if param.default is param.empty:
+                self.min_args += 1
+            hint = hints.get(param.name)
+            self.types.append(hint if isinstance(hint, type) else None)
+
+    def check_args(self, args):
+        """
+        Returns what is wrong with the arguments, or None if they're acceptable
+        """
+        if len(args) < self.min_args or (self.max_args is not None and len(args) > self.max_args):
+            if self.max_args is None:
+                expected = f'at least {self.min_args}'
+            elif self.min_args == self.max_args:
+                expected = self.min_args
+            else:
+                expected = f'{self.min_args} to {self.max_args}'
+            return f'{self.name} takes {expected} arguments, not {len(args)}'
+        for i, (arg, expected) in enumerate(zip(args, self.types)):
+            if expected is None:
+                continue
+            if expected is float:
+                valid = isinstance(arg, (int, float)) and not isinstance(arg, bool)
+            elif expected is int:
+                valid = isinstance(arg, int) and not isinstance(arg, bool)
+            else:
+                valid = isinstance(arg, expected)
+            if not valid:
+                return f'argument {i + 1} of {self.name} must be {expected.__name__}, not {type(arg).__name__}'
+        return None
+
+    def cache_key(self, args):
+        return json.dumps(args, sort_keys=True, separators=(',', ':'))
+
+    def bind(self, bot):
+        return BoundRPCMethod(self, bot)
+
+
+class BoundRPCMethod:
+    """
+    An RPCMethod bound to a bot, with its concurrency limit, response cache and stats.
+
+    A cached response is remade for each caller with the bot's `remake_response()`,
+    so only its encryption and signature are redone. Identical calls made while
+    the response is being computed wait for it, instead of computing it again
+    """
+    def __init__(self, method, bot):
+        self.method = method
+        self.bot = bot
+        self.func = method.func.__get__(bot)
+        self.check_args = method.check_args
+        self.semaphore = None
+        origin = bot.get_origin()
+        self.latency = RPC_LATENCY.labels(bot=origin, method=method.name)
+        self.ok = RPC_COUNT.labels(bot=origin, method=method.name, status='ok')
+        self.errors = RPC_COUNT.labels(bot=origin, method=method.name, status='error')
+        self.invalid = RPC_COUNT.labels(bot=origin, method=method.name, status='invalid')
+        self.cache = None
+        if method.cache_ttl:
+            self.cache = LRUCache(method.cache_size, ttl=method.cache_ttl)
+            # cache key -> future of the response being computed
+            self.inflight = {}
+            self.hits = RPC_CACHE_COUNT.labels(bot=origin, method=method.name, result='hit')
+            self.coalesced = RPC_CACHE_COUNT.labels(bot=origin, method=method.name, result='coalesced')
+            self.misses = RPC_CACHE_COUNT.labels(bot=origin, method=method.name, result='miss')
+
+    async def __call__(self, event, *args):
+        if self.cache is not None:
+            return await self._cached(event, args)
+        return await self._limited(event, args)
+
+    async def _cached(self, event, args):
+        key = self.method.cache_key(args)
+        response = self.cache.get(key, MISSING)
+        if response is not MISSING:
+            self.hits.inc()
+            return self.bot.remake_response(event, response)
+        future = self.inflight.get(key)
+        if future is not None:
+            self.coalesced.inc()
+            response = await asyncio.shield(future)
+            if response is MISSING:
+                # it couldn't be shared, so make our own
+                return await self._limited(event, args)
+            return self.bot.remake_response(event, response)
+
+        self.misses.inc()
+        future = self.inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            response = await self._limited(event, args)
+        except BaseException as e:
+            future.set_exception(e)
+            # the callers waiting for it (if any) get the error
+            future.exception()
+            raise
+        else:
+            if response and 'kwargs' not in response:
+                self.bot.log.warning("Not caching the response of %s, it wasn't made by make_response()",
+                                     self.method.name)
+                future.set_result(MISSING)
+            else:
+                self.cache[key] = response
+                future.set_result(response)
+            return response
+        finally:
+            del self.inflight[key]
+
+    async def _limited(self, event, args):
+        if self.method.concurrency:
+            if self.semaphore is None:
+                self.semaphore = asyncio.Semaphore(self.method.concurrency)
+            async with self.semaphore:
+                return await self._call(event, args)
+        return await self._call(event, args)
+
+    async def _call(self, event, args):
+        start = time.perf_counter()
+        try:
+            response = await self.func(event, *args)
+        except Exception:
+            self.errors.inc()
+            raise
+        else:
+            self.ok.inc()
+        finally:
+            self.latency.observe(time.perf_counter() - start)
+        return response
+
+    @property
+    def stats(self):
+        latency = self.latency.get()
+        stats = {
+            'ok': self.ok.get(),
+            'errors': self.errors.get(),
+            'invalid': self.invalid.get(),
+            'seconds': latency['sum'],
+            'mean_ms': latency['sum'] / latency['count'] * 1000 if latency['count'] else 0.0,
+        }
+        if self.cache is not None:
+            stats['cache'] = {
+                'hits': self.hits.get(),
+                'coalesced': self.coalesced.get(),
+                'misses': self.misses.get(),
+                'size': len(self.cache),
+            }
+        return stats
+
+
+def rpc_method(func=None, *, name=None, concurrency=0, cache_ttl=0, cache_size=1024):
+    """
+    Register a method of an RPCBot as an RPC method.
+
+    `name` defaults to the method name without its `on_` prefix, and `concurrency`
+    limits how many calls run at the same time (0 is unlimited).
+    Methods named `on_*` are registered without the decorator.
+
+    For methods whose response only depends on their arguments, `cache_ttl` caches
+    the `cache_size` most recent responses for that many seconds. The response must be
+    made with `make_response()`, and its arguments mustn't depend on the caller,
+    because they are reused for other callers
+    """
+    def decorate(func):
+        func.rpc_method = RPCMethod(
+            func, name=name, concurrency=concurrency, cache_ttl=cache_ttl, cache_size=cache_size,
+        )
+        return func
+    return decorate(func) if func is not None else decorate
+
+
+def find_rpc_methods(cls):
+    """
+    Returns {name: RPCMethod} for the class, including inherited methods
+    """
+    methods = {}
+    for klass in reversed(cls.__mro__):
+        for attr, value in vars(klass).items():
+            method = getattr(value, 'rpc_method', None)
+            if isinstance(method, RPCMethod):
+                methods[method.name] = method
+            elif attr.startswith('on_') and inspect.isfunction(value):
+                method = RPCMethod(value)
+                methods[method.name] = method
+    return methods
@@ -0,0 +1,200 @@
+"""
+Sharing the handling of events between bots, by priority
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+from .dispatch import EventDispatcher
+from .metrics import SCHEDULER_QUEUED, SCHEDULER_WAIT
+
+# relative share of the handlers each priority class gets when all of them are busy
+PRIORITY_WEIGHTS = {
+    'interactive': 8,
+    'default': 4,
+    'bulk': 1,
+}
+
+
+class Flow:
+    """
+    The queued events of one dispatcher in one priority class
+    """
+    __slots__ = ('dispatcher', 'priority', 'weight', 'queue', 'maxsize', 'vtime', 'not_full', 'queued', 'wait')
+
+    def __init__(self, dispatcher, priority, weight, maxsize, vtime):
+        self.dispatcher = dispatcher
+        self.priority = priority
+        self.weight = weight
+        self.queue = deque()
+        self.maxsize = max(maxsize, 1)
+        self.vtime = vtime
+        self.not_full = asyncio.Event()
+        self.queued = SCHEDULER_QUEUED.labels(bot=dispatcher.name, priority=priority)
+        self.wait = SCHEDULER_WAIT.labels(bot=dispatcher.name, priority=priority)
+
+
+class PriorityScheduler:
+    """
+    Handles the events of several bots with `concurrency` shared worker tasks,
+    using weighted fair queuing between priority classes.
+
+    Each bot's events in each class (a flow) have their own bounded queue. Workers take
+    the oldest event of the flow with the lowest virtual time, and taking an event
+    advances its flow's virtual time by 1 / the weight of its class. When all flows are
+    busy, a flow in a class of weight 8 is served 8 times as often as one of weight 1;
+    the share of idle flows goes to the others. A bot never has more than its own
+    concurrency of events being handled.
+
+    `put()` waits while the event's flow is full, which only pushes back on that bot
+    """
+    def __init__(self, weights=None, concurrency=16, log=None):
+        self.weights = dict(PRIORITY_WEIGHTS if weights is None else weights)
+        self.concurrency = max(concurrency, 1)
+        self.flows = []
+        # virtual time of the last event taken
+        self.vtime = 0.0
+        self.wakeup = None
+        self.workers = []
+        self.log = log or logging.getLogger(__name__)
+
+    def get_dispatcher(self, handler, priority=None, concurrency=1, queue_size=100, name='', log=None):
+        """
+        A dispatcher that handles events through this scheduler.
+        `priority(event)` returns the priority class of an event
+        """
+        return ScheduledDispatcher(
+            self, handler, priority=priority, concurrency=concurrency, queue_size=queue_size, name=name, log=log,
+        )
+
+    def add_flow(self, dispatcher, priority):
+        if priority not in self.weights:
+            raise ValueError(f"Unknown priority class {priority!r}")
+        flow = Flow(dispatcher, priority, self.weights[priority], dispatcher.queue_size, self.vtime)
+        self.flows.append(flow)
+        return flow
+
+    def remove_flows(self, dispatcher):
+        self.flows = [flow for flow in self.flows if flow.dispatcher is not dispatcher]
+
+    def start(self):
+        if self.workers:
+            return
+        self.wakeup = asyncio.Event()
+        self.workers = [asyncio.create_task(self._work()) for i in range(self.concurrency)]
+
+    async def put(self, flow, event):
+        while len(flow.queue) >= flow.maxsize:
+            flow.not_full.clear()
+            await flow.not_full.wait()
+        if not flow.queue:
+            # a flow that was idle doesn't get credit for the time it had nothing to do
+            flow.vtime = max(flow.vtime, self.vtime)
+        flow.queue.append((event, time.perf_counter()))
+        flow.queued.inc()
+        self.start()
+        self.wakeup.set()
+
+    def next_flow(self):
+        """
+        The flow to take the next event from, or None
+        """
+        best = None
+        for flow in self.flows:
+            if flow.queue and flow.dispatcher.running < flow.dispatcher.concurrency:
+                if best is None or flow.vtime < best.vtime:
+                    best = flow
+        return best
+
+    async def _work(self):
+        while True:
+            flow = self.next_flow()
+            if flow is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            event, queued_at = flow.queue.popleft()
+            flow.queued.dec()
+            flow.wait.observe(time.perf_counter() - queued_at)
+            flow.not_full.set()
+            self.vtime = flow.vtime
+            flow.vtime += 1 / flow.weight
+            dispatcher = flow.dispatcher
+            dispatcher.running += 1
+            try:
+                await dispatcher._handle(event)
+            finally:
+                dispatcher.running -= 1
+                dispatcher.check_idle()
+                self.wakeup.set()
+
+    @property
+    def stats(self):
+        stats = {}
+        for flow in self.flows:
+            wait = flow.wait.get()
+            stats.setdefault(flow.priority, {})[flow.dispatcher.name] = {
+                'queued': len(flow.queue),
+                'taken': wait['count'],
+                'mean_wait_ms': wait['sum'] / wait['count'] * 1000 if wait['count'] else 0.0,
+            }
+        return stats
+
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+
+class ScheduledDispatcher(EventDispatcher):
+    """
+    An EventDispatcher whose events are handled by a PriorityScheduler's workers,
+    at most `concurrency` at a time. Events in the same priority class are handled
+    in the order they arrived
+    """
+    def __init__(self, scheduler, handler, priority=None, concurrency=1, queue_size=100, name='', log=None):
+        super().__init__(handler, concurrency=concurrency, queue_size=queue_size, name=name, log=log)
+        self.scheduler = scheduler
+        self.priority = priority
+        self.name = name
+        # priority class -> Flow
+        self.flows = {}
+        self.running = 0
+        self.idle = None
+
+    async def put(self, event):
+        priority = self.priority(event) if self.priority is not None else 'default'
+        flow = self.flows.get(priority)
+        if flow is None:
+            flow = self.flows[priority] = self.scheduler.add_flow(self, priority)
+        if self.idle is None:
+            self.idle = asyncio.Event()
+        self.idle.clear()
+        await self.scheduler.put(flow, event)
+
+    @property
+    def pending(self):
+        return sum(len(flow.queue) for flow in self.flows.values()) + self.running
+
+    def check_idle(self):
+        if self.idle is not None and not self.pending:
+            self.idle.set()
+
+    async def close(self, timeout=None):
+        """
+        Wait up to `timeout` seconds for queued events to be handled, then drop the rest
+        """
+        self.check_idle()
+        if self.idle is not None:
+            try:
+                await asyncio.wait_for(self.idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                self.log.warning("Dropping %d unhandled events", self.pending)
+        for flow in self.flows.values():
+            flow.queued.dec(len(flow.queue))
+            flow.queue.clear()
+            flow.not_full.set()
+        self.scheduler.remove_flows(self)
+        self.flows = {}
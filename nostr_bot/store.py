@@ -0,0 +1,207 @@
+"""
+Persistent bot state
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import LRUCache
+
+MISSING = object()
+CURSOR_KEY = '__cursor__'
+
+
+class Checkpoint:
+    """
+    The `since` cursor to resume from after a restart: the created_at of the newest
+    event processed, but never past an older event that is still being processed.
+
+    Relays send stored events newest first, so while they load (after `hold()`)
+    the cursor stays where it was, until `loaded()` is called.
+
+    Timestamps in the future, from clock skew or forged events, count as now,
+    so they can't move the cursor past events that haven't been sent yet.
+    """
+    def __init__(self):
+        # the cursor, which never moves back
+        self.value = None
+        self.newest = None
+        # created_at -> number of events being processed
+        self.in_progress = Counter()
+        self.held = False
+
+    def hold(self):
+        self.held = True
+
+    def loaded(self):
+        self.held = False
+
+    def begin(self, timestamp):
+        self.in_progress[timestamp] += 1
+
+    def end(self, timestamp):
+        count = self.in_progress.pop(timestamp, 0)
+        if count > 1:
+            self.in_progress[timestamp] = count - 1
+        self.done(timestamp)
+
+    def done(self, timestamp):
+        timestamp = min(timestamp, int(time.time()))
+        if self.newest is None or timestamp > self.newest:
+            self.newest = timestamp
+
+    @property
+    def cursor(self):
+        if not self.held and self.newest is not None:
+            # events in progress are counted by their own timestamps, so end() finds them,
+            # and newest is already no later than now
+            cursor = min(self.newest, min(self.in_progress)) if self.in_progress else self.newest
+            if self.value is None or cursor > self.value:
+                self.value = cursor
+        return self.value
+
+
+class StateStore:
+    """
+    An async key/value store for bot state, backed by SQLite in WAL mode.
+
+    Reads are served from an in-memory cache when possible. Writes update the cache
+    immediately and are written to disk in batches every `flush_interval` seconds,
+    on a background thread, so handlers never wait for disk I/O.
+
+    The `since` cursor of the `checkpoint` is written in the same transaction
+    as the batch it was set with, so after a crash the bot resumes from a cursor
+    whose earlier writes are all on disk.
+
+    When the bot runs in worker processes, each worker's store keeps the cursor of its
+    `shard`, and the parent's store, given the number of `shards`, resumes from the oldest one.
+    """
+    def __init__(self, path, flush_interval=1.0, cache_size=10000, shard=None, shards=0, log=None):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.cache = LRUCache(cache_size)
+        self.log = log or logging.getLogger(__name__)
+        self.pending = {}
+        self.checkpoint = Checkpoint()
+        self.cursor_key = CURSOR_KEY if shard is None else f'{CURSOR_KEY}:{shard}'
+        self.shards = shards
+        self.db = None
+        self.executor = None
+        self.flush_task = None
+        self._openlock = asyncio.Lock()
+
+    def _open(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+        db.commit()
+        return db
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def open(self):
+        async with self._openlock:
+            if self.db is None:
+                self.executor = ThreadPoolExecutor(1, thread_name_prefix='state')
+                self.db = await self._run(self._open)
+                self.flush_task = asyncio.create_task(self._flush_periodically())
+
+    def _read(self, key):
+        row = self.db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return MISSING if row is None else json.loads(row[0])
+
+    async def get(self, key, default=None):
+        if key in self.pending:
+            value = self.pending[key]
+        else:
+            value = self.cache.get(key, MISSING)
+            if value is MISSING and key not in self.cache:
+                await self.open()
+                value = await self._run(self._read, key)
+                self.cache[key] = value
+        return default if value is MISSING else value
+
+    async def contains(self, key):
+        return await self.get(key, MISSING) is not MISSING
+
+    async def set(self, key, value):
+        self.pending[key] = value
+        self.cache[key] = value
+
+    async def delete(self, key):
+        self.pending[key] = MISSING
+        self.cache[key] = MISSING
+
+    async def read_cursor(self, key):
+        value = await self.get(key)
+        if value is None and key != CURSOR_KEY:
+            # saved before the bot ran in workers
+            value = await self.get(CURSOR_KEY)
+        return value
+
+    async def get_cursor(self, default=None):
+        if self.checkpoint.value is None:
+            if self.shards:
+                cursors = [await self.read_cursor(f'{CURSOR_KEY}:{shard}') for shard in range(self.shards)]
+                self.checkpoint.value = None if None in cursors else min(cursors)
+            else:
+                self.checkpoint.value = await self.read_cursor(self.cursor_key)
+        cursor = self.checkpoint.cursor
+        return default if cursor is None else cursor
+
+    def set_cursor(self, timestamp):
+        """
+        Record that the event created at `timestamp` was processed. The cursor advances
+        to it once no older event is in progress, and is saved along with the next batch of writes
+        """
+        self.checkpoint.done(timestamp)
+
+    def _write(self, items):
+        with self.db:
+            for key, value in items:
+                if value is MISSING:
+                    self.db.execute('DELETE FROM state WHERE key = ?', (key,))
+                else:
+                    self.db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    async def flush(self):
+        items = list(self.pending.items())
+        self.pending = {}
+        cursor = self.checkpoint.cursor
+        if cursor is not None and cursor != self.cache.get(self.cursor_key):
+            items.append((self.cursor_key, cursor))
+        if not items:
+            return
+        await self.open()
+        try:
+            await self._run(self._write, items)
+            if cursor is not None:
+                self.cache[self.cursor_key] = cursor
+        except Exception:
+            self.log.exception("Failed to write %d items to %s", len(items), self.path)
+            # keep them for the next flush, unless they've been overwritten since
+            for key, value in items:
+                if key != self.cursor_key:
+                    self.pending.setdefault(key, value)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def close(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+        if self.db is not None:
+            await self._run(self.db.close)
+            self.db = None
+            self.executor.shutdown()
+            self.executor = None
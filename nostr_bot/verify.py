@@ -0,0 +1,68 @@
+"""
+Verifying event signatures off the event loop
+"""
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from aionostr.event import Event
+from .batch import Batcher
+
+
+def has_valid_id(event):
+    """
+    Returns True if the event's id is the hash of its fields.
+    `Event.verify()` checks the signature against the hash, not against the id the event came with
+    """
+    return Event.compute_id(event.pubkey, event.created_at, event.kind, event.tags, event.content) == event.id
+
+
+def verify_events(rows):
+    """
+    Verify a list of event dicts, returning a list of booleans
+    """
+    results = []
+    for row in rows:
+        try:
+            event = Event(**row)
+            results.append(has_valid_id(event) and bool(event.verify()))
+        except Exception:
+            results.append(False)
+    return results
+
+
+class EventVerifier:
+    """
+    Verifies event signatures in batches, using a pool of `workers` processes.
+
+    Set `threads` to use a thread pool instead, which is cheaper to start and
+    scales when the signature backend releases the GIL.
+    """
+    def __init__(self, workers=2, batch_size=64, batch_delay=0.01, threads=False):
+        self.workers = workers
+        self.threads = threads
+        self.batcher = Batcher(self._verify_batch, size=batch_size, delay=batch_delay)
+        self.executor = None
+
+    def get_executor(self):
+        if self.threads:
+            return ThreadPoolExecutor(self.workers, thread_name_prefix='verify')
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    async def _verify_batch(self, events):
+        if self.executor is None:
+            self.executor = self.get_executor()
+        rows = [event.to_json_object() for event in events]
+        return await asyncio.get_running_loop().run_in_executor(self.executor, verify_events, rows)
+
+    def verify(self, event):
+        """
+        Returns a future that resolves to whether the event is valid
+        """
+        return self.batcher.submit(event)
+
+    async def close(self):
+        await self.batcher.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
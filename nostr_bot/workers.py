@@ -0,0 +1,262 @@
+"""
+Running bots across several processes
+"""
+import asyncio
+import logging
+import multiprocessing
+import queue
+import zlib
+
+from aionostr.event import Event
+from .bot import load_bots
+from .query import LOADED
+from .router import BotRouter
+from .verify import has_valid_id
+
+log = logging.getLogger(__name__)
+
+# sent to the workers after the stored events
+LOADED_ROW = 'loaded'
+# ('query', bot number, query) is sent to the workers when a bot's query changes
+QUERY_ROW = 'query'
+
+
+def shard_for(key: str, num_shards: int) -> int:
+    """
+    A stable shard number for the key, the same in every process
+    """
+    return zlib.crc32(key.encode()) % num_shards
+
+
+def get_batch(work_queue, size=100):
+    items = [work_queue.get()]
+    try:
+        while len(items) < size:
+            items.append(work_queue.get_nowait())
+    except queue.Empty:
+        pass
+    return items
+
+
+async def queue_events(work_queue, set_query=None):
+    """
+    Yield the events sent to this worker, until the parent sends None.
+    Query changes are passed to `set_query(index, query)`
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        for row in await loop.run_in_executor(None, get_batch, work_queue):
+            if row is None:
+                return
+            elif row == LOADED_ROW:
+                yield LOADED
+            elif isinstance(row, tuple):
+                if row[0] == QUERY_ROW and set_query is not None:
+                    set_query(*row[1:])
+            else:
+                yield Event(**row)
+
+
+class WorkerRouter(BotRouter):
+    """
+    Runs the bots in worker number `index`.
+
+    The parent owns the subscription, so query updates are sent to it on `control_queue`,
+    and each bot keeps the cursor of this worker's shard.
+    """
+    def __init__(self, bots, index, control_queue):
+        super().__init__(bots)
+        self.worker = index
+        self.control_queue = control_queue
+        # the parent already applied the rate limits
+        self.RATE_LIMIT = self.GLOBAL_RATE_LIMIT = 0
+        # until the parent sends LOADED_ROW
+        self.loading = True
+
+    async def setup(self):
+        for bot in self.bots:
+            bot.shard = self.worker
+        await super().setup()
+
+    def index_queries(self):
+        super().index_queries()
+        # the parent subscribes to the new query, so its events must be admitted here too
+        if self.admission is not None:
+            self.admission.set_filters(self.queries if self.CHECK_QUERY else None)
+
+    def query_changed(self, index, query):
+        self.set_query(index, query)
+        self.index_queries()
+
+    async def update_query(self, query=None, since=None, bot=None):
+        indexes = range(len(self.bots)) if bot is None else [self.bots.index(bot)]
+        for index in indexes:
+            bot_query = query if bot is not None and query is not None else self.bots[index].get_query()
+            self.set_query(index, bot_query)
+            self.control_queue.put((self.worker, index, bot_query, since))
+        self.index_queries()
+
+
+async def run_worker(index, classnames, options, work_queue, control_queue, metrics_port=None, profiler=None,
+                     profile=False):
+    if metrics_port:
+        from .metrics import start_server
+        await start_server(metrics_port)
+    if profiler is not None:
+        from .diagnostics import Profiler
+        profiler = Profiler(**profiler)
+        profiler.install_signal()
+        profiler.start(profile=profile)
+    router = WorkerRouter(load_bots(classnames, **options), index, control_queue)
+    try:
+        await router.start(events=queue_events(work_queue, set_query=router.query_changed))
+    finally:
+        if profiler is not None:
+            await profiler.close()
+
+
+def worker_main(index, classnames, options, work_queue, control_queue, log_level=logging.INFO,
+                metrics_port=None, profiler=None, profile=False):
+    logging.basicConfig(
+        format=f'%(asctime)s worker-{index} %(name)s %(levelname)s – %(message)s',
+        level=log_level,
+    )
+    try:
+        asyncio.run(run_worker(index, classnames, options, work_queue, control_queue, metrics_port, profiler, profile))
+    except KeyboardInterrupt:
+        pass
+
+
+class ShardRouter(BotRouter):
+    """
+    Owns the relay subscription for all the workers.
+
+    Events are deduplicated here, then sent to a worker chosen by a stable hash
+    of the event's pubkey (or id), where they are verified and handled.
+    Sharding by pubkey keeps each author's events in order on one worker.
+    """
+    def __init__(self, bots, queues, shard_by='pubkey'):
+        super().__init__(bots)
+        self.queues = queues
+        self.shard_by = shard_by
+
+    async def setup(self):
+        # the workers keep the cursors, one per shard
+        for bot in self.bots:
+            bot.shards = len(self.queues)
+        await super().setup()
+
+    async def listen(self, control_queue):
+        """
+        Apply the query updates the workers send on `control_queue`, until it gets None
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await loop.run_in_executor(None, control_queue.get)
+            if message is None:
+                return
+            worker, index, query, since = message
+            self.set_query(index, query)
+            for i, work_queue in enumerate(self.queues):
+                if i != worker:
+                    await self.send(work_queue, (QUERY_ROW, index, query))
+            try:
+                await self.update_query(since=since)
+            except Exception:
+                log.exception("Updating the query from worker %d", worker)
+
+    def seen_key(self, event):
+        # events are deduplicated before the workers verify them. With the signature in the key,
+        # a copy with a forged signature doesn't hide the real event
+        return f'{event.id}:{event.sig}'
+
+    async def verified_events(self, events):
+        # the workers verify the signatures. The id is cheap to check here
+        async for event in events:
+            if event is LOADED or has_valid_id(event):
+                yield event
+            else:
+                self.invalid_event(event)
+
+    def begin_event(self, event):
+        # the workers track their bots' cursors
+        pass
+
+    async def stored_loaded(self):
+        # after the events that were sent before it
+        await super().stored_loaded()
+        for work_queue in self.queues:
+            await self.send(work_queue, LOADED_ROW)
+
+    async def handle_event(self, event):
+        work_queue = self.queues[shard_for(getattr(event, self.shard_by), len(self.queues))]
+        await self.send(work_queue, event.to_json_object())
+
+    async def send(self, work_queue, row):
+        try:
+            work_queue.put_nowait(row)
+        except queue.Full:
+            await asyncio.get_running_loop().run_in_executor(None, work_queue.put, row)
+
+
+async def run_workers(classnames, workers=2, relays=None, shard_by='pubkey', log_level=logging.INFO,
+                      queue_size=1000, metrics_port=None, profiler=None, profile=False, **options):
+    """
+    Run the bots in `workers` processes.
+
+    This process owns the relay subscription and shards the events across the workers,
+    restarting any worker that dies. The workers connect to the relays only to publish.
+    With `metrics_port`, worker N serves its own metrics on metrics_port + N + 1.
+    With `profiler` (the Profiler's arguments), each worker runs its own Profiler,
+    toggled by sending SIGUSR1 to the worker. `profile` starts profiling right away
+    """
+    if relays:
+        options['RELAYS'] = list(relays)
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue(maxsize=queue_size) for i in range(workers)]
+    control_queue = context.Queue()
+
+    def spawn(index):
+        process = context.Process(
+            target=worker_main,
+            args=(
+                index, list(classnames), options, queues[index], control_queue, log_level,
+                metrics_port + index + 1 if metrics_port else None, profiler, profile,
+            ),
+            name=f'nostr-bot-worker-{index}',
+            daemon=True,
+        )
+        process.start()
+        return process
+
+    processes = [spawn(i) for i in range(workers)]
+    router = ShardRouter(load_bots(classnames, **options), queues, shard_by=shard_by)
+    task = asyncio.create_task(router.start())
+    listener = asyncio.create_task(router.listen(control_queue))
+    try:
+        while not task.done():
+            await asyncio.wait([task], timeout=1.0)
+            for i, process in enumerate(processes):
+                if not process.is_alive():
+                    log.warning("Worker %d exited with %s. Restarting", i, process.exitcode)
+                    processes[i] = spawn(i)
+                    for index, query in router.bot_queries.items():
+                        await router.send(queues[i], (QUERY_ROW, index, query))
+                    if not router.loading:
+                        await router.send(queues[i], LOADED_ROW)
+        await task
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        loop = asyncio.get_running_loop()
+        control_queue.put(None)
+        await listener
+        for work_queue in queues:
+            try:
+                await loop.run_in_executor(None, work_queue.put, None, True, 5)
+            except queue.Full:
+                pass
+        for process in processes:
+            await loop.run_in_executor(None, process.join, 10)
+            if process.is_alive():
+                process.terminate()
@@ -10,10 +10,16 @@ with open('README.rst') as readme_file:
 with open('HISTORY.rst') as history_file:
     history = history_file.read()
 
-requirements = ['Click>=7.0', 'aionostr>=0.11']
+requirements = ['Click>=7.0', 'aionostr>=0.11', 'coincurve', 'cryptography']
 
 test_requirements = [ ]
 
+extras_requirements = {
+    # faster JSON for RPC commands and event content
+    'orjson': ['orjson'],
+    'msgspec': ['msgspec'],
+}
+
 setup(
     author="Dave St.Germain",
     author_email='dave@st.germa.in',
@@ -35,6 +41,7 @@ setup(
         ],
     },
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="BSD license",
     long_description=readme + '\n\n' + history,
     include_package_data=True,
@@ -0,0 +1,52 @@
+"""Tests for `nostr_bot.admission`."""
+import unittest
+
+from aionostr.event import Event
+from aionostr.key import PrivateKey
+
+from nostr_bot.admission import AdmissionControl, TokenBucket
+
+from .test_verify import CollectingBot, iterate, make_events
+
+
+class TestAdmission(unittest.IsolatedAsyncioTestCase):
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2, burst=3, now=0)
+        self.assertEqual([bucket.take(now=0) for i in range(4)], [True, True, True, False])
+        self.assertTrue(bucket.take(now=0.5))
+        self.assertFalse(bucket.take(now=0.5))
+        self.assertEqual(sum(bucket.take(now=100) for i in range(5)), 3)
+
+    def test_checks(self):
+        admission = AdmissionControl(
+            rate=1, burst=2, max_content_size=10, max_tags=1, filters=[{'kinds': [1]}, {'authors': ['abc']}],
+        )
+        self.assertEqual(admission.check(Event(pubkey='a', content='x' * 11)), 'size')
+        self.assertEqual(admission.check(Event(pubkey='a', tags=[['t', 'a'], ['t', 'b']])), 'size')
+        self.assertEqual(admission.check(Event(pubkey='a', kind=7)), 'query')
+        self.assertIsNone(admission.check(Event(pubkey='abc', kind=7)))
+        self.assertIsNone(admission.check(Event(pubkey='abc', kind=7)))
+        self.assertEqual(admission.check(Event(pubkey='abc', kind=7)), 'rate')
+        # other pubkeys have their own buckets
+        self.assertIsNone(admission.check(Event(pubkey='b')))
+
+        admission = AdmissionControl(global_rate=1, global_burst=2)
+        self.assertEqual([admission.admit(Event(pubkey=str(i))) for i in range(3)], [True, True, False])
+        self.assertEqual(admission.stats['global_rate'], 1)
+        self.assertFalse(AdmissionControl().enabled)
+
+    async def test_flood_is_not_verified(self):
+        bot = CollectingBot()
+        bot.RATE_LIMIT = 1
+        bot.RATE_LIMIT_BURST = 3
+        flood = make_events(20)
+        other = PrivateKey()
+        legit = Event(pubkey=other.public_key.hex(), content='legit', kind=1)
+        other.sign_event(legit)
+        unwanted = Event(pubkey=other.public_key.hex(), content='unwanted', kind=7)
+        other.sign_event(unwanted)
+
+        await bot.process_events(iterate(flood + [legit, unwanted]))
+        self.assertEqual(bot.handled, ['0', '1', '2', 'legit'])
+        self.assertEqual(len(bot.verified_ids), 4)
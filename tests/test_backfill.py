@@ -0,0 +1,104 @@
+"""Tests for `nostr_bot.backfill`."""
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from nostr_bot.backfill import Backfill, Lane
+
+
+class FakeRelay:
+    """
+    Stores one event per second and answers REQs like a relay, newest first.
+    The first `timeouts` REQs are never answered, and at most `max_limit` events are sent
+    """
+    def __init__(self, url, timestamps, timeouts=0, max_limit=None):
+        self.url = url
+        self.events = [SimpleNamespace(id=f'{url}-{ts}', created_at=ts, pubkey='a') for ts in timestamps]
+        self.requests = []
+        self.timeouts = timeouts
+        self.max_limit = max_limit
+
+    async def subscribe(self, sub_id, filter_obj):
+        self.requests.append(filter_obj)
+        queue = asyncio.Queue()
+        if self.timeouts:
+            self.timeouts -= 1
+            return queue
+        matching = sorted(
+            (e for e in self.events if filter_obj['since'] <= e.created_at <= filter_obj['until']
+             and e.pubkey in filter_obj.get('authors', [e.pubkey])),
+            key=lambda e: -e.created_at,
+        )
+        for event in matching[:min(filter_obj['limit'], self.max_limit or filter_obj['limit'])]:
+            queue.put_nowait(event)
+        queue.put_nowait(None)
+        return queue
+
+    async def unsubscribe(self, sub_id):
+        pass
+
+
+class TestBackfill(unittest.IsolatedAsyncioTestCase):
+
+    def test_windows(self):
+        lane = Lane(None, {}, 1, 25, 10)
+        self.assertEqual(lane.next_window(), (16, 25))
+        lane.loaded(False)
+        # twice as long after an empty window
+        self.assertEqual(lane.next_window(), (1, 15))
+        self.assertIsNone(lane.next_window())
+        lane = Lane(None, {}, 1, 25, 10)
+        lane.next_window()
+        lane.loaded(True)
+        self.assertEqual([lane.next_window(), lane.next_window(), lane.next_window()], [(6, 15), (1, 5), None])
+
+    async def test_empty_history(self):
+        # 56 years of daily windows, with events only in the last few days
+        now = 56 * 365 * 86400
+        relay = FakeRelay('a', range(now - 3 * 86400, now, 3600))
+        backfill = Backfill(SimpleNamespace(relays=[relay]), page_size=100, fan_out=2)
+        events = [event.id async for event in backfill.get_events({'kinds': [1]}, 1, now)]
+        self.assertEqual(len(events), 72)
+        self.assertLess(len(relay.requests), 40)
+
+    async def test_paging(self):
+        relays = [FakeRelay('a', range(1, 101)), FakeRelay('b', range(50, 151))]
+        backfill = Backfill(SimpleNamespace(relays=relays), window=40, page_size=7, fan_out=3)
+        events = [event.id async for event in backfill.get_events({'kinds': [1], 'limit': 1}, 1, 120)]
+        expected = [f'a-{ts}' for ts in range(1, 101)] + [f'b-{ts}' for ts in range(50, 121)]
+        self.assertEqual(sorted(events), sorted(expected))
+        self.assertTrue(all(request['limit'] == 7 for request in relays[0].requests))
+
+    async def test_page_timeout(self):
+        relays = [FakeRelay('a', range(1, 21), timeouts=2)]
+        backfill = Backfill(SimpleNamespace(relays=relays), page_size=7, page_timeout=0.01, retry_delay=0.01)
+        events = [event.id async for event in backfill.get_events({'kinds': [1]}, 1, 20)]
+        self.assertEqual(sorted(events), sorted(f'a-{ts}' for ts in range(1, 21)))
+        self.assertEqual(backfill.gaps, [])
+
+        # once the retries run out, the range is reported
+        relays = [FakeRelay('a', range(1, 21), timeouts=3)]
+        backfill = Backfill(SimpleNamespace(relays=relays), page_size=7, page_timeout=0.01, retry_delay=0.01,
+                            page_retries=2)
+        events = [event.id async for event in backfill.get_events({'kinds': [1]}, 1, 20)]
+        self.assertEqual(events, [])
+        self.assertEqual(backfill.gaps, [('a', {'kinds': [1]}, 1, 20)])
+
+    async def test_crowded_second(self):
+        relay = FakeRelay('a', range(1, 6), max_limit=7)
+        # 20 events in the same second
+        relay.events.extend(SimpleNamespace(id=f'a-3-{i}', created_at=3, pubkey=f'p{i % 4}') for i in range(20))
+        backfill = Backfill(SimpleNamespace(relays=[relay]), page_size=7)
+        query = {'authors': ['a', 'p0', 'p1', 'p2', 'p3'], 'kinds': [1]}
+        events = [event.id async for event in backfill.get_events(query, 1, 5)]
+        # paged with fewer authors at a time
+        self.assertEqual(sorted(events), sorted(event.id for event in relay.events))
+        self.assertEqual(backfill.gaps, [])
+
+        # when one author has more events in a second than fit in a page, that second is reported
+        relay.events.extend(SimpleNamespace(id=f'a-3-p0-{i}', created_at=3, pubkey='p0') for i in range(10))
+        backfill = Backfill(SimpleNamespace(relays=[relay]), page_size=7)
+        events = [event.id async for event in backfill.get_events(query, 1, 5)]
+        # 8 of its events are missing
+        self.assertEqual(len(events), len(relay.events) - 8)
+        self.assertEqual(backfill.gaps, [('a', query, 3, 3)])
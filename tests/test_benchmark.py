@@ -0,0 +1,35 @@
+"""Tests for `nostr_bot.benchmark`."""
+import unittest
+
+from nostr_bot import CommunicatorBot
+from nostr_bot.benchmark import EventGenerator, run_benchmark
+
+
+class TestBenchmark(unittest.IsolatedAsyncioTestCase):
+
+    def test_encrypted_rpc(self):
+        bot = CommunicatorBot()
+        generator = EventGenerator(authors=3, kinds=[22222], rpc_method='ping', encrypt_with=bot.shared_secrets)
+        for event in generator.generate(5):
+            self.assertTrue(event.verify())
+            self.assertIn(event.pubkey, generator.pubkeys)
+            self.assertIn('"method": "ping"', bot.decrypt_message(event.content, event.pubkey))
+
+    async def test_ping_bot(self):
+        results = await run_benchmark(
+            'nostr_bot.examples.ping.PingBot',
+            count=50,
+            relays=2,
+            duplicate_ratio=0.5,
+            timeout=10,
+            seed=1,
+        )
+        self.assertEqual(results['handled'], 50)
+        self.assertGreater(results['sent'], 50)
+        self.assertEqual(results['stages']['received'], 50)
+        # the pongs are identical within a second, so they may be published only once
+        self.assertGreaterEqual(results['replies'], 2)
+
+    async def test_stored(self):
+        results = await run_benchmark('nostr_bot.NostrBot', count=20, stored=True, timeout=10)
+        self.assertEqual(results['handled'], 20)
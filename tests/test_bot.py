@@ -0,0 +1,69 @@
+"""Tests for the bot classes in `nostr_bot.bot`."""
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from aionostr.key import PrivateKey
+
+from nostr_bot import CommunicatorBot
+from nostr_bot.nip04 import SharedSecrets
+
+
+class TestKeys(unittest.TestCase):
+
+    def test_private_key_is_cached(self):
+        bot = CommunicatorBot()
+        key = bot.private_key
+        self.assertIs(bot.private_key, key)
+        event = bot.make_event(kind=1, content='hello')
+        self.assertTrue(event.verify())
+        self.assertEqual(event.pubkey, key.public_key.hex())
+
+    def test_private_key_changes(self):
+        bot = CommunicatorBot()
+        key = bot.private_key
+        other = PrivateKey()
+        bot.PRIVATE_KEY = other.bech32()
+        self.assertIsNot(bot.private_key, key)
+        self.assertEqual(bot.private_key, other)
+
+
+class TestEncryption(unittest.IsolatedAsyncioTestCase):
+
+    async def test_shared_secret_cache(self):
+        bot = CommunicatorBot()
+        other = SharedSecrets(PrivateKey())
+        other_key = other.private_key.public_key.hex()
+        dm = bot.make_dm(other_key, content='hello')
+        self.assertEqual(other.decrypt(dm.content, bot.PUBLIC_KEY), 'hello')
+        encrypted = other.encrypt('world', bot.PUBLIC_KEY)
+        self.assertEqual(bot.decrypt_message(encrypted, other_key), 'world')
+        self.assertEqual(bot.shared_secrets.stats['hits'], 1)
+
+    async def test_crypto_threads(self):
+        bot = CommunicatorBot()
+        bot.CRYPTO_THREADS = 2
+        other = PrivateKey().public_key.hex()
+        encrypted = await bot.encrypt('hello', other)
+        self.assertEqual(await bot.decrypt(encrypted, other), 'hello')
+        executor = bot._crypto_executor
+        await bot.close()
+        self.assertIsNone(bot._crypto_executor)
+        with self.assertRaises(RuntimeError):
+            executor.submit(print)
+
+    def test_shared_secret_is_symmetric(self):
+        for i in range(20):
+            first, second = PrivateKey(), PrivateKey()
+            self.assertEqual(
+                SharedSecrets(first).get(second.public_key.hex()),
+                SharedSecrets(second).get(first.public_key.hex()),
+            )
+
+    def test_shared_secrets_threads(self):
+        secrets = SharedSecrets(PrivateKey(), maxsize=4)
+        others = [PrivateKey().public_key.hex() for i in range(16)]
+        with ThreadPoolExecutor(8) as executor:
+            encrypted = list(executor.map(lambda other: secrets.encrypt(other, other), others * 8))
+            decrypted = list(executor.map(secrets.decrypt, encrypted, others * 8))
+        self.assertEqual(decrypted, others * 8)
+        self.assertLessEqual(secrets.stats['size'], 4)
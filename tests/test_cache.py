@@ -0,0 +1,55 @@
+"""Tests for `nostr_bot.cache`."""
+import time
+import unittest
+
+from nostr_bot.cache import LRUCache, SeenCache, BloomFilter
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual(cache.get('a'), 1)
+        cache['c'] = 3
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.stats['hits'], 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats['misses'], 1)
+
+    def test_ttl(self):
+        cache = LRUCache(2, ttl=0.01)
+        cache['a'] = 1
+        time.sleep(0.02)
+        self.assertNotIn('a', cache)
+        with self.assertRaises(KeyError):
+            cache['a']
+
+
+class TestSeenCache(unittest.TestCase):
+
+    def test_lru(self):
+        seen = SeenCache(10)
+        self.assertFalse(seen.seen('a'))
+        self.assertTrue(seen.seen('a'))
+        seen.discard('a')
+        self.assertFalse(seen.seen('a'))
+        self.assertEqual(seen.stats['hits'], 1)
+        self.assertEqual(seen.stats['misses'], 2)
+
+    def test_bloom(self):
+        seen = SeenCache(bloom_capacity=100, error_rate=1e-12)
+        for i in range(150):
+            self.assertFalse(seen.seen(f'{i:064x}'))
+        self.assertIsNotNone(seen.previous)
+        # the last 50 are in the current filter and the rest in the previous one
+        self.assertTrue(all(seen.seen(f'{i:064x}') for i in range(150)))
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(str(i))
+        self.assertTrue(all(str(i) in bloom for i in range(1000)))
+        false_positives = sum(str(i) in bloom for i in range(1000, 11000))
+        self.assertLess(false_positives, 300)
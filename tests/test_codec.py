@@ -0,0 +1,60 @@
+"""Tests for `nostr_bot.codec`."""
+import unittest
+from unittest import mock
+
+from nostr_bot.codec import CODECS, CommandError, get_codec
+
+
+def has_msgspec():
+    try:
+        import msgspec  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def available_codecs():
+    codecs = []
+    for name in CODECS:
+        try:
+            codecs.append(get_codec(name))
+        except ImportError:
+            pass
+    return codecs
+
+
+class TestCodecs(unittest.TestCase):
+
+    def test_commands(self):
+        for codec in available_codecs():
+            with self.subTest(codec=codec.name):
+                content = codec.encode_command('ping', [1, 'a'])
+                self.assertEqual(codec.decode_command(content), ('ping', [1, 'a']))
+                self.assertEqual(codec.loads(codec.dumps({'a': [1, None]})), {'a': [1, None]})
+                for bad in ('', 'nope', '[1]', '{"args": []}', '{"method": 1, "args": []}',
+                            '{"method": "", "args": []}', '{"method": "ping"}', '{"method": "ping", "args": {}}'):
+                    with self.assertRaises(CommandError, msg=bad):
+                        codec.decode_command(bad)
+
+    def test_invalid_json(self):
+        for codec in available_codecs():
+            with self.subTest(codec=codec.name):
+                for bad in ('', 'nope', '{"a": '):
+                    with self.assertRaises(ValueError, msg=bad):
+                        codec.loads(bad)
+
+    @unittest.skipUnless(has_msgspec(), 'msgspec is not installed')
+    def test_msgspec(self):
+        from nostr_bot.profiles import Profile
+        codec = get_codec('msgspec')
+        with self.assertRaises(ValueError):
+            codec.loads('{"name": ')
+        self.assertEqual(codec.decode_command('{"method": "ping", "args": [1]}'), ('ping', [1]))
+        with mock.patch('nostr_bot.profiles.loads', codec.loads):
+            self.assertEqual(Profile('ab', 1, '{"name": ').meta, {})
+
+    def test_default(self):
+        self.assertIn(get_codec().name, CODECS)
+        self.assertEqual(get_codec('json').name, 'json')
+        with self.assertRaisesRegex(ValueError, 'Unknown codec'):
+            get_codec('yaml')
@@ -0,0 +1,64 @@
+"""Tests for `nostr_bot.diagnostics`."""
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+from nostr_bot.diagnostics import LagMonitor, Profiler, StackSampler
+
+
+def block(seconds):
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+class TestDiagnostics(unittest.IsolatedAsyncioTestCase):
+
+    async def test_lag_monitor(self):
+        monitor = LagMonitor(interval=0.01, threshold=0.05)
+        monitor.start()
+        await asyncio.sleep(0.05)
+        with self.assertLogs('nostr_bot.diagnostics', 'WARNING') as logs:
+            block(0.2)
+            await asyncio.sleep(0.05)
+        await monitor.stop()
+        self.assertEqual(monitor.stalls, 1)
+        self.assertGreaterEqual(monitor.stats['max_lag_ms'], 150)
+        # the stack of the blocking call is logged while it blocks
+        self.assertTrue(any('in block' in line for line in logs.output))
+
+    async def test_stack_sampler(self):
+        sampler = StackSampler(interval=0.001)
+        sampler.start()
+        block(0.1)
+        sampler.stop()
+        self.assertGreater(sampler.samples, 10)
+        self.assertTrue(sampler.top(1)[0][0].startswith('block'))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'stacks.txt')
+            samples = sampler.dump(path)
+            with open(path) as fileobj:
+                lines = fileobj.read().splitlines()
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in lines))
+        self.assertEqual(sum(int(line.rsplit(' ', 1)[1]) for line in lines), samples)
+        self.assertEqual(sampler.samples, 0)
+
+    async def test_profiler_toggle(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = Profiler(directory, sample_interval=0.001)
+            with self.assertLogs('nostr_bot.diagnostics', 'INFO'):
+                profiler.start()
+                profiler.toggle()
+                data = [str(i) * 100 for i in range(1000)]
+                block(0.05)
+                profiler.toggle()
+            self.assertFalse(profiler.sampler.running)
+            names = sorted(os.listdir(directory))
+            self.assertEqual(len(names), 2)
+            self.assertTrue(names[0].endswith('-memory.txt') and names[1].endswith('-stacks.txt'))
+            with open(os.path.join(directory, names[0])) as fileobj:
+                self.assertIn('test_diagnostics.py', fileobj.read())
+            await profiler.close()
+            del data
@@ -0,0 +1,46 @@
+"""Tests for `nostr_bot.dispatch`."""
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from nostr_bot.dispatch import EventDispatcher
+
+
+class TestEventDispatcher(unittest.IsolatedAsyncioTestCase):
+
+    async def test_inline(self):
+        handled = []
+
+        async def handler(event):
+            handled.append(event.id)
+
+        dispatcher = EventDispatcher(handler)
+        for i in range(3):
+            await dispatcher.put(SimpleNamespace(id=i, pubkey='a'))
+        self.assertEqual(handled, [0, 1, 2])
+        self.assertEqual(dispatcher.workers, [])
+
+    async def test_concurrent_ordered(self):
+        handled = []
+
+        async def handler(event):
+            await asyncio.sleep(0.01 * (3 - event.id % 3))
+            handled.append((event.pubkey, event.id))
+
+        dispatcher = EventDispatcher(handler, concurrency=4, queue_size=8, ordered=True)
+        for i in range(12):
+            await dispatcher.put(SimpleNamespace(id=i, pubkey=str(i % 2)))
+        await dispatcher.close(timeout=5)
+        self.assertEqual(len(handled), 12)
+        for pubkey in ('0', '1'):
+            ids = [eid for pk, eid in handled if pk == pubkey]
+            self.assertEqual(ids, sorted(ids))
+
+    async def test_handler_errors(self):
+        async def handler(event):
+            raise ValueError(event.id)
+
+        dispatcher = EventDispatcher(handler, concurrency=2)
+        with self.assertLogs('nostr_bot.dispatch', level='ERROR'):
+            await dispatcher.put(SimpleNamespace(id=1, pubkey='a'))
+            await dispatcher.close(timeout=1)
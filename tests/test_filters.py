@@ -0,0 +1,62 @@
+"""Tests for `nostr_bot.filters` and `nostr_bot.router`."""
+import unittest
+
+from aionostr.event import Event
+
+from nostr_bot import NostrBot
+from nostr_bot.filters import FilterIndex, event_matches
+from nostr_bot.router import BotRouter
+from .test_verify import iterate, make_events
+
+
+class TestFilters(unittest.TestCase):
+
+    def test_event_matches(self):
+        event = Event(pubkey='aa', kind=1, created_at=100, tags=[['p', 'bb'], ['e', 'cc']])
+        self.assertTrue(event_matches({'kinds': [1], 'limit': 1}, event))
+        self.assertTrue(event_matches({'authors': ['aa'], '#p': ['bb'], 'since': 100}, event))
+        self.assertFalse(event_matches({'kinds': [4]}, event))
+        self.assertFalse(event_matches({'#e': ['dd']}, event))
+        self.assertFalse(event_matches({'until': 99}, event))
+        self.assertTrue(event_matches({}, event))
+
+    def test_index(self):
+        index = FilterIndex()
+        index.add({'authors': ['aa']}, 'author')
+        index.add({'#p': ['bb'], 'kinds': [4]}, 'dm')
+        index.add({'kinds': [1]}, 'notes')
+        index.add({}, 'everything')
+        note = Event(pubkey='aa', kind=1, tags=[['p', 'bb']])
+        self.assertEqual(index.match(note), ['author', 'notes', 'everything'])
+        dm = Event(pubkey='cc', kind=4, tags=[['p', 'bb']])
+        self.assertEqual(index.match(dm), ['dm', 'everything'])
+
+
+class KindBot(NostrBot):
+    def __init__(self, kind):
+        super().__init__()
+        self.LISTEN_KIND = kind
+        self.handled = []
+
+    async def handle_event(self, event):
+        self.handled.append(event.kind)
+
+
+class TestRouter(unittest.IsolatedAsyncioTestCase):
+
+    async def test_routing(self):
+        bots = [KindBot(1), KindBot(1), KindBot(7)]
+        router = BotRouter(bots)
+        for bot in bots + [router]:
+            bot.manager.connected = True
+        await router.setup()
+        self.assertEqual(len(router.get_query()), 3)
+
+        events = make_events(3)
+        events[1].kind = 7
+        events[1].id = Event.compute_id(events[1].pubkey, events[1].created_at, 7, events[1].tags, events[1].content)
+        await router.process_events(iterate(events))
+        self.assertEqual(bots[0].handled, [1, 1])
+        self.assertEqual(bots[1].handled, [1, 1])
+        # the re-kinded event has a stale signature
+        self.assertEqual(bots[2].handled, [])
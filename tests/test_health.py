@@ -0,0 +1,103 @@
+"""Tests for `nostr_bot.health`."""
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from nostr_bot.health import RelayHealth, RelayHealthTracker, relay_health
+from nostr_bot.outbox import Outbox
+from .test_outbox import FakeManager, FakeRelay
+from .test_verify import make_events
+
+
+class SlowRelay(FakeRelay):
+    """
+    Answers OK after `delay` seconds
+    """
+    def __init__(self, url, delay):
+        super().__init__(url)
+        self.delay = delay
+
+    async def send(self, message):
+        self.sent.append(message[1]['id'])
+        response = ['OK', message[1]['id'], True, '']
+        asyncio.get_running_loop().call_later(self.delay, self.event_adds.put_nowait, response)
+
+
+class TestRelayHealth(unittest.IsolatedAsyncioTestCase):
+
+    def test_average_and_ejection(self):
+        health = RelayHealth('ws://health', alpha=0.5, eject_after=3, eject_seconds=10)
+        self.assertIsNone(health.latency)
+        health.record_eose(0.2)
+        health.record_ok(0.1)
+        health.record_ok(0.3)
+        self.assertAlmostEqual(health.latency, 0.2)
+        self.assertAlmostEqual(health.eose_latency, 0.2)
+        self.assertEqual(health.error_rate, 0.0)
+
+        health.record_connect(False)
+        health.record_publish_failure()
+        self.assertFalse(health.ejected())
+        self.assertAlmostEqual(health.error_rate, 0.75)
+        health.record_disconnect()
+        self.assertTrue(health.ejected())
+        first = health.to_dict()['ejected_for']
+        self.assertGreater(first, 9)
+
+        # the next ejection in a row lasts twice as long
+        health.ejected_until = 0
+        for i in range(3):
+            health.record_connect(False)
+        self.assertGreater(health.to_dict()['ejected_for'], 19)
+        health.ejected_until = 0
+        health.record_connect(True)
+        self.assertEqual(health.ejections, 0)
+        self.assertEqual(health.counts['connect_failures'], 4)
+
+    def test_rank(self):
+        tracker = RelayHealthTracker(eject_after=1)
+        relays = [SimpleNamespace(url=url) for url in ('ws://slow', 'ws://fast', 'ws://new', 'ws://down')]
+        tracker.get('ws://slow').record_ok(0.5)
+        tracker.get('ws://fast').record_ok(0.05)
+        tracker.get('ws://down').record_ok(0.01)
+        tracker.get('ws://down').record_connect(False)
+        self.assertEqual([relay.url for relay in tracker.rank(relays)], ['ws://fast', 'ws://slow', 'ws://new'])
+        # when every relay is ejected, use them anyway
+        self.assertEqual(tracker.rank(relays[3:]), relays[3:])
+        self.assertEqual(list(tracker.scores(['ws://new', 'ws://fast'])), ['ws://fast', 'ws://new'])
+
+
+class TestHedgedPublish(unittest.IsolatedAsyncioTestCase):
+
+    def tearDown(self):
+        for url in ('ws://h1', 'ws://h2', 'ws://h3'):
+            relay_health.relays.pop(url, None)
+
+    async def test_fanout(self):
+        relays = [FakeRelay('ws://h1'), FakeRelay('ws://h2'), FakeRelay('ws://h3')]
+        relay_health.get('ws://h2').record_ok(0.01)
+        relay_health.get('ws://h1').record_ok(0.02)
+        outbox = Outbox(FakeManager(relays), fanout=2, hedge_delay=0.5)
+        result = await outbox.publish(make_events(1)[0])
+        results = await asyncio.wait_for(result, 1)
+        self.assertEqual(results['ws://h1'], (True, ''))
+        self.assertEqual(results['ws://h2'], (True, ''))
+        self.assertTrue(results['ws://h3'][1].startswith('skipped:'))
+        self.assertEqual(relays[2].sent, [])
+        await outbox.close()
+
+    async def test_hedge(self):
+        relays = [SlowRelay('ws://h1', 0.2), FakeRelay('ws://h2', failures=5, reason='blocked: no')]
+        outbox = Outbox(FakeManager(relays), fanout=1, hedge_delay=0.05)
+        # the first relay is too slow, so the event is sent to the second one too
+        result = await outbox.publish(make_events(1)[0])
+        results = await asyncio.wait_for(result, 1)
+        self.assertEqual(results, {'ws://h1': (True, ''), 'ws://h2': (False, 'blocked: no')})
+        # and when the first relay fails, it's sent to the rest right away
+        relays[0].delay = 0
+        relay_health.get('ws://h2').record_ok(0.001)
+        outbox.hedge_delay = 10
+        result = await outbox.publish(make_events(2)[1])
+        results = await asyncio.wait_for(result, 0.04)
+        self.assertEqual(results, {'ws://h2': (False, 'blocked: no'), 'ws://h1': (True, '')})
+        await outbox.close()
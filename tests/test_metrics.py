@@ -0,0 +1,71 @@
+"""Tests for `nostr_bot.metrics`."""
+import asyncio
+import unittest
+
+from nostr_bot.metrics import Registry, registry, start_server
+
+from .test_verify import CollectingBot, iterate, make_events
+
+
+class MetricsBot(CollectingBot):
+
+    async def handle_event(self, event):
+        if event.content == '4':
+            raise ValueError(event.content)
+        await super().handle_event(event)
+
+
+class TestMetrics(unittest.IsolatedAsyncioTestCase):
+
+    def test_registry(self):
+        metrics = Registry()
+        counter = metrics.counter('requests_total', 'Requests')
+        counter.inc(bot='a')
+        counter.labels(bot='a').inc(2)
+        counter.inc(bot='b')
+        histogram = metrics.histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+        histogram.observe(0.1, bot='a')
+        histogram.observe(0.5, bot='a')
+        histogram.observe(5, bot='a')
+
+        snapshot = metrics.snapshot(bot='a')
+        self.assertEqual(snapshot['requests_total'], [{'labels': {'bot': 'a'}, 'value': 3}])
+        self.assertEqual(
+            snapshot['latency_seconds'][0]['value'],
+            {'count': 3, 'sum': 5.6, 'buckets': {0.1: 1, 1.0: 2}},
+        )
+        text = metrics.to_prometheus()
+        self.assertIn('requests_total{bot="b"} 1\n', text)
+        self.assertIn('latency_seconds_bucket{bot="a",le="1.0"} 2\n', text)
+        self.assertIn('latency_seconds_bucket{bot="a",le="+Inf"} 3\n', text)
+        with self.assertRaises(ValueError):
+            metrics.histogram('requests_total')
+
+    async def test_bot_stages(self):
+        bot = MetricsBot()
+        bot.get_origin = lambda: 'MetricsBot'
+        events = make_events(6, invalid=(2,))
+        await bot.process_events(iterate(events + events[:1]))
+
+        stages = {
+            sample['labels']['stage']: sample['value']
+            for sample in registry.snapshot(bot='MetricsBot')['nostr_bot_events_total']
+        }
+        self.assertEqual(stages, {'received': 7, 'duplicate': 1, 'invalid': 1, 'handled': 4, 'error': 1})
+        latency = registry.snapshot(bot='MetricsBot', stage='handle')['nostr_bot_stage_seconds']
+        self.assertEqual(latency[0]['value']['count'], 5)
+
+    async def test_server(self):
+        metrics = Registry()
+        metrics.counter('up_total', 'Up').inc()
+        server = await start_server(0, host='127.0.0.1', registry=metrics)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            response = (await reader.read()).decode()
+            writer.close()
+        finally:
+            server.close()
+        self.assertTrue(response.startswith('HTTP/1.1 200 OK'))
+        self.assertIn('\r\n\r\n# HELP up_total Up\n# TYPE up_total counter\nup_total 1\n', response)
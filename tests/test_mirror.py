@@ -0,0 +1,98 @@
+"""Tests for `nostr_bot.examples.mirror`."""
+import asyncio
+import os
+import tempfile
+import unittest
+
+from nostr_bot.benchmark import FakeRelay
+from nostr_bot.examples.mirror import MirrorFollowersBot
+
+from .test_verify import make_events
+
+
+class SilentRelay(FakeRelay):
+    """
+    Accepts subscriptions but never answers them
+    """
+    async def handle_message(self, ws, message):
+        if message[0] == 'REQ':
+            self.subscriptions[(ws, message[1])] = message[2:]
+        else:
+            await super().handle_message(ws, message)
+
+
+class TestMirror(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.target = await FakeRelay().start()
+        bot = self.bot = MirrorFollowersBot()
+        bot.TARGET_RELAY = self.target.url
+        bot.STATE_FILE = os.path.join(self.tmpdir.name, 'mirror.sqlite')
+        bot.CHECK_BATCH_SIZE = 3
+        bot.CHECK_BATCH_DELAY = 0.05
+        bot.target_manager = bot.get_manager([self.target.url])
+        await bot.target_manager.connect()
+
+    async def asyncTearDown(self):
+        await self.bot.close()
+        await self.target.close()
+        self.tmpdir.cleanup()
+
+    async def published(self, count):
+        # mirrored events are queued for the target relay
+        for i in range(100):
+            if len(self.target.published) >= count:
+                return
+            await asyncio.sleep(0.01)
+
+    async def test_skip_and_publish(self):
+        events = make_events(3)
+        # the target relay already has two of them
+        self.target.store(events[:2])
+        for event in events:
+            await self.bot.handle_event(event)
+        await self.published(1)
+        self.assertEqual([row['id'] for row in self.target.published], [events[2].id])
+        self.assertEqual(self.bot.stats['mirrored'], 1)
+        self.assertEqual(self.bot.stats['skipped'], 2)
+        self.assertEqual(self.bot.stats['skipped_bytes'], sum(len(str(event)) for event in events[:2]))
+        self.assertEqual(self.bot.pending, [])
+        # events already handled aren't checked again
+        await self.bot.handle_event(events[2])
+        self.assertEqual(self.bot.pending, [])
+
+    async def test_partial_batch(self):
+        event = make_events(1)[0]
+        await self.bot.handle_event(event)
+        self.assertEqual(self.bot.pending, [event])
+        self.assertEqual(self.target.published, [])
+        # the cursor waits for the event to be mirrored
+        checkpoint = self.bot.store.checkpoint
+        self.assertEqual(checkpoint.cursor, None)
+        # flushed once CHECK_BATCH_DELAY has passed, without filling the batch
+        await self.published(1)
+        self.assertEqual([row['id'] for row in self.target.published], [event.id])
+        self.assertEqual(self.bot.stats, {'mirrored': 1, 'skipped': 0, 'skipped_bytes': 0})
+        self.assertIsNone(self.bot.flush_task)
+        self.assertEqual(checkpoint.cursor, event.created_at)
+
+    async def test_check_timeout(self):
+        await self.bot.target_manager.close()
+        await self.target.close()
+        self.target = await SilentRelay().start()
+        self.bot.TARGET_RELAY = self.target.url
+        self.bot.CHECK_TIMEOUT = 0.1
+        self.bot.target_manager = self.bot.get_manager([self.target.url])
+        await self.bot.target_manager.connect()
+        events = make_events(3)
+        for event in events:
+            await self.bot.handle_event(event)
+        # the batch is mirrored without the check
+        await self.published(3)
+        self.assertEqual(sorted(row['id'] for row in self.target.published), sorted(event.id for event in events))
+        self.assertEqual(self.bot.pending, [])
+        self.assertEqual(self.bot.store.checkpoint.cursor, max(event.created_at for event in events))
+        # and the lookup was closed
+        await asyncio.sleep(0.05)
+        self.assertEqual(self.target.subscriptions, {})
@@ -0,0 +1,90 @@
+"""Tests for `nostr_bot.outbox`."""
+import asyncio
+import unittest
+
+from nostr_bot.outbox import Outbox, RelayWriter
+from .test_verify import make_events
+
+
+class FakeRelay:
+    """
+    Answers EVENT messages with OK, rejecting the first `failures` attempts
+    """
+    def __init__(self, url, failures=0, reason='error: try again'):
+        self.url = url
+        self.failures = failures
+        self.reason = reason
+        self.event_adds = asyncio.Queue()
+        self.sent = []
+
+    async def send(self, message):
+        self.sent.append(message[1]['id'])
+        if self.failures:
+            self.failures -= 1
+            response = ['OK', message[1]['id'], False, self.reason]
+        else:
+            response = ['OK', message[1]['id'], True, '']
+        asyncio.get_running_loop().call_soon(self.event_adds.put_nowait, response)
+
+
+class FakeManager:
+    def __init__(self, relays):
+        self.relays = relays
+
+
+class TestOutbox(unittest.IsolatedAsyncioTestCase):
+
+    async def test_publish_and_retry(self):
+        relays = [FakeRelay('ws://a'), FakeRelay('ws://b', failures=1)]
+        manager = FakeManager(relays)
+        outbox = Outbox(manager, retry_delay=0.01)
+        other = Outbox(manager)
+        self.assertIs(other.get_writer(relays[0]), outbox.get_writer(relays[0]))
+
+        results = [await outbox.publish(event) for event in make_events(3)]
+        first = await results[0]
+        self.assertEqual(first['ws://a'], (True, ''))
+        self.assertEqual(first['ws://b'], (True, ''))
+        self.assertEqual(len(relays[1].sent), 4)
+        await outbox.flush(1)
+        self.assertTrue(all(result.accepted for result in results))
+        await outbox.close()
+        self.assertEqual(outbox.writers, {})
+        self.assertTrue(other.writers[relays[0]].tasks)
+        await other.close()
+        self.assertFalse(RelayWriter._writers)
+
+    async def test_permanent_failure(self):
+        relay = FakeRelay('ws://a', failures=5, reason='blocked: no')
+        outbox = Outbox(FakeManager([relay]), retry_delay=0.01)
+        result = await outbox.publish(make_events(1)[0])
+        self.assertEqual(await result, {'ws://a': (False, 'blocked: no')})
+        self.assertFalse(result.accepted)
+        self.assertEqual(len(relay.sent), 1)
+        await outbox.close()
+
+    async def test_same_event_twice(self):
+        relay = FakeRelay('ws://a')
+        outbox = Outbox(FakeManager([relay]))
+        event = make_events(1)[0]
+        first = await outbox.publish(event)
+        second = await outbox.publish(event)
+        self.assertEqual(await asyncio.wait_for(first, 1), {'ws://a': (True, '')})
+        self.assertEqual(await asyncio.wait_for(second, 1), {'ws://a': (True, '')})
+        self.assertEqual(len(relay.sent), 1)
+        await outbox.close()
+
+    async def test_close_fails_pending(self):
+        relay = FakeRelay('ws://a')
+        relay.send = lambda message: asyncio.sleep(0)
+        outbox = Outbox(FakeManager([relay]))
+        sent, queued = make_events(2)
+        writer = outbox.get_writer(relay)
+        first = await outbox.publish(sent)
+        await asyncio.sleep(0.01)
+        writer.tasks[0].cancel()
+        second = await outbox.publish(queued)
+        await outbox.close(0.01)
+        closed = {'ws://a': (False, 'closed: outbox stopped')}
+        self.assertEqual(await asyncio.wait_for(first, 1), closed)
+        self.assertEqual(await asyncio.wait_for(second, 1), closed)
@@ -0,0 +1,109 @@
+"""Tests for `nostr_bot.pool`."""
+import asyncio
+import json
+import unittest
+
+from nostr_bot.benchmark import FakeRelay
+from nostr_bot.outbox import Outbox
+from nostr_bot.pool import RelayPool
+
+from .test_verify import make_events
+
+
+class TestRelayPool(unittest.IsolatedAsyncioTestCase):
+
+    async def test_shared_relays(self):
+        pool = RelayPool()
+        first = pool.get_manager(['ws://a', 'ws://b'])
+        second = pool.get_manager(['ws://b'])
+        self.assertIs(first.relays[1], second.relays[0])
+        self.assertEqual(pool.relays['ws://b'].users, 2)
+
+        await second.close()
+        self.assertEqual(pool.relays['ws://b'].users, 1)
+        await first.close()
+        self.assertEqual(pool.relays, {})
+
+    async def test_shared_ok_responses(self):
+        pool = RelayPool()
+        with_outbox, without_outbox = pool.get_manager(['ws://a']), pool.get_manager(['ws://a'])
+        relay = with_outbox.relays[0]
+        slow, fast = make_events(2)
+
+        async def send(message):
+            # the OKs arrive in the opposite order
+            delay = 0.02 if message[1]['id'] == slow.id else 0
+            response = ['OK', message[1]['id'], True, '']
+            asyncio.get_running_loop().call_later(delay, relay.event_adds.put_nowait, response)
+
+        relay.send = send
+        outbox = Outbox(with_outbox, timeout=1)
+        result = await outbox.publish(slow)
+        await asyncio.wait_for(without_outbox.add_event(fast, check_response=True), 1)
+        self.assertEqual(await asyncio.wait_for(result, 1), {'ws://a': (True, '')})
+        self.assertIs(relay.writer, outbox.get_writer(relay))
+        # the last user to close the relay waits for the events still in flight
+        late = make_events(1)[0]
+        await without_outbox.add_event(late)
+        self.assertEqual(len(relay.pending), 1)
+        await outbox.close()
+        await without_outbox.close()
+        await with_outbox.close()
+        self.assertIsNone(relay.writer)
+        self.assertEqual(relay.pending, set())
+
+    async def test_merged_subscriptions(self):
+        pool = RelayPool()
+        manager = pool.get_manager(['ws://a', 'ws://b'])
+        quiet, busy, output = asyncio.Queue(), asyncio.Queue(), asyncio.Queue()
+        events = make_events(3)
+        for event in events + events[:1]:
+            busy.put_nowait(event)
+        busy.put_nowait(None)
+        task = asyncio.create_task(manager.monitor_queues([quiet, busy], output))
+        try:
+            # the busy relay isn't held up by the quiet one
+            for event in events:
+                self.assertIs(await asyncio.wait_for(output.get(), 1), event)
+            quiet.put_nowait(None)
+            self.assertIsNone(await asyncio.wait_for(output.get(), 1))
+            self.assertTrue(output.empty())
+        finally:
+            task.cancel()
+
+    async def test_reconnect_after_clean_close(self):
+        class RestartingRelay(FakeRelay):
+            """
+            Closes the first connection with 1001 (going away) after answering a REQ
+            """
+            connections = 0
+
+            async def handler(self, ws, path=None):
+                self.connections += 1
+                if self.connections == 1:
+                    await self.handle_message(ws, json.loads(await ws.recv()))
+                    await ws.close(1001)
+                    return
+                await super().handler(ws, path)
+
+        server = await RestartingRelay().start()
+        manager = RelayPool().get_manager([server.url])
+        try:
+            await manager.connect()
+            relay = manager.relays[0]
+            first = relay.ws
+            event = make_events(1)[0]
+            server.store([event])
+            queue = await relay.subscribe('sub', {'ids': [event.id]})
+            self.assertEqual((await asyncio.wait_for(queue.get(), 1)).id, event.id)
+            self.assertIsNone(await asyncio.wait_for(queue.get(), 1))
+            # resubscribed on the new connection
+            self.assertEqual((await asyncio.wait_for(queue.get(), 2)).id, event.id)
+            self.assertEqual(server.connections, 2)
+            self.assertIsNot(relay.ws, first)
+            # only one new connection, however many users notice the closed one
+            await asyncio.gather(relay.reconnect(first), relay.reconnect(first))
+            self.assertEqual(server.connections, 2)
+        finally:
+            await manager.close()
+            await server.close()
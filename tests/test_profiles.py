@@ -0,0 +1,70 @@
+"""Tests for `nostr_bot.profiles`."""
+import asyncio
+import json
+import unittest
+from types import SimpleNamespace
+
+from nostr_bot.profiles import ProfileResolver
+
+
+def profile_event(pubkey, created_at, **meta):
+    return SimpleNamespace(pubkey=pubkey, kind=0, created_at=created_at, content=json.dumps(meta))
+
+
+class TestProfileResolver(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.queries = []
+        self.stored = [
+            profile_event('a', 1, name='old a'),
+            profile_event('a', 2, name='alice', display_name='Alice'),
+            profile_event('b', 1, name='bob'),
+            profile_event('x', 1, name='not asked for'),
+        ]
+
+    async def get_events(self, filter_obj):
+        self.queries.append(filter_obj)
+        await asyncio.sleep(0.01)
+        for event in self.stored:
+            if event.pubkey in filter_obj['authors']:
+                yield event
+
+    async def test_batched(self):
+        resolver = ProfileResolver(self.get_events, delay=0.01)
+        names = await asyncio.gather(
+            resolver.get_name('a'), resolver.get_name('b'), resolver.get_name('a'), resolver.get_name('c', 'c?'),
+        )
+        self.assertEqual(names, ['Alice', 'bob', 'Alice', 'c?'])
+        self.assertEqual(self.queries, [{'kinds': [0], 'authors': ['a', 'b', 'c']}])
+
+        # cached, including the missing profile
+        self.assertEqual(await resolver.get_name('b'), 'bob')
+        self.assertIsNone(await resolver.resolve('c'))
+        self.assertEqual(len(self.queries), 1)
+        self.assertEqual(resolver.stats, {'hits': 2, 'coalesced': 1, 'misses': 3, 'size': 3})
+        await resolver.close()
+
+    async def test_feed(self):
+        resolver = ProfileResolver(self.get_events, delay=0.01)
+        resolver.feed(profile_event('d', 5, name='dave'))
+        resolver.feed(profile_event('d', 4, name='older'))
+        resolver.feed(SimpleNamespace(pubkey='e', kind=1, created_at=5, content='hi'))
+        self.assertEqual(await resolver.get_name('d'), 'dave')
+        resolver.feed(SimpleNamespace(pubkey='d', kind=0, created_at=6, content='not json'))
+        self.assertEqual(await resolver.get_name('d', 'd?'), 'd?')
+        self.assertEqual(self.queries, [])
+        await resolver.close()
+
+    async def test_errors(self):
+        async def failing(filter_obj):
+            self.queries.append(filter_obj)
+            raise ConnectionError('down')
+            yield
+
+        resolver = ProfileResolver(failing, delay=0.01)
+        with self.assertLogs('nostr_bot.profiles', 'WARNING'):
+            self.assertIsNone(await resolver.resolve('a'))
+        resolver.get_events = self.get_events
+        self.assertEqual(await resolver.get_name('a'), 'Alice')
+        self.assertEqual(len(self.queries), 2)
+        await resolver.close()
@@ -0,0 +1,182 @@
+"""Tests for `nostr_bot.query`."""
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from nostr_bot.query import LOADED, LiveQuery, QueryPlanner, diff_filters, split_filter
+
+
+class FakeManager:
+    """
+    Answers each subscription with one event per author, then EOSE
+    """
+    def __init__(self):
+        self.subscriptions = {}
+        self.requests = []
+
+    async def subscribe(self, sub_id, *filters):
+        self.requests.append(filters)
+        queue = asyncio.Queue()
+        for filter_obj in filters:
+            for author in filter_obj.get('authors', []):
+                queue.put_nowait(SimpleNamespace(id=author, pubkey=author))
+        # a duplicate from another relay
+        queue.put_nowait(SimpleNamespace(id='dup', pubkey='dup'))
+        queue.put_nowait(None)
+        self.subscriptions[sub_id] = True
+        return queue
+
+    async def unsubscribe(self, sub_id):
+        del self.subscriptions[sub_id]
+
+
+class TestQueryPlanner(unittest.IsolatedAsyncioTestCase):
+
+    def test_split_filter(self):
+        chunks = split_filter({'authors': list('abcde'), 'kinds': [1]}, max_authors=2)
+        self.assertEqual([chunk['authors'] for chunk in chunks], [['a', 'b'], ['c', 'd'], ['e']])
+        self.assertTrue(all(chunk['kinds'] == [1] for chunk in chunks))
+        self.assertEqual(split_filter({'kinds': [1]}), [{'kinds': [1]}])
+
+    async def test_chunked_query(self):
+        manager = FakeManager()
+        planner = QueryPlanner(manager, max_authors=3, fan_out=2)
+        authors = [str(i) for i in range(10)]
+        events = [event.id async for event in planner.get_events({'authors': authors}, {'kinds': [0]})]
+        self.assertEqual(sorted(events), sorted(authors + ['dup']))
+        self.assertEqual(len(manager.requests), 5)
+        self.assertEqual(manager.subscriptions, {})
+
+    async def test_missing_eose(self):
+        class SlowManager(FakeManager):
+            async def subscribe(self, sub_id, *filters):
+                queue = await super().subscribe(sub_id, *filters)
+                if len(self.requests) == 1:
+                    # the first relay never sends EOSE
+                    queue = asyncio.Queue()
+                    queue.put_nowait(SimpleNamespace(id='first', pubkey='first'))
+                return queue
+
+        manager = SlowManager()
+        planner = QueryPlanner(manager, max_authors=1, fan_out=1, eose_timeout=0.05)
+        events = []
+        stream = planner.get_events({'authors': ['a', 'b', 'c']}, only_stored=False, mark_loaded=True)
+        async for event in stream:
+            events.append(event.id)
+            if len(events) == 4:
+                break
+        await stream.aclose()
+        # the other chunks subscribed anyway, but the first one hasn't loaded
+        self.assertEqual(events, ['first', 'b', 'dup', 'c'])
+        self.assertEqual(len(manager.requests), 3)
+        self.assertEqual(manager.subscriptions, {})
+
+    async def test_mark_loaded(self):
+        planner = QueryPlanner(FakeManager(), max_authors=3, fan_out=2)
+        for authors in (['a'], [str(i) for i in range(10)]):
+            events = []
+            async for event in planner.get_events({'authors': authors}, only_stored=False, mark_loaded=True):
+                events.append(event)
+                if event is LOADED:
+                    break
+            # after all the stored events
+            self.assertEqual(len(events), len(authors) + 2)
+            self.assertIs(events[-1], LOADED)
+
+
+class TestLiveQuery(unittest.IsolatedAsyncioTestCase):
+
+    def test_diff_filters(self):
+        old = [{'authors': ['a', 'b'], 'since': 10}, {'kinds': [0]}]
+        self.assertEqual(diff_filters(old, old), [])
+        new = [{'authors': ['a', 'b', 'c'], 'since': 10}, {'kinds': [0]}, {'kinds': [3]}]
+        self.assertEqual(diff_filters(old, new), [{'authors': ['c'], 'since': 10}, {'kinds': [3]}])
+        # removing authors or filters, or changing other fields needs a new subscription
+        self.assertIsNone(diff_filters(old, [{'authors': ['a'], 'since': 10}, {'kinds': [0]}]))
+        self.assertIsNone(diff_filters(old, [{'authors': ['a', 'b'], 'since': 10}]))
+        self.assertIsNone(diff_filters(old, [{'authors': ['a', 'b'], 'kinds': [1]}, {'kinds': [0]}]))
+
+    async def test_update(self):
+        subscriptions = []
+
+        async def get_events(*filters, only_stored=True):
+            queue = asyncio.Queue()
+            subscriptions.append((filters, queue))
+            try:
+                while True:
+                    yield await queue.get()
+            finally:
+                subscriptions.remove((filters, queue))
+
+        live = LiveQuery(get_events, [{'authors': ['a'], 'limit': 10}])
+        received = []
+
+        async def receive():
+            async for event in live.events():
+                received.append(event)
+
+        task = asyncio.create_task(receive())
+        await asyncio.sleep(0)
+        opened = await live.update([{'authors': ['a', 'b'], 'limit': 10}], since=100)
+        self.assertEqual(opened, [{'authors': ['b'], 'since': 100}])
+        await asyncio.sleep(0)
+        self.assertEqual(len(subscriptions), 2)
+        for filters, queue in subscriptions:
+            queue.put_nowait(filters[0]['authors'][0])
+        await asyncio.sleep(0.01)
+        self.assertEqual(sorted(received), ['a', 'b'])
+
+        opened = await live.update([{'authors': ['b']}], since=200)
+        self.assertEqual(opened, [{'authors': ['b'], 'since': 200}])
+        self.assertEqual([filters for filters, queue in subscriptions], [tuple(opened)])
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        self.assertEqual(subscriptions, [])
+
+    async def test_update_while_loading(self):
+        subscriptions = []
+
+        async def get_events(*filters, only_stored=True, mark_loaded=False):
+            # a queue per subscription. None stands for EOSE
+            queue = asyncio.Queue()
+            subscriptions.append((filters, queue))
+            while True:
+                item = await queue.get()
+                if item is not None:
+                    yield item
+                elif mark_loaded:
+                    yield LOADED
+
+        live = LiveQuery(get_events, [{'authors': ['a', 'b'], 'since': 10}], mark_loaded=True)
+        received = []
+
+        async def receive():
+            async for event in live.events():
+                received.append(event)
+
+        task = asyncio.create_task(receive())
+        await asyncio.sleep(0.01)
+        subscriptions[0][1].put_nowait('a-50')
+        await asyncio.sleep(0.01)
+        # removing an author reopens the subscription from the original since, not from the newest event
+        opened = await live.update([{'authors': ['a'], 'since': 10}], since=50)
+        self.assertEqual(opened, [{'authors': ['a'], 'since': 10}])
+        # adding one waits for its stored events too
+        opened = await live.update([{'authors': ['a', 'c'], 'since': 10}], since=50)
+        self.assertEqual(opened, [{'authors': ['c'], 'since': 10}])
+        await asyncio.sleep(0.01)
+        self.assertEqual(len(subscriptions), 3)
+        subscriptions[1][1].put_nowait(None)
+        await asyncio.sleep(0.01)
+        self.assertNotIn(LOADED, received)
+        subscriptions[2][1].put_nowait(None)
+        await asyncio.sleep(0.01)
+        self.assertEqual(received, ['a-50', LOADED])
+        self.assertFalse(live.loading)
+        # afterwards, updates resume from `since`
+        opened = await live.update([{'authors': ['a', 'c', 'd'], 'since': 10}], since=60)
+        self.assertEqual(opened, [{'authors': ['d'], 'since': 60}])
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
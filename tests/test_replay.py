@@ -0,0 +1,60 @@
+"""Tests for `nostr_bot.replay`."""
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+
+from nostr_bot.benchmark import FakeRelay
+from nostr_bot.examples.ping import PingBot
+from nostr_bot.replay import replay
+
+from .test_verify import CollectingBot, make_events
+
+
+class TestReplay(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir.name, name)
+
+    async def test_record_and_replay(self):
+        events = make_events(5, invalid=(3,))
+        async with FakeRelay() as relay:
+            bot = CollectingBot()
+            bot.RELAYS = [relay.url]
+            bot.LIMIT = 10
+            bot.RECORD_FILE = self.path('events.jsonl.gz')
+            relay.store(events[:2])
+            task = asyncio.create_task(bot.start())
+            while not relay.subscriptions:
+                await asyncio.sleep(0.01)
+            for event in events[2:]:
+                await relay.push(event)
+            while len(bot.handled) < 4:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        bot = CollectingBot()
+        results = await replay(bot, self.path('events.jsonl.gz'))
+        self.assertEqual(results['events'], 5)
+        self.assertEqual(bot.handled, ['0', '1', '2', '4'])
+
+    async def test_replies(self):
+        bot = PingBot()
+        with open(self.path('pings.jsonl'), 'w') as fileobj:
+            for i in range(3):
+                event = bot.make_event(kind=22222, content=json.dumps({'method': 'ping', 'args': [i]}))
+                fileobj.write(json.dumps(['EVENT', 'sub', event.to_json_object()]) + '\n')
+            fileobj.write('not json\n')
+
+        results = await replay(bot, self.path('pings.jsonl'), reply_path=self.path('replies.jsonl'))
+        self.assertEqual(results['events'], 3)
+        with open(self.path('replies.jsonl')) as fileobj:
+            replies = [json.loads(line) for line in fileobj]
+        self.assertTrue(replies)
+        self.assertEqual(json.loads(replies[0]['content']), {'method': 'pong', 'args': []})
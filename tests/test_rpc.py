@@ -0,0 +1,160 @@
+"""Tests for RPC dispatch in `nostr_bot.rpc`."""
+import asyncio
+import unittest
+
+from aionostr.event import Event
+from aionostr.key import PrivateKey
+
+from nostr_bot import RPCBot, rpc_method
+
+
+class CalcBot(RPCBot):
+    ENCRYPTED = False
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+        self.running = 0
+        self.max_running = 0
+
+    async def on_add(self, event, a: float, b: float = 0):
+        self.calls.append(a + b)
+
+    async def on_echo(self, event, *args):
+        self.calls.append(args)
+
+    @rpc_method(name='slow', concurrency=2)
+    async def expensive(self, event, name: str):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        self.calls.append(name)
+
+    async def on_fail(self, event):
+        raise ValueError('fail')
+
+
+class LoudCalcBot(CalcBot):
+
+    async def on_add(self, event, a: int, b: int):
+        self.calls.append(f'{a} + {b}')
+
+
+class CachedBot(RPCBot):
+    ENCRYPTED = True
+
+    def __init__(self):
+        super().__init__()
+        self.computed = 0
+        self.replies = []
+
+    @rpc_method(cache_ttl=60)
+    async def on_square(self, event, x: int):
+        self.computed += 1
+        await asyncio.sleep(0.01)
+        if x < 0:
+            raise ValueError('negative')
+        return self.make_response(event, kind=event.kind, content=str(x * x))
+
+    @rpc_method(cache_ttl=60)
+    async def on_cube(self, event, x: int):
+        self.computed += 1
+        await asyncio.sleep(0.01)
+        # made for this caller only
+        return {'event': self.make_event(kind=event.kind, content=str(x ** 3), encrypt_to=event.pubkey)}
+
+    async def reply(self, event, wait=False):
+        self.replies.append(event)
+
+
+class Caller(RPCBot):
+    def __init__(self, private_key):
+        self.PRIVATE_KEY = private_key
+        super().__init__()
+
+
+class TestRPC(unittest.IsolatedAsyncioTestCase):
+
+    def call(self, bot, method, *args):
+        return bot.handle_event(Event(pubkey='ab', kind=22222, content=bot.codec.encode_command(method, args)))
+
+    def test_registry(self):
+        self.assertEqual(set(CalcBot.rpc_methods), {'add', 'echo', 'slow', 'fail'})
+        self.assertEqual(RPCBot.rpc_methods, {})
+        method = CalcBot.rpc_methods['add']
+        self.assertEqual((method.min_args, method.max_args), (1, 2))
+        self.assertIsNone(method.check_args([1, 2.5]))
+        self.assertIn('takes 1 to 2 arguments', method.check_args([]))
+        self.assertIn('must be float, not str', method.check_args(['1']))
+        self.assertIn('must be float, not bool', method.check_args([True]))
+        self.assertIsNone(CalcBot.rpc_methods['echo'].check_args([1, 2, 3]))
+        self.assertIsNot(LoudCalcBot.rpc_methods['add'], method)
+
+    async def test_dispatch(self):
+        bot = CalcBot()
+        await self.call(bot, 'add', 1, 2)
+        await self.call(bot, 'add', 'x')
+        await self.call(bot, 'echo', 'a', 'b')
+        await self.call(bot, 'fail')
+        await self.call(bot, 'missing')
+        await asyncio.gather(*[self.call(bot, 'slow', str(i)) for i in range(5)])
+        self.assertEqual(bot.calls[:2], [3, ('a', 'b')])
+        self.assertEqual(sorted(bot.calls[2:]), ['0', '1', '2', '3', '4'])
+        self.assertEqual(bot.max_running, 2)
+
+        stats = bot.rpc_stats
+        self.assertGreaterEqual(stats['add']['invalid'], 1)
+        self.assertGreaterEqual(stats['fail']['errors'], 1)
+
+        bot = LoudCalcBot()
+        await self.call(bot, 'add', 1, 2)
+        self.assertEqual(bot.calls, ['1 + 2'])
+
+    async def test_cached(self):
+        bot = CachedBot()
+        callers = [Caller(PrivateKey().hex()), Caller(PrivateKey().hex())]
+
+        def call(caller, x):
+            content = caller.encrypt_message(bot.codec.encode_command('square', [x]), bot.PUBLIC_KEY)
+            return bot.handle_event(Event(pubkey=caller.PUBLIC_KEY, kind=22222, content=content))
+
+        # concurrent identical calls share one computation
+        await asyncio.gather(call(callers[0], 3), call(callers[1], 3), call(callers[0], 3))
+        await call(callers[1], 3)
+        await call(callers[0], 4)
+        self.assertEqual(bot.computed, 2)
+        self.assertEqual(len(bot.replies), 5)
+        # each reply is encrypted to and signed for its caller
+        for caller, reply in zip([callers[0], callers[1], callers[0], callers[1]], bot.replies):
+            self.assertTrue(reply.verify())
+            self.assertEqual(caller.decrypt_message(reply.content, bot.PUBLIC_KEY), '9')
+        self.assertEqual(len({reply.id for reply in bot.replies}), 5)
+
+        # errors aren't cached
+        await asyncio.gather(call(callers[0], -1), call(callers[1], -1))
+        await call(callers[0], -1)
+        self.assertEqual(bot.computed, 4)
+
+        stats = bot.rpc_stats['square']['cache']
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['coalesced'], 3)
+        self.assertEqual(stats['misses'], 4)
+        self.assertEqual(stats['size'], 2)
+
+    async def test_uncacheable(self):
+        bot = CachedBot()
+        callers = [Caller(PrivateKey().hex()), Caller(PrivateKey().hex())]
+
+        def call(caller, x):
+            content = caller.encrypt_message(bot.codec.encode_command('cube', [x]), bot.PUBLIC_KEY)
+            return bot.handle_event(Event(pubkey=caller.PUBLIC_KEY, kind=22222, content=content))
+
+        with self.assertLogs(bot.log, 'WARNING'):
+            await asyncio.gather(call(callers[0], 2), call(callers[1], 2))
+        await call(callers[1], 2)
+        # each caller gets a response made for it
+        self.assertEqual(bot.computed, 3)
+        for caller, reply in zip([callers[0], callers[1], callers[1]], bot.replies):
+            self.assertEqual(caller.decrypt_message(reply.content, bot.PUBLIC_KEY), '8')
+        self.assertEqual(bot.rpc_stats['cube']['cache']['size'], 0)
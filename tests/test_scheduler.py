@@ -0,0 +1,83 @@
+"""Tests for `nostr_bot.scheduler`."""
+import asyncio
+import unittest
+from types import SimpleNamespace
+
+from nostr_bot import NostrBot
+from nostr_bot.bot import start_multiple
+from nostr_bot.scheduler import PriorityScheduler, ScheduledDispatcher
+
+
+class IdleBot(NostrBot):
+    async def start(self):
+        self.started_with = self.scheduler
+
+
+class TestPriorityScheduler(unittest.IsolatedAsyncioTestCase):
+
+    async def test_weighted_fair_queuing(self):
+        handled = []
+
+        async def handler(event):
+            await asyncio.sleep(0.001)
+            handled.append(event.id)
+
+        scheduler = PriorityScheduler(concurrency=1)
+        bulk = scheduler.get_dispatcher(handler, priority=lambda event: 'bulk', queue_size=100, name='bulk')
+        interactive = scheduler.get_dispatcher(handler, priority=lambda event: 'interactive', name='interactive')
+        for i in range(20):
+            await bulk.put(SimpleNamespace(id=f'b{i}'))
+        for i in range(10):
+            await interactive.put(SimpleNamespace(id=f'i{i}'))
+        await asyncio.gather(bulk.close(5), interactive.close(5))
+
+        self.assertEqual(len(handled), 30)
+        # 8 interactive events for each bulk event, while both are waiting
+        self.assertEqual(handled[:10], ['b0'] + [f'i{i}' for i in range(8)] + ['b1'])
+        self.assertEqual([e for e in handled if e.startswith('b')], [f'b{i}' for i in range(20)])
+        stats = scheduler.stats
+        self.assertEqual(stats, {})
+        await scheduler.close()
+
+    async def test_bot_concurrency(self):
+        running = 0
+        max_running = 0
+
+        async def handler(event):
+            nonlocal running, max_running
+            running += 1
+            max_running = max(running, max_running)
+            await asyncio.sleep(0.005)
+            running -= 1
+
+        scheduler = PriorityScheduler(concurrency=4)
+        dispatcher = scheduler.get_dispatcher(handler, concurrency=1, queue_size=2, name='serial')
+        for i in range(6):
+            await dispatcher.put(SimpleNamespace(id=i))
+        self.assertIn('serial', scheduler.stats['default'])
+        await dispatcher.close(5)
+        self.assertEqual(max_running, 1)
+        self.assertEqual(dispatcher.handled.get(), 6)
+        self.assertEqual(dispatcher.pending, 0)
+        await scheduler.close()
+
+    async def test_bot_dispatcher(self):
+        bot = NostrBot()
+        self.assertEqual(bot.get_priority(SimpleNamespace(kind=22222)), 'interactive')
+        self.assertEqual(bot.get_priority(SimpleNamespace(kind=1)), 'default')
+        bot.scheduler = PriorityScheduler()
+        self.assertIsInstance(bot.get_dispatcher(), ScheduledDispatcher)
+        bot.PRIORITY = 'urgent'
+        with self.assertRaises(ValueError):
+            await bot.get_dispatcher().put(SimpleNamespace(kind=1, id='x'))
+        await bot.scheduler.close()
+
+    async def test_start_multiple(self):
+        # several bots keep their own inline dispatchers unless asked to share a scheduler
+        bots = [IdleBot(), IdleBot()]
+        await start_multiple(bots)
+        self.assertEqual([bot.started_with for bot in bots], [None, None])
+        bots = [IdleBot(), IdleBot()]
+        await start_multiple(bots, prioritize=True)
+        self.assertIsInstance(bots[0].started_with, PriorityScheduler)
+        self.assertIs(bots[0].started_with, bots[1].started_with)
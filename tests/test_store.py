@@ -0,0 +1,157 @@
+"""Tests for `nostr_bot.store`."""
+import os
+import tempfile
+import time
+import unittest
+
+from aionostr.event import Event
+from aionostr.key import PrivateKey
+
+from nostr_bot import NostrBot
+from nostr_bot.query import LOADED
+from nostr_bot.store import Checkpoint, StateStore
+
+from .test_verify import iterate
+
+
+class TestStateStore(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'state.sqlite')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    async def test_write_behind(self):
+        store = StateStore(self.path, flush_interval=60)
+        await store.set('a', {'seen': 1})
+        store.set_cursor(10)
+        store.set_cursor(5)
+        self.assertTrue(await store.contains('a'))
+        self.assertFalse(await store.contains('b'))
+        self.assertEqual(await store.get_cursor(), 10)
+        await store.close()
+
+        store = StateStore(self.path)
+        self.assertEqual(await store.get('a'), {'seen': 1})
+        self.assertEqual(await store.get_cursor(1), 10)
+        await store.delete('a')
+        await store.close()
+
+        store = StateStore(self.path)
+        self.assertIsNone(await store.get('a'))
+        await store.close()
+
+    async def test_shards(self):
+        store = StateStore(self.path)
+        store.set_cursor(10)
+        await store.close()
+        # each worker keeps its own cursor, starting from the one saved before
+        for shard, cursor in ((0, 30), (1, 20)):
+            store = StateStore(self.path, shard=shard)
+            self.assertEqual(await store.get_cursor(), 10)
+            store.set_cursor(cursor)
+            await store.close()
+        # the parent resumes from the oldest
+        store = StateStore(self.path, shards=2)
+        self.assertEqual(await store.get_cursor(), 20)
+        await store.close()
+        store = StateStore(self.path, shard=0)
+        self.assertEqual(await store.get_cursor(), 30)
+        await store.close()
+
+    def test_future_events(self):
+        checkpoint = Checkpoint()
+        now = int(time.time())
+        checkpoint.begin(now + 10 ** 7)
+        checkpoint.end(now + 10 ** 7)
+        self.assertLessEqual(checkpoint.cursor, int(time.time()))
+        self.assertGreaterEqual(checkpoint.cursor, now)
+        self.assertFalse(checkpoint.in_progress)
+
+    def test_checkpoint(self):
+        checkpoint = Checkpoint()
+        checkpoint.value = 5
+        checkpoint.hold()
+        # stored events arrive newest first
+        for timestamp in (30, 20, 10):
+            checkpoint.begin(timestamp)
+        checkpoint.end(30)
+        checkpoint.end(20)
+        self.assertEqual(checkpoint.cursor, 5)
+        checkpoint.loaded()
+        # not past the event still in progress
+        self.assertEqual(checkpoint.cursor, 10)
+        checkpoint.begin(40)
+        checkpoint.end(10)
+        self.assertEqual(checkpoint.cursor, 30)
+        checkpoint.end(40)
+        self.assertEqual(checkpoint.cursor, 40)
+        self.assertFalse(checkpoint.in_progress)
+
+
+class StoringBot(NostrBot):
+    LISTEN_KIND = 1
+
+    async def handle_event(self, event):
+        await self.store.set(event.id, event.created_at)
+
+
+class TestCursor(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        pk = PrivateKey()
+        self.events = []
+        # newest first, like the stored events from a relay
+        for created_at in (1030, 1020, 1010):
+            event = Event(pubkey=pk.public_key.hex(), content=str(created_at), kind=1, created_at=created_at)
+            pk.sign_event(event)
+            self.events.append(event)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def get_bot(self):
+        bot = StoringBot()
+        bot.STATE_FILE = os.path.join(self.tmpdir.name, 'state.sqlite')
+        # as in start(), which subscribes
+        bot.loading = True
+        return bot
+
+    async def get_cursor(self):
+        store = StateStore(os.path.join(self.tmpdir.name, 'state.sqlite'))
+        try:
+            return await store.get_cursor()
+        finally:
+            await store.close()
+
+    async def test_crash_while_loading(self):
+        async def crash():
+            yield self.events[0]
+            raise ConnectionError('crash')
+
+        bot = self.get_bot()
+        await bot.store.get_cursor()
+        with self.assertRaises(ConnectionError):
+            await bot.process_events(crash())
+        await bot.close()
+        # the older stored events weren't processed, so the cursor didn't move
+        self.assertIsNone(await self.get_cursor())
+
+    async def test_loaded(self):
+        bot = self.get_bot()
+        await bot.store.get_cursor()
+        await bot.process_events(iterate(self.events + [LOADED]))
+        await bot.close()
+        self.assertEqual(await self.get_cursor(), 1030)
+
+    async def test_dropped_events(self):
+        bot = self.get_bot()
+        self.events[0].sig = '00' * 64
+        # the duplicate and the invalid event don't hold the cursor back
+        await bot.process_events(iterate(self.events + self.events[1:2] + [LOADED]))
+        self.assertEqual(bot.checkpoint.in_progress, {})
+        self.assertEqual(bot.checkpoint.cursor, 1020)
+        await bot.close()
@@ -0,0 +1,112 @@
+"""Tests for event verification in `nostr_bot`."""
+import asyncio
+import unittest
+
+from aionostr.event import Event
+from aionostr.key import PrivateKey
+
+from nostr_bot import NostrBot
+
+
+def make_events(count, invalid=()):
+    pk = PrivateKey()
+    events = []
+    for i in range(count):
+        event = Event(pubkey=pk.public_key.hex(), content=str(i), kind=1)
+        pk.sign_event(event)
+        if i in invalid:
+            event.sig = '00' * 64
+        events.append(event)
+    return events
+
+
+async def iterate(items):
+    for item in items:
+        yield item
+
+
+class CollectingBot(NostrBot):
+    def __init__(self):
+        super().__init__()
+        self.handled = []
+
+    async def handle_event(self, event):
+        self.handled.append(event.content)
+
+
+class TestVerification(unittest.IsolatedAsyncioTestCase):
+
+    async def run_bot(self, **config):
+        bot = CollectingBot()
+        for key, value in config.items():
+            setattr(bot, key, value)
+        events = make_events(10, invalid=(3, 7))
+        await bot.process_events(iterate(events))
+        self.assertEqual(bot.handled, [str(i) for i in range(10) if i not in (3, 7)])
+        return bot, events
+
+    async def test_inline(self):
+        bot, events = await self.run_bot()
+        self.assertTrue(bot.is_verified(events[0]))
+        self.assertEqual(bot.verified_ids.hits, 1)
+
+    async def test_thread_pool(self):
+        await self.run_bot(VERIFY_WORKERS=2, VERIFY_THREADS=True, VERIFY_BATCH_SIZE=3)
+
+    async def test_process_pool(self):
+        await self.run_bot(VERIFY_WORKERS=2, VERIFY_BATCH_SIZE=4)
+
+    async def test_duplicates(self):
+        bot = CollectingBot()
+        events = make_events(3, invalid=(1,))
+        await bot.process_events(iterate(events + events))
+        self.assertEqual(bot.handled, ['0', '2'])
+        self.assertEqual(bot.seen_ids.stats['hits'], 2)
+
+    async def test_forged_copy(self):
+        bot = CollectingBot()
+        event = make_events(1)[0]
+        self.assertTrue(bot.is_verified(event))
+        # a verified id and signature, on different content
+        forged = Event(pubkey=event.pubkey, content='forged', created_at=event.created_at, kind=1,
+                       id=event.id, sig=event.sig)
+        self.assertFalse(bot.is_verified(forged))
+        bot.VERIFY_WORKERS = 1
+        bot.VERIFY_THREADS = True
+        bot.DEDUP_SIZE = 0
+        bot.seen_ids = None
+        await bot.process_events(iterate([forged, event]))
+        self.assertEqual(bot.handled, ['0'])
+
+    async def test_forged_copy_first(self):
+        for config in ({}, {'DEDUP_BLOOM_CAPACITY': 100}, {'VERIFY_WORKERS': 1, 'VERIFY_THREADS': True}):
+            with self.subTest(**config):
+                bot = CollectingBot()
+                for key, value in config.items():
+                    setattr(bot, key, value)
+                bot.seen_ids = bot.get_seen_cache()
+                event = make_events(1)[0]
+                forged = Event(pubkey=event.pubkey, content='0', created_at=event.created_at, kind=1,
+                               id=event.id, sig='00' * 64)
+                # the forged copy arrives first, but doesn't hide the real one
+                await bot.process_events(iterate([forged, event, event]))
+                self.assertEqual(bot.handled, ['0'])
+
+    async def test_verifier_error(self):
+        bot = CollectingBot()
+        bot.VERIFY_WORKERS = 1
+
+        class BrokenVerifier:
+            def verify(self, event):
+                future = asyncio.get_running_loop().create_future()
+                future.set_exception(RuntimeError('worker died'))
+                return future
+
+            async def close(self):
+                pass
+
+        bot.get_verifier = BrokenVerifier
+        with self.assertLogs(bot.log, 'WARNING') as logs:
+            await bot.process_events(iterate(make_events(2)))
+        self.assertEqual(bot.handled, [])
+        self.assertEqual(sum('Invalid event' in line for line in logs.output), 2)
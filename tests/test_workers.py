@@ -0,0 +1,117 @@
+"""Tests for `nostr_bot.workers`."""
+import os
+import queue
+import tempfile
+import unittest
+
+from nostr_bot.router import BotRouter
+from nostr_bot.workers import LOADED_ROW, QUERY_ROW, ShardRouter, WorkerRouter, queue_events, shard_for
+
+from .test_filters import KindBot
+from .test_store import StoringBot
+from .test_verify import CollectingBot, make_events
+
+
+class TestWorkers(unittest.IsolatedAsyncioTestCase):
+
+    def test_shard_for(self):
+        shards = [shard_for(str(i), 4) for i in range(100)]
+        self.assertEqual(shards, [shard_for(str(i), 4) for i in range(100)])
+        self.assertEqual(set(shards), {0, 1, 2, 3})
+
+    async def test_queue_events(self):
+        work_queue = queue.Queue()
+        for event in make_events(5, invalid=(2,)):
+            work_queue.put(event.to_json_object())
+        work_queue.put(None)
+
+        bot = CollectingBot()
+        await bot.process_events(queue_events(work_queue))
+        self.assertEqual(bot.handled, ['0', '1', '3', '4'])
+
+    async def test_loaded_row(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for loaded in (False, True):
+                work_queue = queue.Queue()
+                events = make_events(3, invalid=(1,))
+                for event in events:
+                    work_queue.put(event.to_json_object())
+                if loaded:
+                    work_queue.put(LOADED_ROW)
+                work_queue.put(None)
+
+                bot = StoringBot()
+                bot.STATE_FILE = os.path.join(tmpdir, f'{loaded}.sqlite')
+                router = BotRouter([bot])
+                router.loading = True
+                for each in (bot, router):
+                    each.manager.connected = True
+                await router.setup()
+                await bot.store.get_cursor()
+                checkpoint = bot.checkpoint
+                await router.process_events(queue_events(work_queue))
+                # the cursor waits for the parent's LOADED_ROW
+                self.assertEqual(checkpoint.in_progress, {})
+                self.assertEqual(checkpoint.cursor, events[2].created_at if loaded else None)
+
+    async def test_query_updates(self):
+        control_queue = queue.Queue()
+        bots = [KindBot(1), KindBot(7)]
+        worker = WorkerRouter(bots, 1, control_queue)
+        for bot in bots + [worker]:
+            bot.manager.connected = True
+        await worker.setup()
+        # a bot in the worker changes its query
+        await bots[1].update_query({'kinds': [7, 8]}, since=100)
+        self.assertEqual(control_queue.get_nowait(), (1, 1, {'kinds': [7, 8]}, 100))
+        self.assertEqual(worker.get_query(), [{'kinds': [1], 'limit': 1}, {'kinds': [7, 8]}])
+
+        # the parent updates its subscription and tells the other workers
+        updates = []
+
+        class FakeLiveQuery:
+            async def update(self, filters, since=None):
+                updates.append((filters, since))
+                return filters
+
+        queues = [queue.Queue(), queue.Queue()]
+        parent = ShardRouter([KindBot(1), KindBot(7)], queues)
+        parent.index_queries()
+        parent.live_query = FakeLiveQuery()
+        control_queue.put((1, 1, {'kinds': [7, 8]}, 100))
+        control_queue.put(None)
+        await parent.listen(control_queue)
+        self.assertEqual(updates, [([{'kinds': [1], 'limit': 1}, {'kinds': [7, 8]}], 100)])
+        self.assertEqual(queues[0].get_nowait(), (QUERY_ROW, 1, {'kinds': [7, 8]}))
+        self.assertTrue(queues[1].empty())
+
+        # which apply it to their own bots
+        other = WorkerRouter([KindBot(1), KindBot(7)], 0, queue.Queue())
+        other.index_queries()
+        queues[0].put((QUERY_ROW, 1, {'kinds': [7, 8]}))
+        queues[0].put(None)
+        events = [event async for event in queue_events(queues[0], set_query=other.query_changed)]
+        self.assertEqual(events, [])
+        self.assertEqual(other.get_query(), [{'kinds': [1], 'limit': 1}, {'kinds': [7, 8]}])
+
+    async def test_query_update_admits_new_authors(self):
+        first, second = make_events(1), make_events(1)
+
+        class AuthorBot(CollectingBot):
+            def get_query(self):
+                return {'authors': [first[0].pubkey], 'kinds': [1]}
+
+        bot = AuthorBot()
+        worker = WorkerRouter([bot], 0, queue.Queue())
+        worker.loading = False
+        for each in (bot, worker):
+            each.manager.connected = True
+        await worker.setup()
+        work_queue = queue.Queue()
+        work_queue.put(first[0].to_json_object())
+        work_queue.put((QUERY_ROW, 0, {'authors': [first[0].pubkey, second[0].pubkey], 'kinds': [1]}))
+        work_queue.put(second[0].to_json_object())
+        work_queue.put(None)
+        await worker.process_events(queue_events(work_queue, set_query=worker.query_changed))
+        self.assertEqual(len(bot.handled), 2)
+        self.assertEqual(worker.admission.stats['query'], 0)